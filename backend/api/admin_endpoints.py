@@ -0,0 +1,141 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+# This file defines the admin endpoints for finding what uses CPU and memory in a running worker
+# (see profiling.py): a sampling CPU profile, tracemalloc snapshots, and the entries and estimated
+# size of every cache by user. They are disabled unless ADMIN_TOKEN is set, and every request has
+# to send it as "Authorization: Bearer <ADMIN_TOKEN>".
+
+import os
+import hmac
+import asyncio
+import tracemalloc
+from collections import defaultdict
+from typing import Literal
+
+from fastapi import APIRouter, Depends, HTTPException, Header
+from fastapi.responses import PlainTextResponse
+
+from profiling import (Profiler, AllocationSnapshots, DEFAULT_PROFILE_INTERVAL, MAX_PROFILE_SECONDS, start_tracemalloc,
+                       estimate_bytes, memoized_entries, key_user)
+from api.metrics_endpoints import MEMOIZED_FUNCTIONS
+from gpt.functions import tool_result_cache, tool_schema_cache
+from logs import get_logger
+logger = get_logger("admin")
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+
+def require_admin(authorization: str = Header(None)):
+    if not ADMIN_TOKEN:
+        # Disabled: behave as if the endpoints did not exist
+        raise HTTPException(status_code=404, detail="Not Found")
+    token = authorization.split(" ", 1)[1] if authorization and " " in authorization else ""
+    if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+
+router = APIRouter(prefix="/admin", dependencies=[Depends(require_admin)])
+
+
+# CPU profile -----------------------------------------------------------------------------------
+@router.post("/profile/start")
+async def start_profile(seconds: float = 30, interval: float = DEFAULT_PROFILE_INTERVAL, idle: bool = False) -> dict:
+    # Start profiling in the background, fetch the result with /admin/profile/stop
+    profiler = Profiler()
+    try:
+        profiler.start(seconds, interval, idle)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    logger.info("Started CPU profile", seconds=seconds, interval=interval)
+    return {**profiler.status(), "seconds": min(seconds, MAX_PROFILE_SECONDS)}
+
+
+@router.get("/profile/status")
+async def profile_status() -> dict:
+    return Profiler().status()
+
+
+@router.post("/profile/stop", response_class=PlainTextResponse)
+async def stop_profile():
+    # Stop the profile if it is still running and return its collapsed stacks
+    profiler = Profiler()
+    if profiler.started is None:
+        raise HTTPException(status_code=404, detail="No profile was started")
+    await asyncio.to_thread(profiler.stop)
+    logger.info("Stopped CPU profile", samples=profiler.samples)
+    return PlainTextResponse(profiler.collapsed())
+
+
+@router.get("/profile", response_class=PlainTextResponse)
+async def profile(seconds: float = 10, interval: float = DEFAULT_PROFILE_INTERVAL, idle: bool = False):
+    # Profile for `seconds` and return the collapsed stacks, e.g., `curl ... > profile.folded`
+    await start_profile(seconds, interval, idle)
+    await asyncio.sleep(min(seconds, MAX_PROFILE_SECONDS))
+    return await stop_profile()
+
+
+# Memory ----------------------------------------------------------------------------------------
+@router.post("/memory/start")
+async def start_memory_tracing(frames: int = 1) -> dict:
+    # Trace allocations from now on, keeping `frames` frames of each traceback
+    start_tracemalloc(frames)
+    AllocationSnapshots().previous = None
+    logger.info("Started tracemalloc", frames=frames)
+    return {"tracing": True, "frames": frames}
+
+
+@router.get("/memory/snapshot")
+async def memory_snapshot(limit: int = 25, group_by: Literal["lineno", "filename", "traceback"] = "lineno",
+                          compare: bool = False) -> dict:
+    # Top allocators of the memory allocated since tracing started, or of the change since the last snapshot
+    try:
+        return await asyncio.to_thread(AllocationSnapshots().top, limit, group_by, compare)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+
+@router.post("/memory/stop")
+async def stop_memory_tracing() -> dict:
+    tracemalloc.stop()
+    AllocationSnapshots().previous = None
+    logger.info("Stopped tracemalloc")
+    return {"tracing": False}
+
+
+@router.get("/caches")
+async def cache_sizes(top: int = 20) -> dict:
+    """
+    Return the entries and estimated bytes of every cache, in total and by user, and the `top` users by bytes.
+    Sizes are estimated on the event loop, which is blocked meanwhile, so this is slow with large caches.
+    - top: the number of users to return per cache and overall (int)
+    """
+    entries_by_cache = {name: [(key_user(key), value) for key, value in memoized_entries(function)]
+                        for name, function in MEMOIZED_FUNCTIONS.items() if hasattr(function, "cache_close")}
+    # Tool result keys start with the tool name, followed by the user ID
+    entries_by_cache["tool_results"] = [(key[1], result) for key, (result, _) in list(tool_result_cache.entries.items())]
+    entries_by_cache["tool_schemas"] = list(tool_schema_cache.entries.items())
+
+    caches, users = {}, defaultdict(lambda: {"entries": 0, "bytes": 0})
+    for name, entries in entries_by_cache.items():
+        by_user = defaultdict(lambda: {"entries": 0, "bytes": 0})
+        for user_id, value in entries:
+            size = estimate_bytes(value)
+            for totals in (by_user[user_id], users[user_id]):
+                totals["entries"] += 1
+                totals["bytes"] += size
+        caches[name] = {
+            "entries": len(entries),
+            "bytes": sum(totals["bytes"] for totals in by_user.values()),
+            "users": dict(sorted(by_user.items(), key=lambda item: -item[1]["bytes"])[:top]),
+        }
+    # lru_cache does not expose its entries, so only their number is known
+    for name, function in MEMOIZED_FUNCTIONS.items():
+        if name not in caches:
+            caches[name] = {"entries": function.cache_info().currsize, "bytes": None, "users": {}}
+
+    return {
+        "caches": caches,
+        "users": dict(sorted(users.items(), key=lambda item: -item[1]["bytes"])[:top]),
+    }
@@ -11,6 +11,8 @@ from typing import Literal
 from data.utils import round_datetime, advance_datetime
 from data.data_point import DataPoint
 from data.fetch import fetch_aggregated_data
+from logs import get_logger
+logger = get_logger("api")
 
 router = APIRouter(prefix="/data")
 
@@ -23,7 +25,7 @@ async def get_featurized_data(series: str,
                               ) -> list[DataPoint]:
     # API endpoint to expose `data_fetch_utils.fetch_featurized_data`
 
-    print(f"Calling get_featurized_data with args: series={series}, user_id={user_id}, date={date}, granularity={granularity}")
+    logger.info("Calling get_featurized_data", series=series, user_id=user_id, date=date, granularity=granularity)
     date = datetime.fromisoformat(date).replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
     start = round_datetime(date, granularity)
     end = advance_datetime(start, granularity)
@@ -38,6 +40,6 @@ async def get_featurized_data(series: str,
     elif granularity == "month":
         agg_granularity = "day"
 
-    print(f"Data endpoint: fetching data for {user_id} from {start_str} to {end_str} with granularity {granularity} at aggregation level {agg_granularity}")
+    logger.debug("Data endpoint: fetching data", user_id=user_id, start=start_str, end=end_str, granularity=granularity, aggregation=agg_granularity)
     aggregated_data, description_string = await fetch_aggregated_data(user_id, series, start_str, end_str, agg_granularity, include_empty_buckets=True)
     return aggregated_data
\ No newline at end of file
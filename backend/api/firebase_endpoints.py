@@ -4,6 +4,8 @@
 
 from fastapi import APIRouter, HTTPException, Header
 from firebase import FirebaseManager
+from logs import get_logger
+logger = get_logger("api")
 
 router = APIRouter(prefix="/firebase") 
 
@@ -27,9 +29,8 @@ async def verify_token(authorization: str = Header(None)) -> str:
     if not firebase_manager or not firebase_manager.auth:
         raise HTTPException(status_code=500, detail="Firebase not initialized")
     try:
-        print("Verifying token:", token)
         uid = firebase_manager.verify_token(token)
-        print("Token verified successfully, uid = ", uid)
+        logger.info("Token verified", user_id=uid)
         return uid
     except Exception as e:  
         raise HTTPException(status_code=401, detail=str(e))
@@ -4,23 +4,34 @@
 
 # This file defines the endpoints for sending GPT messages
 
+import asyncio
 from fastapi import APIRouter, WebSocket, HTTPException, WebSocketDisconnect
 from datetime import datetime, timedelta
 import openai
 import pytz
 from websockets.exceptions import ConnectionClosed
-from gpt.messages import process_message, fetch_user_summary, resume_conversation, rewind_conversation
+from gpt.messages import process_message, resume_conversation, rewind_conversation, history_page
 from gpt.dsm.dialogue_state_manager import DialogueStateManager
-from gpt.openai_client import OpenAIClient
-openai_client = OpenAIClient()
+from gpt.session import ConversationSession
+from gpt.scheduler import LLMDeadlineExceeded, RETRYABLE_ERRORS
+from gpt.jobs import JobQueue
+from gpt.memory import UserMemories
+from gpt.warmup import DataWarmup
+from monitoring import TURN_ERRORS
+from logs import get_logger
+logger = get_logger("api")
 
 router = APIRouter(prefix="/gpt")
 
+OVERLOADED_MESSAGE = "Sorry, I'm having trouble responding right now. Could you send your message again in a moment?"
+
 from firebase import FirebaseManager
 firebase_manager = FirebaseManager()
 
-def get_most_recent_session_id(user_id):
-    collection_ref =  firebase_manager.get_user_doc(user_id).collection('gpt-messages')
+def get_most_recent_session_id(user_doc_ref):
+    # `user_doc_ref`: the reference of the user document, which the caller validates
+    user_id = user_doc_ref.id
+    collection_ref = user_doc_ref.collection('gpt-messages')
     session_ids = []
     for doc in collection_ref.stream():
         session_ids.append(doc.id)
@@ -42,10 +53,10 @@ def get_most_recent_session_id(user_id):
     if len(session_ids) != 0:
         most_recent_session_id = max(session_ids, key=lambda fn: extract_timestamp(fn))
         time_diff = current_time - extract_timestamp(most_recent_session_id)
-        print("Most recent session time diff: ", time_diff)
+        logger.debug("Most recent session time diff", user_id=user_id, time_diff=time_diff)
         # Check if the most recent timestamp is within the last 5 minutes
         if time_diff > timedelta(minutes=60):
-            print("Most recent session has been active for longer than 5 minutes. Getting new session id...")
+            logger.info("Most recent session has been active for longer than 60 minutes, starting a new session", user_id=user_id)
             most_recent_session_id = f"session-{current_time_iso}"        
     else:
         most_recent_session_id = f"session-{current_time_iso}"        
@@ -55,54 +66,102 @@ def get_most_recent_session_id(user_id):
 
 # API endpoints -------------------------------------------------------------------------
 @router.websocket("/ws/{user_id}/")
-async def websocket_endpoint(user_id: str, websocket: WebSocket):
-    print("Initializing websocket endpoint for user_id", user_id, websocket)
-    # Connect a websocket to the frontend
-    if not firebase_manager.is_valid_user_id(user_id):
-        print("invalid user id!")
+async def websocket_endpoint(user_id: str, websocket: WebSocket, history_page_size: int = 0):
+    # `history_page_size` (query parameter): replay the latest messages in one frame instead of one frame per message
+    logger.info("Initializing websocket endpoint", user_id=user_id)
+    # Connect a websocket to the frontend. The user document is read once (off the event loop), both to
+    # validate the user ID and for the jobs and memory below, while the most recent session is found.
+    user_doc_ref = firebase_manager.get_users_col().document(user_id)
+    user_doc, session_id = await asyncio.gather(asyncio.to_thread(user_doc_ref.get),
+                                                asyncio.to_thread(get_most_recent_session_id, user_doc_ref))
+    if not user_doc.exists:
+        logger.warning("Invalid user id", user_id=user_id)
         raise HTTPException(status_code=401, detail="Invalid user id!")
     
     await websocket.accept()
+    # Load the user's data sources, tool schema and recent data while the history is replayed
+    DataWarmup().start(user_id, session_id)
     dialogue_manager = DialogueStateManager(base_directory='../prompts/dialogue/states')
+    session = None
 
     try:
-        # Fetch summary from gpt
-        user_summary = fetch_user_summary(user_id)
+        # The most recent session_id, or a new one if there is none
+        logger.info("Session", user_id=user_id, session_id=session_id)
 
-        # Find the most recent session_id. If it doesn't exist, create a new one
-        session_id = get_most_recent_session_id(user_id)            
-        print("SESSION ID: ", session_id)
+        # Loaded once here and kept up to date for the lifetime of the websocket
+        session = ConversationSession(user_id, session_id)
+        await resume_conversation(session, websocket, page_size=history_page_size)
 
-        await resume_conversation(user_id, session_id, websocket)
+        # After the replay, so the client does not wait for them. Both are done before the first message is processed.
+        # The memory (with the summary) of earlier sessions replaces their history in the prompts
+        user_data = user_doc.to_dict() or {}
+        UserMemories().load(user_id, user_data, session_id)
+        # Resume the background jobs of this user that a previous worker did not finish
+        await JobQueue().resume(user_id, user_data.get("jobs", {}))
 
         while True:
             # Receive a message from the frontend
             data = await websocket.receive_json()
             if data["type"] == "message":  
-                print(f"Received chat message {data}\n")
+                logger.info("Received chat message", user_id=user_id, characters=len(data.get("prompt") or ""))
 
                 prompt = data["prompt"]
                 user_id = data["user_id"]
+                turn_start = len(session.messages)
             
                 try:
-                    await process_message(prompt, user_id=user_id, session_id=session_id, dialogue_manager=dialogue_manager, websocket=websocket)
+                    await process_message(prompt, session=session, dialogue_manager=dialogue_manager, websocket=websocket)
                 except openai.BadRequestError as e:
+                    TURN_ERRORS.inc(error=e.code or type(e).__name__)
                     if e.code == 'context_length_exceeded':
-                        print("Context length exceeded. Updating model to GPT-4 Turbo...")
-                        openai_client.update_model('gpt-4-turbo')
+                        # Prompts are budgeted locally, so this only happens if the token estimate was off.
+                        # Retry this turn with half the budget rather than switching models for everyone.
+                        logger.warning("Context length exceeded, retrying with a smaller context budget", user_id=user_id)
                     else:
-                        print(f"Unhandled OpenAI error: {e}")
+                        logger.error("Unhandled OpenAI error: %s", e, user_id=user_id)
                         return
                     
-                    await process_message(prompt, user_id=user_id, session_id=session_id, dialogue_manager=dialogue_manager, websocket=websocket)
+                    # The failed attempt may already have stored the user message and part of the reply
+                    await session.discard_since(turn_start)
+                    await process_message(prompt, session=session, dialogue_manager=dialogue_manager, websocket=websocket, budget_scale=0.5)
+                except (LLMDeadlineExceeded,) + RETRYABLE_ERRORS as e:
+                    # The scheduler already retried. Keep the connection open so the user can try again.
+                    TURN_ERRORS.inc(error=type(e).__name__)
+                    logger.error("LLM request failed after retries: %s", e, user_id=user_id)
+                    await websocket.send_json({
+                        "type": "message",
+                        "role": "assistant",
+                        "content": OVERLOADED_MESSAGE,
+                        "state": None,
+                        "strategy": None
+                    })
+
+            elif data["type"] == "history":
+                # The client asks for the messages before the oldest one it shows
+                try:
+                    before, limit = int(data.get("before", 0)), int(data.get("limit") or history_page_size or len(session.replay))
+                except (TypeError, ValueError):
+                    before = limit = -1
+                if before < 0 or limit < 0:
+                    logger.warning("Invalid history request", user_id=user_id, before=data.get("before"), limit=data.get("limit"))
+                    await websocket.send_json({
+                        "type": "error",
+                        "content": "Invalid history request: 'before' and 'limit' must be non-negative integers",
+                    })
+                    continue
+                await websocket.send_json(history_page(session.replay, before, limit))
 
             elif data["type"] == "rewind":
-                print("Rewinding conversation...")
-                await rewind_conversation(user_id, session_id, websocket)
+                logger.info("Rewinding conversation", user_id=user_id)
+                await rewind_conversation(session, websocket)
 
-    except ConnectionClosed as e:
-        print("Connection closed:", e)
+    except (ConnectionClosed, WebSocketDisconnect) as e:
+        logger.info("Connection closed: %s", e, user_id=user_id)
         return
     except Exception as e:
-        print("Exception occurred:", e)
-        return
\ No newline at end of file
+        logger.exception("Exception in websocket endpoint: %s", e, user_id=user_id)
+        return
+    finally:
+        if session is not None:
+            # Fold the last turns of the session into the memory
+            UserMemories().maybe_update(session.user_id, session.session_id, session.history_for_gpt, force=True)
\ No newline at end of file
@@ -0,0 +1,72 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+# This file defines the endpoint serving the metrics in the Prometheus text format (see monitoring.py),
+# and the metrics that are read from the caches and the LLM scheduler when it is scraped
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from monitoring import CallbackMetric, render
+from data.data_sources import get_user_data_sources
+from data.fetch import fetch_aggregated_data, fetch_raw_data
+from data.visualize import generate_vizualization
+from gpt.context import count_serialized_tokens
+from gpt.functions import tool_result_cache, tool_schema_cache
+from gpt.scheduler import LLMScheduler
+from gpt.jobs import JobQueue
+
+router = APIRouter()
+
+# Memoized functions (alru_cache and lru_cache), by the name they are reported under
+MEMOIZED_FUNCTIONS = {
+    "fetch_aggregated_data": fetch_aggregated_data,
+    "fetch_raw_data": fetch_raw_data,
+    "generate_vizualization": generate_vizualization,
+    "get_user_data_sources": get_user_data_sources,
+    "count_serialized_tokens": count_serialized_tokens,
+}
+
+
+def cache_lookups() -> dict:
+    # cache name -> (hits, misses)
+    lookups = {}
+    for name, function in MEMOIZED_FUNCTIONS.items():
+        info = function.cache_info()
+        lookups[name] = (info.hits, info.misses)
+    lookups["tool_results"] = (tool_result_cache.hits, tool_result_cache.misses)
+    lookups["tool_schemas"] = (tool_schema_cache.hits, tool_schema_cache.misses)
+    return lookups
+
+
+def cache_lookup_counts() -> dict:
+    counts = {}
+    for name, (hits, misses) in cache_lookups().items():
+        counts[(name, "hit")] = hits
+        counts[(name, "miss")] = misses
+    return counts
+
+
+def cache_hit_ratios() -> dict:
+    return {(name,): hits / (hits + misses) if hits + misses else 0.0 for name, (hits, misses) in cache_lookups().items()}
+
+
+CallbackMetric("cache_lookups_total", "Lookups of the memoized functions and caches", ("cache", "result"),
+               cache_lookup_counts, "counter")
+CallbackMetric("cache_hit_ratio", "Fraction of the lookups of the memoized functions and caches that were hits", ("cache",),
+               cache_hit_ratios)
+CallbackMetric("tool_prefetches_total", "Tool results computed ahead of a likely tool call (started), and lookups that used one (hit)",
+               ("result",), lambda: {("started",): tool_result_cache.prefetches, ("hit",): tool_result_cache.prefetch_hits}, "counter")
+CallbackMetric("llm_requests_in_flight", "LLM requests being sent", (), lambda: {(): LLMScheduler().in_flight})
+CallbackMetric("llm_requests_queued", "LLM requests waiting for a slot", (), lambda: {(): LLMScheduler().slots.queued})
+CallbackMetric("llm_retries_total", "LLM requests retried after a transient error", (), lambda: {(): LLMScheduler().retries}, "counter")
+CallbackMetric("llm_deadlines_exceeded_total", "LLM calls that did not finish within their deadline", (),
+               lambda: {(): LLMScheduler().deadlines_exceeded}, "counter")
+CallbackMetric("jobs_queued", "Background jobs waiting for a worker", (), lambda: {(): JobQueue().queued})
+CallbackMetric("jobs_active", "Background jobs queued, running or waiting for a retry", (), lambda: {(): len(JobQueue().active)})
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,288 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Generator for synthetic HealthKit data in the format the iOS app uploads (see
+ios/HealthKitUpload/Standard/HealthKitUploadStandard+HealthKit.swift): one document per sample in
+`users/{user_id}/health/{data_source}/raw/{start}`, holding the FHIR observation of the sample
+(`valueQuantity`, or `valueCodeableConcept` for workouts), the name of the recording device and the
+time index fields of Date+ConstructTimeIndex.swift.
+
+Sample density differs per data source, from minute-level heart rate to a few workouts a week, and
+can be scaled with `density`. The same seed always generates the same data.
+
+Write data for some users to the Firestore emulator, or to JSON files, from the backend directory:
+    python -m benchmarks.healthkit --users 5 --months 3 --sources health.stepcount health.heartrate --target emulator
+"""
+
+import os
+import json
+import uuid
+import random
+import argparse
+import calendar
+from datetime import date, datetime, timedelta
+import numpy as np
+import pytz
+from pydantic import BaseModel
+
+from firebase import FirebaseManager, STUDY_ID
+
+TIMEZONE = "America/Los_Angeles"
+HEALTHKIT_SYSTEM = "http://developer.apple.com/documentation/healthkit"
+UNITS_SYSTEM = "http://unitsofmeasure.org"
+WATCH = "Apple Watch"
+IPHONE = "iPhone"
+BATCH_SIZE = 500  # maximum number of writes in a Firestore batch
+
+
+class SourceProfile(BaseModel):
+    identifier: str  # HealthKit type identifier
+    unit: str
+    mean: float  # of a sample's value
+    std: float
+    interval: float  # mean time between samples, in minutes
+    hours: tuple[int, int] = (0, 24)  # hours of the day in which samples are recorded
+    duration: float = 0  # time covered by a sample, in minutes (0 for point samples)
+    devices: tuple[str, ...] = (WATCH,)
+    decimals: int = 0
+    minimum: float = 0
+
+
+SOURCE_PROFILES = {
+    "health.stepcount": SourceProfile(identifier="HKQuantityTypeIdentifierStepCount", unit="count", mean=180, std=150,
+                                      interval=10, hours=(7, 23), duration=8, devices=(WATCH, IPHONE)),
+    "health.distancewalkingrunning": SourceProfile(identifier="HKQuantityTypeIdentifierDistanceWalkingRunning", unit="m", mean=130, std=110,
+                                                   interval=10, hours=(7, 23), duration=8, devices=(WATCH, IPHONE), decimals=1),
+    "health.flightsclimbed": SourceProfile(identifier="HKQuantityTypeIdentifierFlightsClimbed", unit="count", mean=2, std=1.5,
+                                           interval=120, hours=(8, 21), duration=5, devices=(IPHONE,), minimum=1),
+    "health.activeenergyburned": SourceProfile(identifier="HKQuantityTypeIdentifierActiveEnergyBurned", unit="kcal", mean=4, std=4,
+                                               interval=5, duration=5, decimals=2),
+    "health.basalenergyburned": SourceProfile(identifier="HKQuantityTypeIdentifierBasalEnergyBurned", unit="kcal", mean=18, std=2,
+                                              interval=15, duration=15, decimals=2),
+    "health.appleexercisetime": SourceProfile(identifier="HKQuantityTypeIdentifierAppleExerciseTime", unit="min", mean=1, std=0,
+                                              interval=30, hours=(6, 21), duration=1, minimum=1),
+    "health.applestandtime": SourceProfile(identifier="HKQuantityTypeIdentifierAppleStandTime", unit="min", mean=4, std=2,
+                                           interval=60, hours=(7, 22), duration=5, minimum=1),
+    "health.heartrate": SourceProfile(identifier="HKQuantityTypeIdentifierHeartRate", unit="count/min", mean=74, std=12,
+                                      interval=1, minimum=40),
+    "health.restingheartrate": SourceProfile(identifier="HKQuantityTypeIdentifierRestingHeartRate", unit="count/min", mean=61, std=4,
+                                             interval=1440, hours=(23, 24), minimum=40),
+    "health.walkingheartrateaverage": SourceProfile(identifier="HKQuantityTypeIdentifierWalkingHeartRateAverage", unit="count/min", mean=98, std=7,
+                                                    interval=1440, hours=(23, 24), minimum=60),
+    "health.heartratevariabilitysdnn": SourceProfile(identifier="HKQuantityTypeIdentifierHeartRateVariabilitySDNN", unit="ms", mean=45, std=15,
+                                                     interval=240, decimals=1, minimum=5),
+    "health.respiratoryrate": SourceProfile(identifier="HKQuantityTypeIdentifierRespiratoryRate", unit="count/min", mean=15, std=1.5,
+                                            interval=10, hours=(0, 7), decimals=1, minimum=8),
+    "health.oxygensaturation": SourceProfile(identifier="HKQuantityTypeIdentifierOxygenSaturation", unit="%", mean=0.97, std=0.01,
+                                             interval=60, hours=(0, 7), decimals=2, minimum=0.85),
+}
+
+# Workouts are sparse interval samples whose value is the activity type
+WORKOUT_TYPES = ["walking", "running", "cycling", "traditionalStrengthTraining", "yoga", "swimming"]
+WORKOUTS_PER_WEEK = 3
+WORKOUT_MINUTES = (20, 90)
+
+DATA_SOURCE_NAMES = list(SOURCE_PROFILES) + ["health.workout"]
+
+
+def iso_format(dt: datetime) -> str:
+    # Date.toISOFormat(): local time with milliseconds and without a UTC offset
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
+
+
+def value_range(start: int, end: int, max_value: int, start_value: int = 0) -> list[int]:
+    # getRange() of Date+ConstructTimeIndex.swift: wraps around if the end is before the start
+    if start <= end:
+        return list(range(start, end + 1))
+    return list(range(start, max_value + 1)) + list(range(start_value, end + 1))
+
+
+def time_index(start: datetime, end: datetime, timezone: str = TIMEZONE) -> dict:
+    # Date.constructTimeIndex(startDate:endDate:)
+    index = {
+        "range": start != end,
+        "timezone": timezone,
+        "datetimeStart": iso_format(start),
+        "datetimeEnd": iso_format(end),
+    }
+    for suffix, dt in [("Start", start), ("End", end)]:
+        index.update({
+            f"year{suffix}": dt.year,
+            f"month{suffix}": dt.month,
+            f"day{suffix}": dt.day,
+            f"hour{suffix}": dt.hour,
+            f"minute{suffix}": dt.minute,
+            f"second{suffix}": dt.second,
+            f"dayMinute{suffix}": dt.hour * 60 + dt.minute,
+            f"fifteenMinBucket{suffix}": dt.hour * 4 + dt.minute // 15,
+        })
+    index["yearRange"] = value_range(start.year, end.year, end.year)
+    index["monthRange"] = value_range(start.month, end.month, 12, 1)
+    index["dayRange"] = value_range(start.day, end.day, calendar.monthrange(start.year, start.month)[1], 1)
+    index["hourRange"] = value_range(start.hour, end.hour, 23)
+    index["dayMinuteRange"] = value_range(index["dayMinuteStart"], index["dayMinuteEnd"], 1439)
+    index["fifteenMinBucketRange"] = value_range(index["fifteenMinBucketStart"], index["fifteenMinBucketEnd"], 95)
+    return index
+
+
+def sample_document(identifier: str, start: datetime, end: datetime, device: str, rng: random.Random,
+                    value: dict, timezone: str = TIMEZONE) -> dict:
+    """
+    Build the Firestore document of one sample, like convertToFirestoreResource() in the iOS app
+    - identifier: the HealthKit type identifier (str)
+    - start, end: the local start and end time of the sample (datetime)
+    - device: the name of the recording device (str)
+    - rng: the random generator for the observation ID (random.Random)
+    - value: the `valueQuantity` or `valueCodeableConcept` entry of the observation (dict)
+    """
+    local = pytz.timezone(timezone)
+    utc_start = local.localize(start).astimezone(pytz.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+    utc_end = local.localize(end).astimezone(pytz.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+    document = {
+        "resourceType": "Observation",
+        "id": str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+        "status": "final",
+        "code": {"coding": [{"system": HEALTHKIT_SYSTEM, "code": identifier}]},
+        "effectivePeriod": {"start": utc_start, "end": utc_end},
+        "issued": utc_end,
+        **value,
+        "device": device,
+    }
+    document.update(time_index(start, end, timezone))
+    return document
+
+
+def generate_quantity_samples(profile: SourceProfile, day: date, device: str, rng: random.Random,
+                              np_rng: np.random.Generator, density: float, level: float) -> list[dict]:
+    first_minute, last_minute = profile.hours[0] * 60, profile.hours[1] * 60
+    interval = profile.interval / density
+    if interval >= last_minute - first_minute:
+        # At most one sample a day, e.g., resting heart rate
+        recorded = rng.random() < min(density, 1)
+        minutes = np.array([first_minute + rng.uniform(0, last_minute - first_minute)] if recorded else [])
+    else:
+        # Sample times with jittered gaps, so that devices do not record at the same instant
+        count = int((last_minute - first_minute) / interval) + 1
+        minutes = first_minute + rng.uniform(0, interval) + np.cumsum(np_rng.uniform(0.7, 1.3, count) * interval) - interval
+        minutes = minutes[(minutes >= first_minute) & (minutes < last_minute)]
+    values = np.maximum(np_rng.normal(profile.mean * level, profile.std, len(minutes)), profile.minimum).round(profile.decimals)
+
+    midnight = datetime.combine(day, datetime.min.time())
+    documents = []
+    for minute, value in zip(minutes, values):
+        start = midnight + timedelta(minutes=float(minute))
+        end = start + timedelta(minutes=profile.duration)
+        quantity = {"valueQuantity": {"value": int(value) if profile.decimals == 0 else float(value),
+                                      "unit": profile.unit, "system": UNITS_SYSTEM, "code": profile.unit}}
+        documents.append(sample_document(profile.identifier, start, end, device, rng, quantity))
+    return documents
+
+
+def generate_workouts(day: date, rng: random.Random, density: float) -> list[dict]:
+    documents = []
+    if rng.random() < min(WORKOUTS_PER_WEEK * density / 7, 1):
+        start = datetime.combine(day, datetime.min.time()) + timedelta(hours=rng.uniform(6, 20))
+        end = start + timedelta(minutes=rng.uniform(*WORKOUT_MINUTES))
+        concept = {"valueCodeableConcept": {"coding": [{"system": HEALTHKIT_SYSTEM, "code": rng.choice(WORKOUT_TYPES)}]}}
+        documents.append(sample_document("HKWorkoutTypeIdentifier", start, end, WATCH, rng, concept))
+    return documents
+
+
+def generate_source(data_source: str, start: date, days: int, seed: int | str = 0, density: float = 1.0) -> dict:
+    """
+    Generate the documents of one data source for consecutive days
+    - data_source: the data source (str), e.g., "health.heartrate"
+    - start: the first day (date)
+    - days: the number of days (int)
+    - seed: the random seed (int or str)
+    - density: a factor on the number of samples (float)
+
+    Returns: the documents by document ID (dict), i.e., by the local start time as in the iOS app
+    """
+    rng = random.Random(f"{seed}:{data_source}")
+    np_rng = np.random.default_rng(rng.getrandbits(64))
+    documents = {}
+    for offset in range(days):
+        day = start + timedelta(days=offset)
+        if data_source == "health.workout":
+            day_documents = generate_workouts(day, rng, density)
+        else:
+            profile = SOURCE_PROFILES[data_source]
+            # Some days are more active than others
+            level = float(np.clip(np_rng.normal(1.0, 0.25), 0.3, 2.0)) if profile.std > 0 else 1.0
+            day_documents = [document for device in profile.devices
+                             for document in generate_quantity_samples(profile, day, device, rng, np_rng, density, level)]
+        # Samples with the same start time overwrite each other, as they do when uploaded
+        documents.update((document["datetimeStart"], document) for document in day_documents)
+    return documents
+
+
+def raw_collection_path(user_id: str, data_source: str) -> str:
+    module, name = data_source.split(".")
+    return f"studies/{STUDY_ID}/users/{user_id}/{module}/{name}/raw"
+
+
+def write_documents(db, user_id: str, data_source: str, documents: dict):
+    """
+    Write generated documents with batched writes, like uploadBatch() in the iOS app
+    - db: a Firestore client (firestore.Client, or the in-memory stand-in of benchmarks/memory_firestore.py)
+    - user_id: the user's Firebase ID (str)
+    - data_source: the data source (str)
+    - documents: the documents by document ID (dict), see generate_source
+    """
+    collection = db.collection(raw_collection_path(user_id, data_source))
+    items = list(documents.items())
+    for index in range(0, len(items), BATCH_SIZE):
+        batch = db.batch()
+        for document_id, document in items[index:index + BATCH_SIZE]:
+            batch.set(collection.document(document_id), document)
+        batch.commit()
+
+
+def seed_user(db, user_id: str, data_sources: list[str], start: date, days: int, seed: int = 0, density: float = 1.0) -> int:
+    # Create the user and write generated data for each data source. Returns the number of documents.
+    db.collection(f"studies/{STUDY_ID}/users").document(user_id).set({"synthetic": True}, merge=True)
+    written = 0
+    for data_source in data_sources:
+        documents = generate_source(data_source, start, days, seed=f"{seed}:{user_id}", density=density)
+        write_documents(db, user_id, data_source, documents)
+        written += len(documents)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic HealthKit data in the iOS upload format")
+    parser.add_argument("--users", type=int, default=1)
+    parser.add_argument("--user-prefix", default="synthetic-user")
+    parser.add_argument("--sources", nargs="+", default=DATA_SOURCE_NAMES, choices=DATA_SOURCE_NAMES)
+    parser.add_argument("--months", type=int, default=3, help="Number of months of data per user")
+    parser.add_argument("--end", type=date.fromisoformat, default=date.today(), help="Last day of data (YYYY-MM-DD)")
+    parser.add_argument("--density", type=float, default=1.0, help="Factor on the number of samples of each source")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--target", choices=["emulator", "json"], default="json")
+    parser.add_argument("--output", default="synthetic_healthkit", help="Directory of the JSON files")
+    args = parser.parse_args()
+
+    days = args.months * 30
+    start = args.end - timedelta(days=days - 1)
+    user_ids = [f"{args.user_prefix}-{index}" for index in range(args.users)]
+    if args.target == "emulator":
+        db = FirebaseManager().initialize_firebase_app().db
+        for user_id in user_ids:
+            written = seed_user(db, user_id, args.sources, start, days, args.seed, args.density)
+            print(f"Wrote {written} documents for {user_id}")
+    else:
+        os.makedirs(args.output, exist_ok=True)
+        for user_id in user_ids:
+            for data_source in args.sources:
+                documents = generate_source(data_source, start, days, seed=f"{args.seed}:{user_id}", density=args.density)
+                path = os.path.join(args.output, f"{user_id}.{data_source}.json")
+                with open(path, "w") as file:
+                    json.dump(documents, file)
+                print(f"Wrote {len(documents)} documents to {path}")
+
+
+if __name__ == "__main__":
+    main()
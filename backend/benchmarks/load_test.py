@@ -0,0 +1,247 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Load generator for the chat websocket (/gpt/ws/{user_id}/). Each simulated client connects as its
+own user and drives a scripted conversation (chat turns, tool-triggering prompts and rewinds).
+The run reports turn latency, time to first frame, connect latency, throughput and event loop lag
+(of the server and of the load generator itself) as JSON, and can compare against an earlier report.
+
+Run from the backend directory against the benchmark server (benchmarks/server.py):
+    python -m benchmarks.load_test --spawn --clients 1 10 50 --output report.json
+    python -m benchmarks.load_test --spawn --clients 1 10 50 --compare report.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+from datetime import datetime, timezone
+import httpx
+import websockets
+
+from benchmarks.stats import summarize
+
+# A step is a chat message or a rewind. `label` groups the turns in the report.
+DEFAULT_SCRIPT = [
+    {"type": "message", "label": "chat", "prompt": "Hi! I've been trying to be more active lately."},
+    {"type": "message", "label": "tool", "prompt": "How many steps did I take last week?"},
+    {"type": "message", "label": "tool", "prompt": "Can you show me a graph of my steps this month?"},
+    {"type": "rewind", "label": "rewind"},
+    {"type": "message", "label": "tool", "prompt": "Actually, how did I sleep last night?"},
+    {"type": "message", "label": "chat", "prompt": "Thanks! I'd like to walk more. Any suggestions?"},
+]
+
+# Metrics compared against the baseline report, and whether higher values are better
+COMPARED_METRICS = [
+    ("turn_latency.p50", False),
+    ("turn_latency.p95", False),
+    ("turn_latency.p99", False),
+    ("time_to_first_frame.p95", False),
+    ("connect_latency.p95", False),
+    ("throughput", True),
+    ("errors", False),
+    ("server.event_loop_lag.p99", False),
+]
+
+
+class ClientLagMonitor:
+    # Lag of the load generator's own event loop; high values mean the generator is the bottleneck
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.samples = []
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(loop.time() - start - self.interval, 0.0))
+
+
+class RunResults:
+    def __init__(self):
+        self.turns = []  # (label, latency, time to first frame)
+        self.connects = []
+        self.errors = []
+
+
+async def receive_until(websocket, frame_types: set, timeout: float) -> tuple:
+    # Receive frames until one of `frame_types` arrives. Returns the time to the first frame
+    # that is not a loading indicator, and the number of frames received.
+    start = time.perf_counter()
+    first_frame, frames = None, 0
+    while True:
+        frame = json.loads(await asyncio.wait_for(websocket.recv(), timeout))
+        frames += 1
+        if first_frame is None and frame.get("type") != "loading":
+            first_frame = time.perf_counter() - start
+        if frame.get("type") in frame_types:
+            return first_frame, frames
+
+
+async def drain(websocket, quiet: float = 0.2):
+    # Discard the frames of a resumed conversation
+    try:
+        while True:
+            await asyncio.wait_for(websocket.recv(), quiet)
+    except asyncio.TimeoutError:
+        pass
+
+
+async def run_client(index: int, user_id: str, args, script: list, results: RunResults):
+    await asyncio.sleep(args.ramp_up * index / max(args.clients_in_run, 1))
+    rng = random.Random(index)
+    start = time.perf_counter()
+    try:
+        async with websockets.connect(f"{args.url}/gpt/ws/{user_id}/", max_size=None) as websocket:
+            await asyncio.wait_for(websocket.recv(), args.timeout)
+            results.connects.append(time.perf_counter() - start)
+            await drain(websocket)
+
+            for _ in range(args.repeat):
+                for step in script:
+                    await asyncio.sleep(rng.uniform(0.5, 1.5) * args.think_time)
+                    sent = time.perf_counter()
+                    if step["type"] == "rewind":
+                        await websocket.send(json.dumps({"type": "rewind"}))
+                        first_frame, _ = await receive_until(websocket, {"rewind_confirmation"}, args.timeout)
+                    else:
+                        await websocket.send(json.dumps({"type": "message", "prompt": step["prompt"], "user_id": user_id}))
+                        first_frame, _ = await receive_until(websocket, {"message"}, args.timeout)
+                    results.turns.append((step.get("label", step["type"]), time.perf_counter() - sent, first_frame))
+    except (asyncio.TimeoutError, websockets.ConnectionClosed, OSError) as e:
+        results.errors.append(f"{user_id}: {type(e).__name__} {e}")
+
+
+async def run(args, clients: int, script: list) -> dict:
+    user_ids = [f"benchmark-user-{index}" for index in range(clients)]
+    http_url = args.url.replace("ws://", "http://").replace("wss://", "https://")
+    # Generous timeout, since resetting may generate health data for every user
+    async with httpx.AsyncClient(base_url=http_url, timeout=600) as http:
+        (await http.post("/benchmark/reset", json={"user_ids": user_ids, "health_days": args.health_days,
+                                                   "health_end": args.health_end})).raise_for_status()
+
+        args.clients_in_run = clients
+        results = RunResults()
+        lag_monitor = ClientLagMonitor()
+        lag_task = asyncio.create_task(lag_monitor.run())
+        start = time.perf_counter()
+        await asyncio.gather(*[run_client(index, user_id, args, script, results) for index, user_id in enumerate(user_ids)])
+        duration = time.perf_counter() - start
+        lag_task.cancel()
+
+        server_stats = (await http.get("/benchmark/stats")).json()
+
+    labels = sorted({label for label, _, _ in results.turns})
+    return {
+        "clients": clients,
+        "duration": round(duration, 3),
+        "turns": len(results.turns),
+        "errors": len(results.errors),
+        "error_samples": results.errors[:10],
+        "throughput": round(len(results.turns) / duration, 4) if duration else 0.0,  # turns per second
+        "turn_latency": summarize([latency for _, latency, _ in results.turns]),
+        "turn_latency_by_label": {label: summarize([latency for l, latency, _ in results.turns if l == label]) for label in labels},
+        "time_to_first_frame": summarize([first_frame for _, _, first_frame in results.turns if first_frame is not None]),
+        "connect_latency": summarize(results.connects),
+        "client_event_loop_lag": summarize(lag_monitor.samples),
+        "server": server_stats,
+    }
+
+
+def metric(run: dict, path: str):
+    for key in path.split("."):
+        run = run.get(key) if isinstance(run, dict) else None
+    return run
+
+
+def print_comparison(report: dict, baseline: dict):
+    baseline_runs = {run["clients"]: run for run in baseline["runs"]}
+    for run in report["runs"]:
+        baseline_run = baseline_runs.get(run["clients"])
+        if baseline_run is None:
+            continue
+        print(f"\n{run['clients']} clients (vs. {baseline['created']})")
+        for path, higher_is_better in COMPARED_METRICS:
+            old, new = metric(baseline_run, path), metric(run, path)
+            if old is None or new is None:
+                continue
+            change = (new - old) / old * 100 if old else 0.0
+            worse = change < 0 if higher_is_better else change > 0
+            flag = "  <- regression" if worse and abs(change) >= 10 else ""
+            print(f"  {path:<28} {old:>10.4f} -> {new:>10.4f} ({change:+.1f}%){flag}")
+
+
+def spawn_server(args) -> subprocess.Popen:
+    port = args.url.rsplit(":", 1)[-1].split("/")[0]
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "benchmarks.server:app", "--port", port, "--log-level", "warning"],
+                              env=os.environ.copy(), stdout=subprocess.DEVNULL if args.quiet_server else None)
+    http_url = args.url.replace("ws://", "http://")
+    for _ in range(100):
+        try:
+            httpx.get(f"{http_url}/benchmark/stats").raise_for_status()
+            return server
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("The benchmark server did not start")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Websocket load generator and turn latency benchmark")
+    parser.add_argument("--url", default="ws://localhost:5001", help="Base URL of the backend")
+    parser.add_argument("--clients", type=int, nargs="+", default=[10], help="Concurrent clients, one run per value")
+    parser.add_argument("--repeat", type=int, default=1, help="Times each client goes through the script")
+    parser.add_argument("--script", help="JSON file with the conversation steps (default: DEFAULT_SCRIPT)")
+    parser.add_argument("--think-time", type=float, default=1.0, help="Mean pause before each step, in seconds")
+    parser.add_argument("--ramp-up", type=float, default=5.0, help="Time over which the clients connect, in seconds")
+    parser.add_argument("--timeout", type=float, default=180.0, help="Maximum time to wait for a turn, in seconds")
+    parser.add_argument("--health-days", type=int, default=90, help="Days of synthetic health data per user (0 for none)")
+    # The tool handler currently pins its date to 2024-09-16, so the data has to cover it
+    parser.add_argument("--health-end", default="2024-09-30", help="Last day of synthetic health data (YYYY-MM-DD)")
+    parser.add_argument("--spawn", action="store_true", help="Start benchmarks/server.py for the duration of the runs")
+    parser.add_argument("--quiet-server", action="store_true", help="Hide the output of the spawned server")
+    parser.add_argument("--output", help="File to write the JSON report to")
+    parser.add_argument("--compare", help="Earlier JSON report to compare against")
+    args = parser.parse_args()
+
+    script = DEFAULT_SCRIPT
+    if args.script:
+        with open(args.script, "r") as file:
+            script = json.load(file)
+
+    server = spawn_server(args) if args.spawn else None
+    try:
+        runs = []
+        for clients in args.clients:
+            print(f"Running {clients} clients...")
+            runs.append(asyncio.run(run(args, clients, script)))
+            print(json.dumps({key: runs[-1][key] for key in ["turns", "errors", "throughput", "turn_latency"]}))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    report = {
+        "created": datetime.now(tz=timezone.utc).isoformat(),
+        "config": {key: value for key, value in vars(args).items() if key not in ["output", "compare", "clients_in_run"]},
+        "script": script,
+        "runs": runs,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"Wrote {args.output}")
+    if args.compare:
+        with open(args.compare, "r") as file:
+            print_comparison(report, json.load(file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+# This file defines an in-memory stand-in for the Firestore clients, covering the calls the
+# backend makes (documents, collections, where/limit queries, ArrayUnion and ArrayRemove updates
+# and list_documents). It lets the benchmarks run without the Firestore emulator. Every operation
+# can wait for a simulated round trip, blocking for the sync client and awaiting for the async one,
+# like the real clients do.
+
+import copy
+import time
+import asyncio
+from collections import defaultdict
+from google.cloud.firestore_v1 import ArrayUnion, ArrayRemove, DELETE_FIELD
+
+OPERATORS = {
+    "==": lambda value, target: value == target,
+    "!=": lambda value, target: value != target,
+    "<": lambda value, target: value is not None and value < target,
+    "<=": lambda value, target: value is not None and value <= target,
+    ">": lambda value, target: value is not None and value > target,
+    ">=": lambda value, target: value is not None and value >= target,
+    "in": lambda value, target: value in target,
+    "not-in": lambda value, target: value not in target,
+    "array_contains": lambda value, target: isinstance(value, list) and target in value,
+    "array_contains_any": lambda value, target: isinstance(value, list) and any(t in value for t in target),
+}
+
+
+class MemoryStore:
+    """
+    The documents of an in-memory Firestore database
+    - latency: the simulated round trip of every read or write (float, seconds)
+    """
+    def __init__(self, latency: float = 0.0):
+        self.collections = defaultdict(dict)  # collection path -> document ID -> data
+        self.parents = defaultdict(set)  # collection path -> IDs of documents that have subcollections
+        self.latency = latency
+        self.reads = 0
+        self.writes = 0
+
+    def get(self, path: str) -> dict:
+        collection_path, document_id = path.rsplit("/", 1)
+        return self.collections.get(collection_path, {}).get(document_id)
+
+    def put(self, path: str, data: dict):
+        collection_path, document_id = path.rsplit("/", 1)
+        self.collections[collection_path][document_id] = data
+        # Register the ancestors so that list_documents also returns documents that only have subcollections
+        segments = collection_path.split("/")
+        for end in range(2, len(segments), 2):
+            self.parents["/".join(segments[:end - 1])].add(segments[end - 1])
+
+    def delete(self, path: str):
+        collection_path, document_id = path.rsplit("/", 1)
+        self.collections[collection_path].pop(document_id, None)
+
+    def child_ids(self, collection_path: str) -> list:
+        # IDs of the documents in a collection, including documents that only have subcollections
+        return sorted(set(self.collections.get(collection_path, {})) | self.parents.get(collection_path, set()))
+
+    def stats(self) -> dict:
+        documents = sum(len(documents) for documents in self.collections.values())
+        return {"documents": documents, "reads": self.reads, "writes": self.writes}
+
+
+def apply_transforms(data: dict, updates: dict, merge: bool = False) -> dict:
+    # With `merge`, nested maps are merged into the existing ones like `set(..., merge=True)` does
+    for field, value in updates.items():
+        if isinstance(value, ArrayUnion):
+            existing = data.get(field) or []
+            data[field] = existing + [item for item in copy.deepcopy(value.values) if item not in existing]
+        elif isinstance(value, ArrayRemove):
+            data[field] = [item for item in data.get(field) or [] if item not in value.values]
+        elif value is DELETE_FIELD:
+            data.pop(field, None)
+        elif merge and isinstance(value, dict) and isinstance(data.get(field), dict):
+            data[field] = apply_transforms(dict(data[field]), value, merge)
+        else:
+            data[field] = copy.deepcopy(value)
+    return data
+
+
+class DocumentSnapshot:
+    def __init__(self, reference, data: dict):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self) -> dict:
+        return copy.deepcopy(self._data)
+
+    def get(self, field: str):
+        return (self._data or {}).get(field)
+
+
+class DocumentReference:
+    def __init__(self, store: MemoryStore, path: str):
+        self.store = store
+        self.path = path
+        self.id = path.split("/")[-1]
+
+    def collection(self, collection_id: str):
+        return type(self).collection_type(self.store, f"{self.path}/{collection_id}")
+
+    def _get(self) -> DocumentSnapshot:
+        self.store.reads += 1
+        return DocumentSnapshot(self, self.store.get(self.path))
+
+    def _set(self, data: dict, merge: bool = False):
+        self.store.writes += 1
+        base = (self.store.get(self.path) or {}) if merge else {}
+        self.store.put(self.path, apply_transforms(dict(base), data, merge))
+
+    def _update(self, data: dict):
+        if self.store.get(self.path) is None:
+            raise ValueError(f"No document to update: {self.path}")
+        self.store.writes += 1
+        # Dotted field paths (e.g., "jobs.summarize_1a2b") replace a field of a nested map
+        document = copy.deepcopy(self.store.get(self.path))
+        for field, value in data.items():
+            *parents, name = field.split(".")
+            target = document
+            for parent in parents:
+                if not isinstance(target.get(parent), dict):
+                    target[parent] = {}
+                target = target[parent]
+            apply_transforms(target, {name: value})
+        self.store.put(self.path, document)
+
+    def _delete(self):
+        self.store.writes += 1
+        self.store.delete(self.path)
+
+    def get(self) -> DocumentSnapshot:
+        time.sleep(self.store.latency)
+        return self._get()
+
+    def set(self, data: dict, merge: bool = False):
+        time.sleep(self.store.latency)
+        self._set(data, merge)
+
+    def update(self, data: dict):
+        time.sleep(self.store.latency)
+        self._update(data)
+
+    def delete(self):
+        time.sleep(self.store.latency)
+        self._delete()
+
+
+class Query:
+    def __init__(self, store: MemoryStore, path: str, filters: tuple = (), limit_to: int = None):
+        self.store = store
+        self.path = path
+        self.filters = filters
+        self.limit_to = limit_to
+
+    def where(self, field_path: str = None, op_string: str = None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return type(self)(self.store, self.path, self.filters + ((field_path, OPERATORS[op_string], value),), self.limit_to)
+
+    def limit(self, count: int):
+        return type(self)(self.store, self.path, self.filters, count)
+
+    def _snapshots(self) -> list:
+        snapshots = []
+        for document_id, data in sorted(self.store.collections.get(self.path, {}).items()):
+            if not all(operator(data.get(field), value) for field, operator, value in self.filters):
+                continue
+            self.store.reads += 1
+            snapshots.append(DocumentSnapshot(self.document_type(self.store, f"{self.path}/{document_id}"), data))
+            if self.limit_to is not None and len(snapshots) == self.limit_to:
+                break
+        return snapshots
+
+    def get(self) -> list:
+        time.sleep(self.store.latency)
+        return self._snapshots()
+
+    def stream(self):
+        yield from self.get()
+
+
+class CollectionReference(Query):
+    def __init__(self, store: MemoryStore, path: str, filters: tuple = (), limit_to: int = None):
+        super().__init__(store, path, filters, limit_to)
+        self.id = path.split("/")[-1]
+
+    def document(self, document_id: str):
+        return self.document_type(self.store, f"{self.path}/{document_id}")
+
+    def list_documents(self):
+        time.sleep(self.store.latency)
+        return [self.document(document_id) for document_id in self.store.child_ids(self.path)]
+
+
+class AsyncDocumentReference(DocumentReference):
+    async def get(self) -> DocumentSnapshot:
+        await asyncio.sleep(self.store.latency)
+        return self._get()
+
+    async def set(self, data: dict, merge: bool = False):
+        await asyncio.sleep(self.store.latency)
+        self._set(data, merge)
+
+    async def update(self, data: dict):
+        await asyncio.sleep(self.store.latency)
+        self._update(data)
+
+    async def delete(self):
+        await asyncio.sleep(self.store.latency)
+        self._delete()
+
+
+class AsyncQuery(Query):
+    async def get(self) -> list:
+        await asyncio.sleep(self.store.latency)
+        return self._snapshots()
+
+    async def stream(self):
+        for snapshot in await self.get():
+            yield snapshot
+
+
+class AsyncCollectionReference(AsyncQuery, CollectionReference):
+    async def list_documents(self):
+        await asyncio.sleep(self.store.latency)
+        for document_id in self.store.child_ids(self.path):
+            yield self.document(document_id)
+
+
+DocumentReference.collection_type = CollectionReference
+Query.document_type = DocumentReference
+AsyncDocumentReference.collection_type = AsyncCollectionReference
+AsyncQuery.document_type = AsyncDocumentReference
+AsyncCollectionReference.document_type = AsyncDocumentReference
+
+
+class WriteBatch:
+    # Writes all documents at once, with a single simulated round trip
+    def __init__(self, store: MemoryStore):
+        self.store = store
+        self.writes = []
+
+    def set(self, reference: DocumentReference, data: dict, merge: bool = False):
+        self.writes.append((reference, data, merge))
+
+    def commit(self):
+        time.sleep(self.store.latency)
+        for reference, data, merge in self.writes:
+            reference._set(data, merge)
+        self.writes = []
+
+
+class MemoryClient:
+    # Stands in for firestore.Client
+    def __init__(self, store: MemoryStore):
+        self.store = store
+
+    def batch(self) -> WriteBatch:
+        return WriteBatch(self.store)
+
+    def collection(self, path: str) -> CollectionReference:
+        return CollectionReference(self.store, path)
+
+    def document(self, path: str) -> DocumentReference:
+        return DocumentReference(self.store, path)
+
+
+class AsyncMemoryClient(MemoryClient):
+    # Stands in for firestore_async.AsyncClient
+    def collection(self, path: str) -> AsyncCollectionReference:
+        return AsyncCollectionReference(self.store, path)
+
+    def document(self, path: str) -> AsyncDocumentReference:
+        return AsyncDocumentReference(self.store, path)
+
+
+def install(firebase_manager, store: MemoryStore):
+    """
+    Point the FirebaseManager singleton at an in-memory store instead of Firestore
+    - firebase_manager: the FirebaseManager instance (FirebaseManager)
+    - store: the in-memory database (MemoryStore)
+    """
+    firebase_manager.db = MemoryClient(store)
+    firebase_manager.async_db = AsyncMemoryClient(store)
+    print(f"Using the in-memory Firestore stand-in ({store.latency * 1000:.0f}ms simulated latency)")
@@ -0,0 +1,89 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+"""
+The backend app set up for benchmarking: LLM requests are answered by the fake backend (or replayed,
+see gpt/llm_backend.py), Firestore is the in-memory stand-in or the emulator, and two extra endpoints
+reset the benchmark users and report server-side measurements (event loop lag, LLM stages, caches).
+
+Run from the backend directory (benchmarks/load_test.py can also start it with --spawn):
+    uvicorn benchmarks.server:app --port 5001
+
+Settings (environment variables):
+- BENCHMARK_FIRESTORE: "memory" (default) or "emulator"
+- BENCHMARK_FIRESTORE_LATENCY: simulated Firestore round trip of the in-memory stand-in, in seconds
+- LLM_BACKEND and LLM_SYNTHETIC_LATENCY: default to "fake" and "lognormal:0.8:0.5"
+"""
+
+import os
+from datetime import date, timedelta
+from fastapi import Body
+
+# Read by gpt/llm_backend.py on import, so they have to be set before the app is imported
+os.environ.setdefault("LLM_BACKEND", "fake")
+os.environ.setdefault("LLM_SYNTHETIC_LATENCY", "lognormal:0.8:0.5")
+
+from firebase import FirebaseManager
+from benchmarks.memory_firestore import MemoryStore, install
+from benchmarks.healthkit import seed_user
+from benchmarks.stats import summarize
+from gpt.metrics import LLMMetrics
+from gpt.scheduler import LLMScheduler
+from gpt.tool_cache import ToolResultCache
+from monitoring import EventLoopLagMonitor
+import main
+
+FIRESTORE = os.getenv("BENCHMARK_FIRESTORE", "memory")
+FIRESTORE_LATENCY = float(os.getenv("BENCHMARK_FIRESTORE_LATENCY", "0.005"))
+# Data sources generated for the benchmark users, see benchmarks/healthkit.py
+HEALTH_SOURCES = ["health.stepcount", "health.activeenergyburned", "health.restingheartrate", "health.workout"]
+
+firebase_manager = FirebaseManager()
+store = None
+if FIRESTORE == "memory":
+    # Installed before startup, so main.on_startup keeps the stand-in
+    store = MemoryStore(latency=FIRESTORE_LATENCY)
+    install(firebase_manager, store)
+
+
+lag_monitor = EventLoopLagMonitor()
+app = main.app
+
+
+@app.post("/benchmark/reset")
+async def reset(user_ids: list[str] = Body(..., embed=True), health_days: int = Body(0, embed=True),
+                health_end: date = Body(None, embed=True)):
+    # Create the benchmark users without any sessions, optionally with synthetic health data for the
+    # `health_days` days up to `health_end`, and reset the server-side measurements
+    users = firebase_manager.get_users_col()
+    for user_id in user_ids:
+        users.document(user_id).set({"benchmark": True}, merge=True)
+        for session in users.document(user_id).collection("gpt-messages").stream():
+            session.reference.delete()
+        if health_days and not users.document(user_id).collection("health").document("stepcount").collection("raw").limit(1).get():
+            seed_user(firebase_manager.db, user_id, HEALTH_SOURCES, health_end - timedelta(days=health_days - 1), health_days)
+
+    LLMMetrics().stages.clear()
+    scheduler = LLMScheduler()
+    scheduler.retries = scheduler.deadlines_exceeded = 0
+    tool_result_cache = ToolResultCache()
+    tool_result_cache.entries.clear()
+    tool_result_cache.hits = tool_result_cache.misses = tool_result_cache.cross_session_hits = 0
+    tool_result_cache.prefetches = tool_result_cache.prefetch_hits = 0
+    tool_result_cache.warmed.clear()
+    lag_monitor.samples.clear()
+    return {"users": len(user_ids)}
+
+
+@app.get("/benchmark/stats")
+async def stats():
+    return {
+        "firestore": FIRESTORE,
+        "llm_backend": os.environ["LLM_BACKEND"],
+        "event_loop_lag": summarize(list(lag_monitor.samples)),
+        "llm": LLMMetrics().summary(),
+        "scheduler": LLMScheduler().stats(),
+        "tool_cache": ToolResultCache().stats(),
+        "firestore_operations": store.stats() if store else None,
+    }
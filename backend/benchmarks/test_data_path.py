@@ -0,0 +1,124 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Microbenchmarks of the data path (fetch_raw_data -> data_to_df -> aggregate -> DataPoint.__str__) on
+synthetic HealthKit data (benchmarks/healthkit.py), for a dense (minute-level heart rate), a medium
+(step count from two devices) and a sparse (workouts) data source, over 1 day, 1 week, 3 months
+and 1 year, at all granularities.
+
+Run from the backend directory (requires pytest-benchmark):
+    pytest benchmarks/test_data_path.py --benchmark-json=data_path.json
+    pytest benchmarks/test_data_path.py --benchmark-compare --benchmark-group-by=func
+"""
+
+import asyncio
+from datetime import date, timedelta
+from functools import lru_cache
+import pandas as pd
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from firebase import FirebaseManager
+from benchmarks.healthkit import generate_source, seed_user
+from benchmarks.memory_firestore import MemoryStore, install
+from data.aggregate import aggregate
+from data.fetch import fetch_raw_data
+from data.granularity import Granularity, adjust_date_and_granularity, count_buckets
+from data.utils import data_to_df
+
+SOURCES = ["health.heartrate", "health.stepcount", "health.workout"]
+SPANS = {"1day": 1, "1week": 7, "3months": 91, "1year": 365}
+END = date(2024, 9, 30)  # last day of data
+ROUNDS = 5
+# Larger cases are skipped: the generated documents would need several GB of memory, and the
+# describe tool coarsens requests with this many buckets anyway (see plan_granularity)
+MAX_SAMPLES = 150_000
+MAX_BUCKETS = 3_000
+
+
+def time_range(days: int) -> tuple[pd.Timestamp, pd.Timestamp]:
+    end = pd.Timestamp(END) + pd.Timedelta(days=1)
+    return end - pd.Timedelta(days=days), end
+
+
+def skip_unsupported(start: pd.Timestamp, end: pd.Timestamp, granularity: str):
+    if adjust_date_and_granularity(str(start), str(end), granularity)[2] != granularity:
+        pytest.skip("coarser than the range, fetch_aggregated_data would use a finer granularity")
+    if count_buckets(start, end, Granularity(granularity)) > MAX_BUCKETS:
+        pytest.skip(f"more than {MAX_BUCKETS} buckets")
+
+
+@lru_cache(maxsize=None)
+def documents(data_source: str, days: int) -> list[dict]:
+    generated = list(generate_source(data_source, END - timedelta(days=days - 1), days).values())
+    if len(generated) > MAX_SAMPLES:
+        pytest.skip(f"{len(generated)} samples")
+    return generated
+
+
+@lru_cache(maxsize=None)
+def dataframe(data_source: str, days: int) -> pd.DataFrame:
+    return data_to_df(documents(data_source, days))
+
+
+@pytest.fixture(scope="module")
+def firestore():
+    # Fresh in-memory Firestore (without simulated latency) with one user per data source and span
+    store = MemoryStore()
+    firebase_manager = FirebaseManager()
+    previous = firebase_manager.db, firebase_manager.async_db
+    install(firebase_manager, store)
+    seeded = set()
+
+    def seed(data_source: str, days: int) -> str:
+        user_id = f"benchmark-{data_source.split('.')[1]}-{days}"
+        if user_id not in seeded:
+            documents(data_source, days)  # skips oversized cases before writing anything
+            seed_user(firebase_manager.db, user_id, [data_source], END - timedelta(days=days - 1), days)
+            seeded.add(user_id)
+        return user_id
+
+    yield seed
+    firebase_manager.db, firebase_manager.async_db = previous
+
+
+@pytest.mark.parametrize("span", SPANS)
+@pytest.mark.parametrize("data_source", SOURCES)
+def test_fetch_raw_data(benchmark, firestore, data_source, span):
+    user_id = firestore(data_source, SPANS[span])
+    start, end = time_range(SPANS[span])
+    # Bypass the cache to measure the queries and the document conversion
+    fetch = fetch_raw_data.__wrapped__
+    benchmark.pedantic(lambda: asyncio.run(fetch(user_id, data_source, start.to_pydatetime(), end.to_pydatetime())), rounds=ROUNDS)
+
+
+@pytest.mark.parametrize("span", SPANS)
+@pytest.mark.parametrize("data_source", SOURCES)
+def test_data_to_df(benchmark, data_source, span):
+    data = documents(data_source, SPANS[span])
+    df = benchmark.pedantic(data_to_df, args=(data,), rounds=ROUNDS)
+    assert len(df) == len(data)
+
+
+@pytest.mark.parametrize("granularity", Granularity.ORDER)
+@pytest.mark.parametrize("span", SPANS)
+@pytest.mark.parametrize("data_source", SOURCES)
+def test_aggregate(benchmark, data_source, span, granularity):
+    start, end = time_range(SPANS[span])
+    skip_unsupported(start, end, granularity)
+    df = dataframe(data_source, SPANS[span])
+    benchmark.pedantic(aggregate, args=(df, data_source, start, end, Granularity(granularity)), rounds=ROUNDS)
+
+
+@pytest.mark.parametrize("granularity", Granularity.ORDER)
+@pytest.mark.parametrize("span", SPANS)
+@pytest.mark.parametrize("data_source", SOURCES)
+def test_describe(benchmark, data_source, span, granularity):
+    start, end = time_range(SPANS[span])
+    skip_unsupported(start, end, granularity)
+    data_points = aggregate(dataframe(data_source, SPANS[span]), data_source, start, end, Granularity(granularity))
+    lines = benchmark.pedantic(lambda: [str(data_point) for data_point in data_points], rounds=ROUNDS)
+    assert len(lines) == len(data_points)
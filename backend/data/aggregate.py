@@ -7,29 +7,23 @@ from datetime import datetime
 
 from data.data_point import DataPoint, WorkoutData
 from data.data_sources import DATA_SOURCES
+from data.granularity import PANDAS_FREQUENCIES
 from data.utils import filter_by_device
+from logs import get_logger
+logger = get_logger("data")
     
 def aggregate(df, data_source, start, end, granularity, include_empty_buckets=False) -> list[DataPoint]:
-    print(f"Aggregating data for {data_source} from {start} to {end} with granularity {granularity}")
+    logger.debug("Aggregating data", data_source=data_source, start=start, end=end, granularity=granularity)
     # get all time buckets for the given granularity
-    if granularity == "15min":
-        freq = "15min"
-    elif granularity == "hour":
-        freq = "H"
-    elif granularity == "day":
-        freq = "D"
-    elif granularity == "week":
-        freq = "W-SUN"
-    elif granularity == "month":
-        freq = "M"
-    else:
+    freq = PANDAS_FREQUENCIES.get(getattr(granularity, "value", granularity))
+    if freq is None:
         raise ValueError(f"Unsupported granularity: {granularity}")
 
     # Create time buckets
     time_buckets = pd.date_range(start=start, end=end, freq=freq)
     if granularity == "month":
         time_buckets = time_buckets + pd.Timedelta(days=1)
-    if time_buckets[0] != start:  # Ensure the first bucket starts at the start time
+    if len(time_buckets) == 0 or time_buckets[0] != start:  # Ensure the first bucket starts at the start time
         time_buckets = time_buckets.union([start])
     if time_buckets[-1] != end:  # Ensure the last bucket goes up to the end time
         time_buckets = time_buckets.union([end])
@@ -0,0 +1,139 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+# This file defines a compact description of aggregated data for results that are too long to send
+# to GPT bucket by bucket. All statistics are computed locally from the DataPoint list, so no numbers
+# pass through an extra summarization call.
+
+import numpy as np
+import pandas as pd
+
+from data.data_point import DataPoint
+
+# Maximum length of a function call result sent to GPT
+DEFAULT_MAX_CHARS = 1500
+
+# Number of highest/lowest buckets and missing-data spans listed, tried from most to least detailed
+DETAIL_LEVELS = [(5, 5), (3, 3), (2, 2), (1, 1), (0, 0)]
+
+
+def total(data_point: DataPoint) -> float:
+    # Sum of all entries, including entries grouped by day
+    if data_point.is_daily_count:
+        return float(sum(np.sum(d) for d in data_point.data))
+    return float(np.sum(data_point.data))
+
+
+def missing_spans(data_points: list[DataPoint], start: pd.Timestamp, end: pd.Timestamp) -> list[tuple]:
+    # Time ranges without data: empty buckets and gaps between consecutive buckets
+    spans = []
+    cursor = pd.Timestamp(start)
+    for data_point in data_points:
+        if len(data_point) == 0:
+            continue
+        bucket_start = pd.Timestamp(data_point.start)
+        if bucket_start > cursor:
+            spans.append((cursor, bucket_start - pd.Timedelta(seconds=1)))
+        cursor = max(cursor, pd.Timestamp(data_point.end) + pd.Timedelta(seconds=1))
+    if cursor < pd.Timestamp(end):
+        spans.append((cursor, pd.Timestamp(end) - pd.Timedelta(seconds=1)))
+    return spans
+
+
+def format_span(span: tuple) -> str:
+    span_start, span_end = span
+    if span_start.date() == span_end.date():
+        return span_start.strftime('%a, %Y-%m-%d')
+    return f"{span_start.strftime('%a, %Y-%m-%d')} to {span_end.strftime('%a, %Y-%m-%d')}"
+
+
+def numeric_digest(data_points: list[DataPoint], granularity: str, n_extremes: int) -> list[str]:
+    units = data_points[0].units
+    values = np.array([data_point.value for data_point in data_points], dtype=float)
+    lines = [f"Per {granularity}: mean {values.mean():.2f}±{values.std():.2f} {units}, "
+             f"minimum {values.min():.2f} {units}, maximum {values.max():.2f} {units}"]
+    if data_points[0].type == "count":
+        lines.append(f"Total over the period: {sum(total(data_point) for data_point in data_points):.2f} {units}")
+
+    if len(values) >= 4:
+        slope = np.polyfit(np.arange(len(values)), values, 1)[0]
+        half = len(values) // 2
+        first_half, second_half = values[:half].mean(), values[half:].mean()
+        direction = "increasing" if slope > 0 else "decreasing" if slope < 0 else "flat"
+        lines.append(f"Trend: {direction} by about {abs(slope):.2f} {units} per {granularity} "
+                     f"(first half mean {first_half:.2f}, second half mean {second_half:.2f})")
+
+    if n_extremes and len(data_points) > 2 * n_extremes:
+        order = np.argsort(values, kind="stable")
+        lines.append(f"Highest {n_extremes} buckets:")
+        lines += [f" - {data_points[i]}" for i in order[::-1][:n_extremes]]
+        lines.append(f"Lowest {n_extremes} buckets:")
+        lines += [f" - {data_points[i]}" for i in order[:n_extremes]]
+    elif n_extremes:
+        lines.append("Buckets:")
+        lines += [f" - {data_point}" for data_point in data_points]
+    return lines
+
+
+def workout_digest(data_points: list[DataPoint], n_extremes: int) -> list[str]:
+    workouts = [workout for data_point in data_points for workout in data_point.data]
+    lines = [f"{len(workouts)} workouts in {len(data_points)} buckets"]
+    durations = {}
+    for workout in workouts:
+        durations.setdefault(workout.type, []).append(workout.duration)
+    for workout_type, type_durations in sorted(durations.items(), key=lambda item: -len(item[1])):
+        lines.append(f" - {workout_type}: {len(type_durations)} workouts, {np.mean(type_durations) / 60:.2f} mins/workout, "
+                     f"{np.sum(type_durations) / 60:.2f} mins total")
+
+    if n_extremes:
+        busiest = sorted(data_points, key=lambda data_point: -len(data_point))[:n_extremes]
+        lines.append("Buckets with the most workouts:")
+        lines += [f" - {data_point.start.strftime('%a, %Y-%m-%d')}: {len(data_point)} workouts" for data_point in busiest]
+    return lines
+
+
+def compact_description(data_source: str,
+                        start: pd.Timestamp,
+                        end: pd.Timestamp,
+                        granularity: str,
+                        data_points: list[DataPoint],
+                        max_chars: int = DEFAULT_MAX_CHARS) -> str:
+    """
+    Describe aggregated data with summary statistics instead of one line per bucket
+    - data_source: the name of the data source (str), e.g., "health.stepcount"
+    - start: the start of the time range (pd.Timestamp)
+    - end: the end of the time range (pd.Timestamp), exclusive
+    - granularity: the granularity of the buckets (str)
+    - data_points: the aggregated data, as returned by `aggregate` (list of DataPoint objects)
+    - max_chars: the maximum length of the description (int)
+
+    Returns: a description with the overall statistics, the trend, the highest and lowest buckets and the
+    time ranges without data. Fewer buckets and ranges are listed until the description fits into `max_chars`.
+    """
+    granularity = getattr(granularity, "value", granularity)
+    with_data = [data_point for data_point in data_points if len(data_point) > 0]
+    spans = missing_spans(data_points, start, end)
+    header = (f"Here is a summary of the data for {data_source} from {start} to {end} at a granularity of {granularity} "
+              f"({len(with_data)} buckets with data). These numbers are computed from the data and should be reported exactly:")
+
+    description = header
+    for n_extremes, n_spans in DETAIL_LEVELS:
+        lines = [header]
+        if not with_data:
+            lines.append("No data in this time range.")
+        elif with_data[0].type == "workout":
+            lines += workout_digest(with_data, n_extremes)
+        else:
+            lines += numeric_digest(with_data, granularity, n_extremes)
+
+        if spans:
+            lines.append(f"No data in {len(spans)} time ranges" + (":" if n_spans else ""))
+            lines += [f" - {format_span(span)}" for span in spans[:n_spans]]
+            if 0 < n_spans < len(spans):
+                lines.append(f" - ... and {len(spans) - n_spans} more")
+
+        description = "\n".join(lines) + "\n"
+        if len(description) <= max_chars:
+            return description
+    return description[:max_chars]
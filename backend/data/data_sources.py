@@ -2,7 +2,7 @@
 #
 # SPDX-License-Identifier: MIT
 
-from functools import lru_cache
+from async_lru import alru_cache
 from firebase import FirebaseManager
 firebase_manager = FirebaseManager()
 
@@ -37,12 +37,18 @@ DATA_SOURCES = {
     "health.workout": DataSource("health.workout", "min", "workout", "Workouts can be logged manually or automatically by your phone or watch. Each workout is logged with a start and end time, type of workout, and duration. Workouts can be used to track physical activity and exercise habits."),
 }
 
-@lru_cache(maxsize=128)
-def get_user_data_sources(user_id: str) -> list[str]:
-    user_doc = firebase_manager.get_user_doc(user_id)
-    sources = ["health." + doc.id for doc in user_doc.collection("health").list_documents()]
+# Seconds before a user's data sources are listed again, e.g., to pick up newly uploaded data types
+DATA_SOURCES_TTL = 600
+
+@alru_cache(maxsize=128, ttl=DATA_SOURCES_TTL)
+async def get_user_data_sources(user_id: str) -> list[str]:
+    # Uses the async client so that listing the collection does not block the event loop
+    health_col = firebase_manager.get_users_col(async_ref=True).document(user_id).collection("health")
+    sources = ["health." + doc.id async for doc in health_col.list_documents()]
     
     # TODO: add support for sleep 
-    if "sleepanalysis" in sources:
+    # Sleep has no entry in DATA_SOURCES and is not queried by data/fetch.py, so it is not offered to the tools.
+    # (The check used to compare the unprefixed name and never matched, so users with sleep data were offered it.)
+    if "health.sleepanalysis" in sources:
         sources.remove("health.sleepanalysis")
-    return sources
\ No newline at end of file
+    return sources
@@ -5,26 +5,36 @@
 from typing import Literal
 from async_lru import alru_cache
 from datetime import datetime, timedelta
-import time
+import numpy as np
+import pandas as pd
 from google.cloud.firestore_v1.base_query import FieldFilter
 # from utils import *
 
 from data.aggregate import aggregate
+from data.compact import compact_description
 from data.data_point import DataPoint
 from data.data_sources import get_user_data_sources
-from data.granularity import adjust_date_and_granularity, Granularity
+from data.granularity import adjust_date_and_granularity, plan_granularity, count_buckets, Granularity
 from data.utils import *
 
 from firebase import FirebaseManager
+from tracing import Tracer
+from logs import get_logger
+logger = get_logger("data")
 firebase_manager = FirebaseManager()
 
-@alru_cache(maxsize=128)
+# Seconds before cached data is fetched again, so that ranges including today pick up new uploads
+LIVE_DATA_TTL = 300
+
+@alru_cache(maxsize=128, ttl=LIVE_DATA_TTL)
 async def fetch_aggregated_data(user_id: str, 
                                 data_source: str, 
                                 start: str, 
                                 end: str, 
                                 granularity: Literal["15min", "hour", "day", "week", "month"],
-                                include_empty_buckets: bool = False) -> tuple[list[DataPoint], str]:
+                                include_empty_buckets: bool = False,
+                                max_chars: int = None,
+                                max_rows: int = None) -> tuple[list[DataPoint], str]:
     """
     Fetch aggregated data for a given user, data source, and time range
     - user_id: the user's Firebase ID (str)
@@ -32,41 +42,87 @@ async def fetch_aggregated_data(user_id: str,
     - start: the start of the time range in a YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS format (str). If no time is specified, the function interprets the start date as the beginning of the day.
     - end: the start of the time range in a YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS format (str). The end is exclusive, i.e., data is fetched up to but not including this date/datetime.
     - granularity: the granularity of the time buckets to aggregate the data into (str: "15min", "hour", "day", "week", "monthStart"). For example, if the granularity is 'hour', the function will return the data aggregated into hourly buckets. If the granularity is 'week', the function will return the data aggregated into weekly buckets. Note that a week is defined as starting on Sunday and ending on Saturday.
+    - include_empty_buckets: whether to include buckets without data in the aggregated data (bool)
+    - max_chars: the maximum length of the description string (int, optional). If the bucket-by-bucket description is longer, a compact summary (see data/compact.py) is returned instead.
+    - max_rows: the maximum number of rows in the description string (int, optional). If the requested granularity produces more buckets, the data is aggregated at a coarser granularity and the most notable buckets are broken down at the requested granularity, as far as the remaining rows allow.
 
     Returns: a tuple containing the aggregated data (list of DataPoint objects) and a description string
     """
-    print(f"Calling fetch_aggregated_data with args: user_id={user_id}, data_source={data_source}, start={start}, end={end}, granularity={granularity}")
+    logger.info("Calling fetch_aggregated_data", user_id=user_id, data_source=data_source, start=start, end=end, granularity=granularity)
 
-    user_data_sources = get_user_data_sources(user_id)
+    user_data_sources = await get_user_data_sources(user_id)
     if data_source not in user_data_sources:
         raise ValueError(f"Data source '{data_source}' not found for user '{user_id}'")
     
     start, end, granularity = adjust_date_and_granularity(start, end, granularity)
     assert start < end, f"Invalid date range: {start} to {end}. Start date must be before end date."
-
-    
-    time1 = time.time()
-    data = await fetch_raw_data(user_id, data_source, start, end)
-    time2 = time.time()
+    requested_granularity = granularity
+    if max_rows:
+        granularity = plan_granularity(start, end, granularity, max_rows)
+
+    tracer = Tracer()
+    with tracer.span("data.fetch_raw_data", data_source=data_source) as span:
+        data = await fetch_raw_data(user_id, data_source, start, end)
+        span.set(documents=len(data))
     if len(data) == 0:
         raise ValueError(f"No data found for {data_source} for user {user_id} from {start} to {end}")
-    df = data_to_df(data)
-    time3 = time.time()
-    aggregated_data = aggregate(df, data_source, start, end, granularity, include_empty_buckets)
-    time4 = time.time()
-
-    # fix times to only show seconds
-    print("Time taken to fetch raw data:", time2 - time1)
-    print("Time taken to convert data to df:", time3 - time2)
-    print("Time taken to aggregate data:", time4 - time3)
-
-    description_string = f"Here is a summary of the data for {data_source} from {start} to {end} at a granularity of {granularity}:\n"
-    for data_point in aggregated_data:
-        description_string += str(data_point) + "\n"
+    with tracer.span("data.data_to_df", rows=len(data)):
+        df = data_to_df(data)
+    with tracer.span("data.aggregate", granularity=str(granularity)) as span:
+        aggregated_data = aggregate(df, data_source, start, end, granularity, include_empty_buckets)
+        span.set(buckets=len(aggregated_data))
+
+    with tracer.span("data.describe") as span:
+        lines = [f"Here is a summary of the data for {data_source} from {start} to {end} at a granularity of {granularity}:"]
+        if granularity != requested_granularity:
+            lines[0] = lines[0][:-1] + f" (instead of {requested_granularity}, which would have been too many rows):"
+        lines += [str(data_point) for data_point in aggregated_data]
+        if granularity != requested_granularity:
+            lines += drill_down(df, data_source, aggregated_data, granularity, requested_granularity, max_rows - len(aggregated_data))
+        description_string = "\n".join(lines) + "\n"
+        if max_chars and len(description_string) > max_chars:
+            description_string = compact_description(data_source, start, end, granularity, aggregated_data, max_chars)
+        span.set(chars=len(description_string))
 
     return aggregated_data, description_string
 
-@alru_cache(maxsize=128)
+def drill_down(df, data_source: str, data_points: list[DataPoint], granularity: Granularity, 
+               requested_granularity: Granularity, max_rows: int) -> list[str]:
+    """
+    Break down the most notable buckets (furthest from the mean, or with the most workouts) at a finer granularity
+    - df: the raw data the buckets were aggregated from (pd.DataFrame)
+    - data_source: the name of the data source (str)
+    - data_points: the buckets to break down (list of DataPoint objects)
+    - granularity: the granularity of `data_points` (Granularity)
+    - requested_granularity: the finest granularity of a breakdown (Granularity). Coarser ones are used if it does not fit.
+    - max_rows: the maximum number of rows of all breakdowns together (int)
+
+    Returns: the lines of the breakdowns (list of str)
+    """
+    with_data = [data_point for data_point in data_points if len(data_point) > 0]
+    if not with_data:
+        return []
+    if with_data[0].type == "workout":
+        notable = sorted(with_data, key=lambda data_point: -len(data_point))
+    else:
+        mean = np.mean([data_point.value for data_point in with_data])
+        notable = sorted(with_data, key=lambda data_point: -abs(data_point.value - mean))
+
+    lines = []
+    for data_point in notable:
+        bucket_start, bucket_end = pd.Timestamp(data_point.start), pd.Timestamp(data_point.end) + pd.Timedelta(seconds=1)
+        if max_rows < 3:
+            break
+        fine_granularity = plan_granularity(bucket_start, bucket_end, requested_granularity, max_rows - 1)
+        if not fine_granularity < granularity or count_buckets(bucket_start, bucket_end, fine_granularity) + 1 > max_rows:
+            continue
+        breakdown = aggregate(df, data_source, bucket_start, bucket_end, fine_granularity)
+        lines.append(f"Breakdown of {bucket_start} to {bucket_end} at a granularity of {fine_granularity}:")
+        lines += [" - " + str(fine_data_point) for fine_data_point in breakdown]
+        max_rows -= len(breakdown) + 1
+    return lines
+
+@alru_cache(maxsize=128, ttl=LIVE_DATA_TTL)
 async def fetch_raw_data(user_id: str, 
                          data_source_name: str, 
                          start: datetime, 
@@ -80,7 +136,7 @@ async def fetch_raw_data(user_id: str,
 
     Returns: a list of dictionaries, where each dictionary represents a Firestore document
     """
-    print(f"Calling fetch_raw_data with args: user_id={user_id}, data_source_name={data_source_name}, start={start}, end={end}")
+    logger.debug("Calling fetch_raw_data", user_id=user_id, data_source=data_source_name, start=start, end=end)
     module, data_source = data_source_name.split(".")
     try:
         user_doc = firebase_manager.get_user_doc(user_id, async_ref=True)
@@ -90,7 +146,7 @@ async def fetch_raw_data(user_id: str,
         if not snapshot:
             raise ValueError(f"Collection {module}.{data_source}.raw does not exist for user {user_id}")
     except Exception as e:
-        print(f"Error fetching data source collection: {e}")
+        logger.warning("Error fetching data source collection: %s", e, user_id=user_id, data_source=data_source_name)
         return []
     
     end -= timedelta(microseconds=1) # end date is exclusive
@@ -98,14 +154,14 @@ async def fetch_raw_data(user_id: str,
     # TODO: expand query for sleep data
 
     if start.year != end.year:
-        print("Case: different years")
+        logger.debug("Case: different years")
         if is_start_of_year(start) and is_end_of_year(end):
-            print("\tCase: single query")
-            print(f"\twhere: yearRange contains {list(range(start.year, end.year+1))}")
+            logger.debug("Case: single query")
+            logger.debug(f"where: yearRange contains {list(range(start.year, end.year+1))}")
             query = collection.where(filter=FieldFilter("yearRange", "array_contains_any", list(range(start.year, end.year+1))))
             return [doc.to_dict() async for doc in query.stream()]
         else:
-            print("\tCase: split queries")
+            logger.debug("Case: split queries")
             set1 = await fetch_raw_data(user_id, data_source_name, start, datetime(start.year+1, 1, 1, 0, 0))
             if start.year + 1 != end.year:
                 set2 = await fetch_raw_data(user_id, data_source_name, datetime(start.year+1, 1, 1, 0, 0), datetime(end.year, 1, 1, 0, 0))
@@ -116,15 +172,15 @@ async def fetch_raw_data(user_id: str,
             return dedupe(set1 + set2 + set3)
         
     elif start.month != end.month:
-        print("Case: different months")
+        logger.debug("Case: different months")
         if is_start_of_month(start) and is_end_of_month(end):
-            print("\tCase: single query")
-            print(f"\twhere: yearStart == {start.year} AND monthRange contains {start.month}")
+            logger.debug("Case: single query")
+            logger.debug(f"where: yearStart == {start.year} AND monthRange contains {start.month}")
             query = collection.where(filter=FieldFilter("yearStart", "==", start.year)) \
                               .where(filter=FieldFilter("monthRange", "array_contains_any", list(range(start.month, end.month+1))))
             return [doc.to_dict() async for doc in query.stream()]
         else:
-            print("\tCase: split queries")
+            logger.debug("Case: split queries")
             set1 = await fetch_raw_data(user_id, data_source_name, start, datetime(start.year, start.month+1, 1, 0, 0))
             if start.month + 1 != end.month:
                 set2 = await fetch_raw_data(user_id, data_source_name, datetime(start.year, start.month+1, 1, 0, 0), datetime(end.year, end.month, 1, 0, 0))
@@ -134,10 +190,10 @@ async def fetch_raw_data(user_id: str,
             return dedupe(set1 + set2 + set3)
         
     elif start.day != end.day:
-        print("Case: different days", is_start_of_day(start), is_end_of_day(end))
+        logger.debug("Case: different days")
         if is_start_of_day(start) and is_end_of_day(end):
-            print("\tCase: single query")
-            print(f"\twhere: yearStart == {start.year} AND monthStart == {start.month} AND dayRange contains {start.day} AND dayStart >= {start.day} AND dayStart < {end.day}")
+            logger.debug("Case: single query")
+            logger.debug(f"where: yearStart == {start.year} AND monthStart == {start.month} AND dayRange contains {start.day} AND dayStart >= {start.day} AND dayStart < {end.day}")
             
             query1 = collection.where(filter=FieldFilter("yearStart", "==", start.year)) \
                                .where(filter=FieldFilter("monthStart", "==", start.month)) \
@@ -149,7 +205,7 @@ async def fetch_raw_data(user_id: str,
 
             return [doc.to_dict() async for doc in query1.stream()] + [doc.to_dict() async for doc in query2.stream()]
         else:
-            print("\tCase: split queries")
+            logger.debug("Case: split queries")
             day_after_start = datetime(start.year, start.month, start.day, 0, 0) + timedelta(days=1)
             set1 = await fetch_raw_data(user_id, data_source_name, start, day_after_start)
             if start.day + 1 != end.day:
@@ -160,21 +216,21 @@ async def fetch_raw_data(user_id: str,
             return dedupe(set1 + set2 + set3)
         
     else:
-        print("Case: same day")
+        logger.debug("Case: same day")
         if is_start_of_day(start) and is_end_of_day(end):
-            print("\tCase: whole day")
-            print(f"\twhere: yearStart == {start.year} AND monthStart == {start.month} AND dayStart == {start.day}")
+            logger.debug("Case: whole day")
+            logger.debug(f"where: yearStart == {start.year} AND monthStart == {start.month} AND dayStart == {start.day}")
             query = collection.where(filter=FieldFilter("yearStart", "==", start.year)) \
                               .where(filter=FieldFilter("monthStart", "==", start.month)) \
                               .where(filter=FieldFilter("dayStart", "==", start.day)) 
             return [doc.to_dict() async for doc in query.stream()]
 
-        print("\tCase: intraday")
+        logger.debug("Case: intraday")
         start_15min_bucket = (start.hour * 60 + start.minute) // 15
         end_15min_bucket = (end.hour * 60 + end.minute) // 15
         if start_15min_bucket != end_15min_bucket:
-            print("\t\tCase: multiple 15min buckets")
-            print(f"\t\twhere: yearStart == {start.year} AND monthStart == {start.month} AND dayStart == {start.day} AND fifteenMinBucketStart >= {start_15min_bucket} AND fifteenMinBucketStart < {end_15min_bucket} AND fifteenMinBucketRange contains {start_15min_bucket}")
+            logger.debug("Case: multiple 15min buckets")
+            logger.debug(f"where: yearStart == {start.year} AND monthStart == {start.month} AND dayStart == {start.day} AND fifteenMinBucketStart >= {start_15min_bucket} AND fifteenMinBucketStart < {end_15min_bucket} AND fifteenMinBucketRange contains {start_15min_bucket}")
             query1 = collection.where(filter=FieldFilter("yearStart", "==", start.year)) \
                               .where(filter=FieldFilter("monthStart", "==", start.month)) \
                               .where(filter=FieldFilter("dayStart", "==", start.day)) \
@@ -187,8 +243,8 @@ async def fetch_raw_data(user_id: str,
                                .where(filter=FieldFilter("fifteenMinBucketRange", "array_contains", start_15min_bucket))
             return [doc.to_dict() async for doc in query1.stream()] + [doc.to_dict() async for doc in query2.stream()]
         else:
-            print("\t\tCase: single 15min bucket")
-            print(f"\t\twhere: yearStart == {start.year} AND monthStart == {start.month} AND dayStart == {start.day} AND fifteenMinBucket == {start_15min_bucket}")
+            logger.debug("Case: single 15min bucket")
+            logger.debug(f"where: yearStart == {start.year} AND monthStart == {start.month} AND dayStart == {start.day} AND fifteenMinBucket == {start_15min_bucket}")
             query = collection.where(filter=FieldFilter("yearStart", "==", start.year)) \
                               .where(filter=FieldFilter("monthStart", "==", start.month)) \
                               .where(filter=FieldFilter("dayStart", "==", start.day)) \
@@ -6,6 +6,9 @@ from functools import total_ordering
 from typing import Literal
 import pandas as pd
 
+from logs import get_logger
+logger = get_logger("data")
+
 @total_ordering
 class Granularity:
     ORDER = ["15min", "hour", "day", "week", "month"]
@@ -44,16 +47,49 @@ def adjust_date_and_granularity(start: str, end: str, granularity: str) -> tuple
     granularity = Granularity(granularity)
     # automatically adjust granularity if too coarse for specific start/end
     if delta.total_seconds() < 900 and granularity != "15min":
-        print(f"Adjusting granularity from {granularity} to 15min")
+        logger.debug("Adjusting granularity", requested=granularity, granularity="15min")
         granularity = Granularity("15min")
     elif delta.total_seconds() < 3600 and granularity > "hour":
-        print(f"Adjusting granularity from {granularity} to hour")
+        logger.debug("Adjusting granularity", requested=granularity, granularity="hour")
         granularity = Granularity("hour")
     elif delta.days < 1 and granularity > "day":
-        print(f"Adjusting granularity from {granularity} to day")
+        logger.debug("Adjusting granularity", requested=granularity, granularity="day")
         granularity = Granularity("day")
     elif delta.days < 7 and granularity > "week":
-        print(f"Adjusting granularity from {granularity} to week")
+        logger.debug("Adjusting granularity", requested=granularity, granularity="week")
         granularity = Granularity("week")
 
-    return start, end, granularity
\ No newline at end of file
+    return start, end, granularity
+
+# Default maximum number of buckets in a description sent to GPT. Only requests with more buckets are
+# aggregated at a coarser granularity, e.g., a month of days fits. Descriptions within the limit that are
+# longer than the description budget are summarized at the requested granularity (see data/compact.py).
+DEFAULT_MAX_ROWS = 40
+
+# pandas frequency of the time buckets of each granularity (weeks start on Sunday)
+PANDAS_FREQUENCIES = {"15min": "15min", "hour": "H", "day": "D", "week": "W-SUN", "month": "M"}
+
+def count_buckets(start: pd.Timestamp, end: pd.Timestamp, granularity: Granularity) -> int:
+    # Number of buckets `aggregate` creates for the range, including partial buckets at either end
+    boundaries = pd.date_range(start=start, end=end, freq=PANDAS_FREQUENCIES[granularity.value])
+    if granularity == "month":
+        boundaries = boundaries + pd.Timedelta(days=1)
+    return len(boundaries.union([start, end])) - 1
+
+def plan_granularity(start: pd.Timestamp, end: pd.Timestamp, granularity: Granularity, max_rows: int) -> Granularity:
+    """
+    Pick the granularity to aggregate a range into so that the result has at most `max_rows` buckets
+    - start: the start of the time range (pd.Timestamp)
+    - end: the end of the time range (pd.Timestamp)
+    - granularity: the requested granularity (Granularity)
+    - max_rows: the maximum number of buckets (int)
+
+    Returns: the requested granularity if it fits, else the finest coarser granularity that fits (or "month")
+    """
+    for value in Granularity.ORDER[Granularity.ORDER.index(granularity.value):]:
+        candidate = Granularity(value)
+        if count_buckets(start, end, candidate) <= max_rows:
+            break
+    if candidate != granularity:
+        logger.debug("Planning a coarser granularity to stay within the row limit", requested=granularity, granularity=candidate, max_rows=max_rows)
+    return candidate
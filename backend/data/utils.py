@@ -7,6 +7,8 @@ import pandas as pd
 from dateutil.relativedelta import relativedelta
 
 from data.granularity import Granularity
+from logs import get_logger
+logger = get_logger("data")
 
 def is_start_of_day(dt: datetime) -> bool:
     return dt.hour == 0 and dt.minute == 0 and dt.second == 0
@@ -90,7 +92,7 @@ def round_datetime(dt: datetime, granularity: Granularity) -> datetime:
     elif granularity == "week":
         dt = dt.replace(hour=0, minute=0, second=0, microsecond=0)
         dt = dt - timedelta(days=dt.weekday() + 1)
-        print(f"Rounded to week: {dt} (weekday: {dt.weekday()}")
+        logger.debug("Rounded to week", datetime=dt, weekday=dt.weekday())
         return dt
     elif granularity == "month":
         return dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
@@ -10,12 +10,15 @@ import pytz
 from datetime import datetime
 from async_lru import alru_cache
 
-from data.fetch import fetch_aggregated_data
+from data.fetch import fetch_aggregated_data, LIVE_DATA_TTL
+from data.compact import DEFAULT_MAX_CHARS
 from data.data_sources import DATA_SOURCES
 from data.granularity import Granularity
 from data.utils import *
+from logs import get_logger
+logger = get_logger("data")
 
-@alru_cache(maxsize=128)
+@alru_cache(maxsize=128, ttl=LIVE_DATA_TTL)
 async def generate_vizualization(user_id: str, 
                                  data_source_name: str, 
                                  date_str: str = "", 
@@ -71,8 +74,9 @@ async def generate_vizualization(user_id: str,
         viz_text = f"{data_source.name} ({data_source.description}) from {start_str} to {end_str} is now being show to the user."
 
     # Add summary text
-    print(f"Visualize: fetching data for {user_id} from {start_str} to {end_str} with granularity {granularity}")
-    aggregated_data, description_string = await fetch_aggregated_data(user_id, data_source_name, start_str, end_str, granularity.value)
+    logger.info("Visualize: fetching data", user_id=user_id, data_source=data_source_name, start=start_str, end=end_str, granularity=granularity)
+    aggregated_data, description_string = await fetch_aggregated_data(user_id, data_source_name, start_str, end_str, granularity.value,
+                                                                     max_chars=max(DEFAULT_MAX_CHARS - len(viz_text), 500))
     viz_text += "\n" + description_string
     return viz_text, viz_json
 
@@ -7,6 +7,9 @@ import firebase_admin
 from firebase_admin import credentials, auth
 from firebase_admin import firestore, firestore_async
 from google.cloud.firestore_v1 import DocumentReference
+from tracing import traced_firestore
+from logs import get_logger
+logger = get_logger("firestore")
 
 STUDY_ID = "testing"
 FIREBASE_PROJECT_NAME = ""
@@ -38,15 +41,18 @@ class FirebaseManager:
         return cls._instance
 
     def initialize_firebase_app(self):
+        if self.db is not None:
+            # Already initialized, e.g., with the in-memory stand-in of the benchmarks
+            return self
         if USE_EMULATOR:
-            print("Initializing Firebase with emulator environment")
+            logger.info("Initializing Firebase with emulator environment")
             os.environ["FIRESTORE_EMULATOR_HOST"] = "localhost:8080"
             os.environ["FIREBASE_AUTH_EMULATOR_HOST"] = "localhost:9099"
             self.db = firestore.Client(project=FIREBASE_PROJECT_NAME)
             self.async_db = firestore_async.AsyncClient(project=FIREBASE_PROJECT_NAME)
             self.app = firebase_admin.initialize_app()
         else:
-            print("Initializing Firebase with production environment")
+            logger.info("Initializing Firebase with production environment")
             cred = credentials.Certificate('serviceAccount.json')
             self.app = firebase_admin.initialize_app(cred)
             self.db = firestore.client()
@@ -56,20 +62,18 @@ class FirebaseManager:
         self.auth = auth
         return self
 
+    def get_client(self, async_ref=False):
+        # Returns the sync or async Firestore client, wrapped so that reads and writes are counted and traced (see tracing.py)
+        return traced_firestore(self.async_db if async_ref else self.db)
+
     def get_users_col(self, async_ref=False):
         # Returns a reference to the users collection in firebase
-        if not async_ref:
-            return self.db.collection(f'studies/{STUDY_ID}/users')
-        else:
-            return self.async_db.collection(f'studies/{STUDY_ID}/users')
+        return self.get_client(async_ref).collection(f'studies/{STUDY_ID}/users')
 
     def get_user_doc(self, user_id: str, async_ref=False) -> DocumentReference:
         # Returns a reference to a user's document in firebase
         # Raises an error if user is not found
-        if not async_ref:
-            user_doc_ref = self.db.collection(f'studies/{STUDY_ID}/users').document(user_id)
-        else:
-            user_doc_ref = self.async_db.collection(f'studies/{STUDY_ID}/users').document(user_id)
+        user_doc_ref = self.get_users_col(async_ref).document(user_id)
 
         if not self.is_valid_user_id(user_id):
             raise ValueError(f"User {user_id} not found")
@@ -78,7 +82,7 @@ class FirebaseManager:
 
     def is_valid_user_id(self, user_id: str) -> bool:
         # Returns true if the user id is valid, false otherwise
-        user_doc_ref = self.db.collection(f'studies/{STUDY_ID}/users').document(user_id)
+        user_doc_ref = self.get_users_col().document(user_id)
         user_doc = user_doc_ref.get()
         return user_doc.exists
     
@@ -0,0 +1,268 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+# This file defines a token-budgeted context window. Before each LLM call, the prompt is counted
+# locally and older conversation history is compacted until it fits the budget of the stage.
+
+import os
+import json
+import time
+import threading
+from functools import lru_cache
+import tiktoken
+
+from logs import get_logger
+logger = get_logger("llm")
+
+# Total context size of each model (prompt + completion)
+MODEL_CONTEXT_LIMITS = {
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+    "gpt-3.5-turbo": 16385,
+}
+DEFAULT_CONTEXT_LIMIT = 8192
+
+# Tokens kept free for the completion
+RESERVED_COMPLETION_TOKENS = 1024
+
+# Prompt token budget of each stage. Keeping these well below the context limit keeps latency
+# and cost predictable as sessions grow long.
+STAGE_BUDGETS = {
+    "predict_strategy": 6000,
+    "generate_tool_call": 6000,
+    "generate_response": 6000,
+    "respond_with_tool_results": 6500,
+    "classify_state": 6000,
+}
+DEFAULT_STAGE_BUDGET = 6000
+
+# Compacted tool results are truncated to this many characters each
+COMPACTED_TOOL_RESULT_CHARS = 300
+# Fraction of the stage budget that the note replacing dropped history may use
+COMPACTED_NOTE_BUDGET_FRACTION = 0.25
+
+# The turns that the user's memory covers (see gpt/memory.py) are only left out once the prompt with them
+# would exceed this fraction of the stage budget (at most 1). Until then, the memory is added to the full history.
+MEMORY_SUBSTITUTION_FRACTION = float(os.getenv("MEMORY_SUBSTITUTION_FRACTION", "1.0"))
+# The most recent turns are kept verbatim even if the user's memory covers them
+MEMORY_KEEP_TURNS = 2
+
+# Approximation used when no tokenizer is available (e.g., while it loads, or offline before the encoding is cached)
+CHARS_PER_TOKEN = 4
+
+
+# Seconds before loading a tokenizer again after it failed to load
+ENCODING_RETRY_SECONDS = 300
+
+encodings = {}  # model -> loaded tiktoken encoding
+encoding_failures = {}  # model -> time of the last failed load (time.monotonic)
+encodings_loading = set()
+encodings_lock = threading.Lock()
+
+
+def load_encoding(model: str):
+    try:
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding("cl100k_base")
+        with encodings_lock:
+            encodings[model] = encoding
+            encoding_failures.pop(model, None)
+        logger.info("Loaded tokenizer", model=model)
+    except Exception as e:
+        # tiktoken downloads its encodings on first use
+        logger.warning("Could not load tokenizer, approximating token counts: %s", e, model=model)
+        with encodings_lock:
+            encoding_failures[model] = time.monotonic()
+    finally:
+        with encodings_lock:
+            encodings_loading.discard(model)
+
+
+def get_encoding(model: str):
+    """
+    Return the tokenizer of the model, or None if it is not loaded (yet). Tokenizers are loaded in a background
+    thread on first use, so that a download never blocks the caller, and loaded again ENCODING_RETRY_SECONDS
+    after a failed load.
+    """
+    encoding = encodings.get(model)
+    if encoding is not None:
+        return encoding
+    with encodings_lock:
+        failed = encoding_failures.get(model)
+        if model in encodings_loading or (failed is not None and time.monotonic() - failed < ENCODING_RETRY_SECONDS):
+            return None
+        encodings_loading.add(model)
+    threading.Thread(target=load_encoding, args=(model,), name=f"load-encoding-{model}", daemon=True).start()
+    return None
+
+
+def count_tokens(text: str, model: str) -> int:
+    if not text:
+        return 0
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text) // CHARS_PER_TOKEN + 1
+    return len(encoding.encode(text))
+
+
+@lru_cache(maxsize=256)
+def count_serialized_tokens(text: str, model: str) -> int:
+    # For text that repeats across calls, e.g., the tools payload of a user. Only used once the tokenizer is
+    # loaded, so that approximate counts are not cached.
+    return count_tokens(text, model)
+
+
+def count_message_tokens(message: dict, model: str) -> int:
+    # Follows OpenAI's accounting: a few tokens of overhead per message plus its content
+    if not isinstance(message, dict):
+        message = message.model_dump(exclude_none=True)
+    tokens = 4
+    tokens += count_tokens(message.get("content") or "", model)
+    if message.get("name"):
+        tokens += count_tokens(message["name"], model)
+    if message.get("tool_calls"):
+        tool_calls = [call if isinstance(call, dict) else call.model_dump() for call in message["tool_calls"]]
+        tokens += count_tokens(json.dumps(tool_calls), model)
+    return tokens
+
+
+def count_prompt_tokens(messages: list, model: str, tools: list = None) -> int:
+    tokens = sum(count_message_tokens(message, model) for message in messages) + 3
+    if tools:
+        serialized = json.dumps(tools)
+        tokens += count_serialized_tokens(serialized, model) if get_encoding(model) else count_tokens(serialized, model)
+    return tokens
+
+
+def split_into_turns(messages: list) -> list[list[int]]:
+    # Group message indices into turns, each starting at a user message
+    turns = []
+    for i, message in enumerate(messages):
+        role = message.get("role") if isinstance(message, dict) else message.role
+        if role == "user" or not turns:
+            turns.append([])
+        turns[-1].append(i)
+    return turns
+
+
+class ContextWindow:
+    """
+    Fits the messages of each LLM call of a turn into the prompt budget of its stage.
+
+    Messages are expected in the layout built by `build_stage_messages`: the shared system prompt,
+    the conversation history, the current turn (starting at the latest user message) and the stage
+    instructions. The shared system prompt, the current turn and the stage instructions are always kept.
+    Whole turns of older history are dropped, oldest first, and replaced by a compact note that keeps
+    their tool results and dialogue state transitions.
+
+    The number of dropped turns only grows within a turn, so that all stages after the first trim
+    share the same prefix and can still hit the provider's prompt cache.
+
+    If the user has a memory, it follows the shared system prompt. Once the prompt exceeds
+    MEMORY_SUBSTITUTION_FRACTION of the budget, the turns at the start of the history that the memory covers
+    are left out (except for the last MEMORY_KEEP_TURNS), before any others are dropped.
+
+    - states: the dialogue state of each message in the conversation history (list[str], optional)
+    - budget_scale: multiplier applied to every stage budget (float), e.g., 0.5 to retry after a context length error
+    - user_id: the user whose turn this is (str, optional), used to schedule the turn's requests
+    - memory: the rendered memory of the user (str, optional), see ConversationMemory.render
+    - memory_covers: the number of messages at the start of the history that the memory covers (int)
+    """
+    def __init__(self, states: list = None, budget_scale: float = 1.0, user_id: str = None, memory: str = None,
+                 memory_covers: int = 0):
+        self.states = states or []
+        self.budget_scale = budget_scale
+        self.user_id = user_id
+        self.memory = memory
+        self.memory_covers = memory_covers
+        self.dropped_turns = 0
+
+    def budget(self, stage: str, model: str) -> int:
+        context_limit = MODEL_CONTEXT_LIMITS.get(model, DEFAULT_CONTEXT_LIMIT) - RESERVED_COMPLETION_TOKENS
+        return int(min(STAGE_BUDGETS.get(stage, DEFAULT_STAGE_BUDGET), context_limit) * self.budget_scale)
+
+    def compact(self, history: list, dropped: list[int], model: str, max_tokens: int) -> dict:
+        # Summarize the dropped messages into a single system message, without calling the LLM
+        lines = []
+        tool_call_args = {}
+        previous_state = None
+        for i in dropped:
+            message = history[i]
+            state = self.states[i] if i < len(self.states) else None
+            if isinstance(state, list):
+                state = state[-1] if state else None
+            if state and previous_state and state != previous_state:
+                lines.append(f"- The conversation moved from the '{previous_state}' stage to the '{state}' stage.")
+            previous_state = state or previous_state
+
+            for call in message.get("tool_calls") or []:
+                call = call if isinstance(call, dict) else call.model_dump()
+                tool_call_args[call.get("id")] = f"{call['function']['name']}({call['function']['arguments']})"
+
+            if message.get("role") == "tool":
+                call = tool_call_args.get(message.get("tool_call_id"), message.get("name"))
+                result = message.get("content") or ""
+                if len(result) > COMPACTED_TOOL_RESULT_CHARS:
+                    result = result[:COMPACTED_TOOL_RESULT_CHARS] + "... (truncated)"
+                lines.append(f"- {call} returned: {result}")
+
+        # Keep the most recent notes that fit into the note budget
+        kept_lines, tokens = [], 0
+        for line in reversed(lines):
+            tokens += count_tokens(line, model) + 1
+            if tokens > max_tokens:
+                break
+            kept_lines.insert(0, line)
+
+        content = "Earlier parts of the conversation were omitted to save space."
+        if kept_lines:
+            content += " Notes from the omitted part:\n" + "\n".join(kept_lines)
+        return {"role": "system", "content": content}
+
+    def fit(self, stage: str, messages: list, model: str, tools: list = None) -> list:
+        """
+        Return `messages` trimmed to fit the budget of `stage` when sent to `model`.
+        If the messages cannot be trimmed enough, the smallest possible prompt is returned and the
+        provider decides whether it fits.
+        """
+        budget = self.budget(stage, model)
+        if not self.memory and self.dropped_turns == 0 and count_prompt_tokens(messages, model, tools) <= budget:
+            return messages
+
+        # Locate the history: everything between the shared system prompt and the latest user message
+        roles = [m.get("role") if isinstance(m, dict) else m.role for m in messages]
+        if roles[0] != "system" or "user" not in roles:
+            return messages
+        current_turn_start = len(roles) - 1 - roles[::-1].index("user")
+        head, history, tail = messages[:1], messages[1:current_turn_start], messages[current_turn_start:]
+        turns = split_into_turns(history)
+        memory = [{"role": "system", "content": self.memory}] if self.memory else []
+        if self.memory and self.dropped_turns == 0:
+            fitted = head + memory + history + tail
+            if count_prompt_tokens(fitted, model, tools) <= budget * min(MEMORY_SUBSTITUTION_FRACTION, 1.0):
+                return fitted
+
+        covered_turns = 0
+        if self.memory:
+            covered_turns = min(sum(1 for turn in turns if turn[-1] < self.memory_covers), max(len(turns) - MEMORY_KEEP_TURNS, 0))
+
+        for dropped_turns in range(max(min(self.dropped_turns, len(turns)), covered_turns), len(turns) + 1):
+            # Only the dropped turns that the memory does not cover get a note
+            dropped = [i for turn in turns[covered_turns:dropped_turns] for i in turn]
+            kept = [history[i] for turn in turns[dropped_turns:] for i in turn]
+            note = [self.compact(history, dropped, model, int(budget * COMPACTED_NOTE_BUDGET_FRACTION))] if dropped else []
+            fitted = head + memory + note + kept + tail
+            if count_prompt_tokens(fitted, model, tools) <= budget:
+                break
+
+        if dropped_turns > max(self.dropped_turns, covered_turns):
+            logger.info("Context window: dropped earlier turns to fit the budget", stage=stage, dropped_turns=dropped_turns,
+                        turns=len(turns), budget=budget, user_id=self.user_id)
+        self.dropped_turns = dropped_turns
+        return fitted
@@ -5,6 +5,8 @@
 from gpt.openai_client import OpenAIClient
 openai_client = OpenAIClient()
 from openai.types.chat import ChatCompletionMessage, ChatCompletionMessageToolCall
+from logs import get_logger, log_payload
+prompt_logger = get_logger("prompts")
 
 class CustomTransitionFunctions:
     # Custom function execution with deterministic state transition
@@ -25,14 +27,15 @@ class CustomTransitionFunctions:
         system_prompt = " \n".join([self.summarize_prompt] + formatted_dialogue)        
                 
         messages = [{"role": "system", "content": system_prompt}]
-        print("Message being sent for summarizing conversation to GPT: ", messages)
+        log_payload(prompt_logger, "summarize_conversation messages", messages)
 
         response = await openai_client.chat_completion(
+            stage="summarize_conversation",
             messages=messages
         )
 
         reply_message = response.choices[0].message
-        print("GPT Conversation Summary:", reply_message, "\n\n\n")
+        log_payload(prompt_logger, "summarize_conversation response", reply_message.content)
 
         return reply_message.content
         # return self.next_state_id
\ No newline at end of file
@@ -40,7 +40,8 @@ class DialogueState:
             elif transition_data.get('type') == 'StateClassifier':
                 self.transition = StateClassifier(
                     classification_prompt=transition_data['classification_prompt'],
-                    class_transitions=transition_data['class_transitions']
+                    class_transitions=transition_data['class_transitions'],
+                    state_id=self.id
                 )
                 self.transition_type = 'StateClassifier'       
             elif transition_data.get('type') == 'custom':
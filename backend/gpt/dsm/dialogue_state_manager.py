@@ -8,6 +8,8 @@ from gpt.dsm.dialogue_state import DialogueState
 from gpt.dsm.annotated_response import AnnotatedResponse
 from typing import Tuple, Union, List, Optional
 from collections import OrderedDict
+from logs import get_logger
+logger = get_logger("dsm")
 
 class DialogueStateManager:
     def __init__(self, base_directory):
@@ -35,7 +37,8 @@ class DialogueStateManager:
 
     def get_state(self, state_id):
         """Retrieve a state object by its ID."""
-        self.load_states()
+        if not self.states:
+            self.load_states()
         return self.states.get(state_id)
 
 
@@ -70,17 +73,17 @@ class DialogueStateManager:
         return user_response, agent_response    
 
 
-    async def handle_transition(self, current_state, dialogue_history: List[AnnotatedResponse]=None):                
+    async def handle_transition(self, current_state, dialogue_history: List[AnnotatedResponse]=None, context=None):                
         next_state_name = None  
         # Check the transition type and determine the next state
         if current_state.transition_type == 'StateClassifier':            
-            next_state_name = await current_state.transition.classify_state(dialogue_history)
+            next_state_name = await current_state.transition.classify_state(dialogue_history, context)
         elif current_state.transition_type == 'id':
             next_state_name = current_state.transition
         elif current_state.transition_type == 'custom':
             next_state_name = current_state.transition          
 
-        print("Transitions: next state is: ", next_state_name)                     
+        logger.debug("Transition", next_state=next_state_name)                     
         if next_state_name:                   
             # self.mark_skipped_states(from_state, next_state_name)
             return next_state_name
@@ -91,13 +94,13 @@ class DialogueStateManager:
             return list(d.keys())
         return {}
 
-    async def traverse(self, dialogue_history: List[AnnotatedResponse]):
+    async def traverse(self, dialogue_history: List[AnnotatedResponse], context=None):
         user_response, agent_response = self.get_most_recent_responses(dialogue_history) 
         # visited_states = set(self.list_visited_states(agent_response))
         
         visited_states = self.ordered_set(self.list_visited_states(agent_response))
         # current_state = visited_states[-1]
-        print("Visited States: ", self.list_visited_states(agent_response))
+        logger.debug("Visited states", visited_states=visited_states)
 
         if len(visited_states) == 0 or visited_states[-1] == 'root': 
             # If the conversation has just started or the system has sent the first intro message
@@ -106,16 +109,16 @@ class DialogueStateManager:
         # current_state_id = stack[-1]  # Look at the last state without popping it        
         current_state_id = self.list_visited_states(agent_response)[-1]
         current_state = self.get_state(current_state_id)
-        print(f"Handling state: {current_state_id}, prompt: {current_state.prompt}")
-        next_state_id = await self.handle_transition(current_state, dialogue_history)                                  
-        print(f"Next state is {next_state_id}")
+        logger.debug("Handling state", state=current_state_id)
+        next_state_id = await self.handle_transition(current_state, dialogue_history, context)                                  
+        logger.debug("Next state", state=next_state_id)
         return self.get_state(next_state_id), visited_states
         
-    async def get_next_system_prompt(self, dialogue_history: List[AnnotatedResponse]):
+    async def get_next_system_prompt(self, dialogue_history: List[AnnotatedResponse], context=None):
         # It will break if next state is None
-        next_state, parent_states = await self.traverse(dialogue_history)
+        next_state, parent_states = await self.traverse(dialogue_history, context)
         if next_state:
-            print(f"Returning system prompt for next state {next_state.id}")
+            logger.debug("Returning system prompt for next state", state=next_state.id)
             return AnnotatedResponse(role='system', 
             response=next_state.prompt, start_state=parent_states,
             end_state=next_state.id, transition=None)
@@ -5,9 +5,17 @@
 from gpt.openai_client import OpenAIClient
 openai_client = OpenAIClient()
 from openai.types.chat import ChatCompletionMessage, ChatCompletionMessageToolCall
+from gpt.prompts import PromptRegistry
+prompt_registry = PromptRegistry()
+from gpt.local_classifier import LocalClassifiers, state_completion_features
+from logs import get_logger, log_payload
+logger = get_logger("dsm")
+prompt_logger = get_logger("prompts")
+local_classifiers = LocalClassifiers()
 
 class StateClassifier:
-    def __init__(self, classification_prompt, class_transitions):
+    def __init__(self, classification_prompt, class_transitions, state_id=None):
+        self.state_id = state_id
         self.classification_prompt = classification_prompt
         self.class_transitions = class_transitions
         self.probe_frequency = 0
@@ -25,8 +33,8 @@ class StateClassifier:
             dialogue_history.append(message_dict)
         return dialogue_history        
 
-    async def classify_state(self, dialogue_history=None):
-        print("Trying to classify state by calling GPT to evaluate dialogue history")
+    async def classify_state(self, dialogue_history=None, context=None):
+        logger.debug("Classifying state", state=self.state_id)
 
         # formatted_dialogue = []
         # for annotated_response in dialogue_history:
@@ -35,18 +43,29 @@ class StateClassifier:
         #     formatted_dialogue.append(message)   
         formatted_dialogue = self.get_message_history_for_gpt(dialogue_history)
 
-        messages = [{"role": "system", "content": self.classification_prompt}] + \
+        # Use the local classifier if it is confident enough, otherwise ask the LLM
+        local_response = local_classifiers.predict("state_completion", state_completion_features(self.state_id, formatted_dialogue))
+        if local_response in self.class_transitions:
+            openai_client.metrics.record_local("classify_state")
+            return self.class_transitions.get(local_response)
+
+        # Start with the same system prompt and history as the other stages of the turn so the
+        # provider's prompt cache can be reused, and put the classification prompt at the end
+        messages = [{"role": "system", "content": prompt_registry.shared_system_prompt()}] + \
             formatted_dialogue + \
+            [{"role": "system", "content": self.classification_prompt}] + \
             [{"role": "assistant", "content": "Given this conversation history, respond only with 'continue' or 'completed' depending on whether the task has been successfully completed."}]
         
-        print("STATE CLASSIFIER message being sent to GPT: ", messages)
+        log_payload(prompt_logger, "classify_state messages", messages, state=self.state_id)
 
         response = await openai_client.chat_completion(
+            stage="classify_state",
+            context=context,
             messages=messages
         )
 
         reply_message = response.choices[0].message
-        print("GPT State Classifier response:", reply_message, "\n\n\n")
+        log_payload(prompt_logger, "classify_state response", reply_message.content, state=self.state_id)
         
         gpt_response = reply_message.content.lower()  # 'not_consented'  # Example response        
         
@@ -0,0 +1,148 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+# This file defines the selection of few-shot examples for a turn. The prompts listed in EXAMPLE_PROMPTS
+# (e.g., the example function calls and the strategy definitions) are split into examples when they are
+# loaded, and indexed with BM25. Once the strategy of a turn is known, the examples most relevant to its
+# dialogue state, strategy and user message are selected, up to FEW_SHOT_TOP_K examples and
+# FEW_SHOT_TOKEN_BUDGET tokens, and added to the instructions of the remaining stages of the turn.
+
+import os
+import re
+import math
+from collections import Counter
+
+from gpt.context import count_tokens
+from gpt.routing import STRONG_MODEL
+
+FEW_SHOT_TOP_K = int(os.getenv("FEW_SHOT_TOP_K", "3"))
+FEW_SHOT_TOKEN_BUDGET = int(os.getenv("FEW_SHOT_TOKEN_BUDGET", "400"))
+
+# Prompt -> (how its examples are separated, title of the selected examples)
+# - blocks: examples are paragraphs starting with "> ", the paragraphs before them are the introduction
+# - lines: the first paragraph is the title, every following line is an example
+EXAMPLE_PROMPTS = {
+    "strategies": ("lines", "Strategies"),
+    "few_shot_function_calls": ("blocks", "Examples of function calls"),
+}
+
+# BM25 parameters
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Weight of each part of the query. The prompt of the dialogue state is long and the same for every turn
+# in the state, so each of its terms counts once and little, and the turn's strategy and message decide.
+QUERY_WEIGHTS = {
+    "state": 1.0,
+    "state_prompt": 0.1,
+    "strategy": 1.0,
+    "user_message": 1.0,
+}
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+PARAGRAPH_SEPARATOR = re.compile(r"\n\s*\n")
+STOP_WORDS = frozenset("""
+a an and are as at be by can do for from has have how i if in is it me my of on or so such that the
+their them they this to was we were what when with you your
+""".split())
+
+
+def tokenize(text: str) -> list[str]:
+    # Words and numbers, e.g., "health.stepcount" -> ["health", "stepcount"], "past_experience" -> ["past", "experience"]
+    return [token for token in TOKEN_PATTERN.findall(text.lower().replace("_", " ")) if token not in STOP_WORDS]
+
+
+def build_query(**parts: str) -> Counter:
+    # Weighted query terms from the parts named in QUERY_WEIGHTS, e.g., build_query(strategy="Reflect", user_message="...")
+    query = Counter()
+    for name, text in parts.items():
+        terms = tokenize(text or "")
+        if name == "state_prompt":
+            terms = set(terms)
+        for term in terms:
+            query[term] += QUERY_WEIGHTS[name]
+    return query
+
+
+def split_examples(text: str, separation: str) -> tuple[str, list[str]]:
+    """
+    Split a prompt into its introduction and its examples
+    - text: the prompt (str)
+    - separation: "blocks" or "lines", see EXAMPLE_PROMPTS (str)
+
+    Returns: the introduction (str) and the examples (list of str)
+    """
+    paragraphs = [paragraph.strip() for paragraph in PARAGRAPH_SEPARATOR.split(text) if paragraph.strip()]
+    if separation == "blocks":
+        introduction = [paragraph for paragraph in paragraphs if not paragraph.startswith("> ")]
+        examples = [paragraph for paragraph in paragraphs if paragraph.startswith("> ")]
+    elif separation == "lines":
+        introduction = paragraphs[:1]
+        examples = [line.strip() for paragraph in paragraphs[1:] for line in paragraph.splitlines() if line.strip()]
+    else:
+        raise ValueError(f"Unknown example separation '{separation}'")
+    return "\n\n".join(introduction), examples
+
+
+class Example:
+    def __init__(self, prompt: str, position: int, text: str):
+        self.prompt = prompt
+        self.position = position
+        self.text = text
+        self.terms = Counter(tokenize(text))
+        self.length = sum(self.terms.values())
+        self.tokens = count_tokens(text, STRONG_MODEL)
+
+
+class ExampleIndex:
+    """
+    A BM25 index over the examples of the prompts in EXAMPLE_PROMPTS
+    - prompts: the text of each prompt (dict of str -> str)
+    """
+    def __init__(self, prompts: dict):
+        self.introductions = {}
+        self.examples = []
+        for name, (separation, _) in EXAMPLE_PROMPTS.items():
+            introduction, examples = split_examples(prompts[name], separation)
+            self.introductions[name] = introduction
+            self.examples += [Example(name, position, text) for position, text in enumerate(examples)]
+
+        self.average_length = sum(example.length for example in self.examples) / max(len(self.examples), 1)
+        document_frequency = Counter(term for example in self.examples for term in example.terms)
+        self.idf = {term: math.log(1 + (len(self.examples) - count + 0.5) / (count + 0.5))
+                    for term, count in document_frequency.items()}
+
+    def score(self, example: Example, query: Counter) -> float:
+        normalization = BM25_K1 * (1 - BM25_B + BM25_B * example.length / max(self.average_length, 1))
+        score = 0.0
+        for term, weight in query.items():
+            frequency = example.terms.get(term, 0)
+            if frequency:
+                score += weight * self.idf[term] * frequency * (BM25_K1 + 1) / (frequency + normalization)
+        return score
+
+    def select(self, query: Counter, top_k: int = FEW_SHOT_TOP_K, token_budget: int = FEW_SHOT_TOKEN_BUDGET) -> list[Example]:
+        # The best matching examples that fit the budget, skipping those that match no term of the query (see `build_query`)
+        scored = sorted(((self.score(example, query), i) for i, example in enumerate(self.examples)), key=lambda item: -item[0])
+        selected, tokens = [], 0
+        for score, i in scored:
+            if score <= 0 or len(selected) >= top_k:
+                break
+            example = self.examples[i]
+            if tokens + example.tokens <= token_budget:
+                selected.append(example)
+                tokens += example.tokens
+        return selected
+
+    def render(self, examples: list[Example]) -> str:
+        """
+        Return the selected examples grouped under the title of their prompt, in the order of the prompt files,
+        so that the same selection always gives the same text. Returns an empty string if nothing is selected.
+        """
+        sections = []
+        for name, (_, title) in EXAMPLE_PROMPTS.items():
+            texts = [example.text for example in sorted(examples, key=lambda example: example.position) if example.prompt == name]
+            if texts:
+                sections.append(f"{title}:\n\n" + "\n\n".join(texts))
+        return "\n\n".join(sections)
@@ -2,34 +2,41 @@
 #
 # SPDX-License-Identifier: MIT
 
-from async_lru import alru_cache
 from data.fetch import fetch_aggregated_data
+from data.compact import DEFAULT_MAX_CHARS
+from data.granularity import adjust_date_and_granularity, Granularity, DEFAULT_MAX_ROWS
+from data.utils import round_datetime, advance_datetime
 from data.data_sources import get_user_data_sources
 from data.visualize import generate_vizualization
 from fastapi import WebSocket
 
 import json
-import traceback
+import pytz
+import pandas as pd
+from datetime import datetime
 from firebase import FirebaseManager
 firebase_manager = FirebaseManager()
 
 from data.fetch import fetch_aggregated_data
 from openai.types.chat import ChatCompletionMessageToolCall
-from gpt.utils import write_message_to_db
-
-async def handle_function_call(tool_call: ChatCompletionMessageToolCall, web_socket: WebSocket, user_id: str, session_id: str):
+from gpt.session import ConversationSession
+from gpt.tool_cache import ToolResultCache, data_version
+from gpt.jobs import JobQueue
+from logs import get_logger, log_payload
+logger = get_logger("tools")
+tool_result_cache = ToolResultCache()
+
+async def handle_function_call(tool_call: ChatCompletionMessageToolCall, web_socket: WebSocket, session: ConversationSession):
+    user_id = session.user_id
     try:
         function_name = tool_call.function.name
         args = json.loads(tool_call.function.arguments)
         args["user_id"] = user_id
         args["web_socket"] = web_socket
-        args["session_id"] = session_id
-
-        args['data_source_name'] = "health.stepcount"
-        args['granularity'] = "month"
-        args['date'] = '2024-09-16'
+        args["session_id"] = session.session_id
+        args["session"] = session
 
-        print(f"Calling function {function_name} with args: {args}")
+        logger.info("Calling function", function=function_name, user_id=user_id, arguments=tool_call.function.arguments)
         if function_name == "describe":
             fn = describe
         elif function_name == "visualize":
@@ -37,50 +44,82 @@ async def handle_function_call(tool_call: ChatCompletionMessageToolCall, web_soc
         elif function_name == "finish":
             fn = finish
         else:
-            print(f"=> ERROR: {function_name} does not exist!")
+            logger.error("Function does not exist", function=function_name)
             return f"{function_name} does not exist"
         
         result = await fn(**args)
-        print(f" => {result}")
+        log_payload(logger, f"{function_name} result", result, user_id=user_id)
 
         return result
     except Exception as error:
-        print(f" => ERROR: {error}")
-        traceback.print_exc()
+        logger.exception("Function call failed: %s", error, function=tool_call.function.name)
         return f"An error occured: {error.with_traceback(None)}"
 
 
 # Function callbacks ----------------------------------------------------------------
-@alru_cache(maxsize=128)
-async def visualize(web_socket: WebSocket, user_id, session_id, data_source_name, date="", granularity=""):
+# The data each function returns is computed once per cache key (see gpt/tool_cache.py).
+# Everything that involves the websocket or the session runs on every call, including cache hits.
+def describe_key(user_id: str, data_source_name: str, start: str, end: str, granularity: str) -> tuple:
+    start, end, granularity = adjust_date_and_granularity(start, end, granularity)
+    return ("describe", user_id, data_source_name, start.isoformat(), end.isoformat(), granularity.value, data_version(end))
+
+def visualize_key(user_id: str, data_source_name: str, date: str, granularity: str) -> tuple:
+    date = pd.to_datetime(date) if date else datetime.now(tz=pytz.timezone("US/Pacific"))
+    start = round_datetime(date, Granularity(granularity))
+    end = advance_datetime(start, Granularity(granularity))
+    return ("visualize", user_id, data_source_name, start.date().isoformat(), end.date().isoformat(), granularity, data_version(end))
+
+def describe_result(user_id, data_source_name, start, end, granularity) -> tuple:
+    # The cache key of the result and a function computing it
+    async def compute_description():
+        aggregated_data, description_string = await fetch_aggregated_data(user_id, data_source_name, start, end, granularity,
+                                                                         max_chars=DEFAULT_MAX_CHARS, max_rows=DEFAULT_MAX_ROWS)
+        return description_string
+    return describe_key(user_id, data_source_name, start, end, granularity), compute_description
+
+def visualize_result(user_id, data_source_name, date="", granularity="") -> tuple:
+    # Without a granularity, a day is visualized (the default of `generate_vizualization`)
+    granularity = granularity or "day"
+    return (visualize_key(user_id, data_source_name, date, granularity),
+            lambda: generate_vizualization(user_id, data_source_name, date, granularity))
+
+# Function name -> function returning the cache key and computation of its result for the arguments (without the websocket and session)
+FUNCTION_RESULTS = {
+    "describe": describe_result,
+    "visualize": visualize_result,
+}
+
+async def visualize(web_socket: WebSocket, user_id, session_id, session: ConversationSession, data_source_name, date="", granularity=""):
     # Send a json descripton over the web socket
     # Send a text description back to GPT
     await web_socket.send_json({
         "type": "loading",
         "content": "Fetching data..."
     })
-    viz_text, viz_json = await generate_vizualization(user_id, data_source_name, date, granularity)
+    key, compute = visualize_result(user_id, data_source_name, date, granularity)
+    viz_text, viz_json = await tool_result_cache.get_or_compute(key, session_id, compute)
 
     if viz_json:
         await web_socket.send_json(viz_json)
-        write_message_to_db(user_id, session_id, viz_json)
+        # A copy, since the cached result is shared by every session that shows it
+        await session.append(dict(viz_json))
 
     return viz_text
 
-async def finish(description, user_id):
-    # Completed the interview process
-    firebase_manager.get_user_doc(user_id).set({"gpt-summary": description}, merge=True)
+async def finish(description, user_id, session_id, **kwargs):
+    # Completed the interview process. The summary is saved in the background, the reply does not wait for it.
+    JobQueue().enqueue("save_summary", user_id, f"{session_id}:{description}", description=description)
     return "You have completed the user interview! End the conversation."
 
-@alru_cache(maxsize=128)
-async def describe(web_socket: WebSocket, user_id, session_id, data_source_name, start, end, granularity):
+async def describe(web_socket: WebSocket, user_id, session_id, data_source_name, start, end, granularity, **kwargs):
     # Get the descriptive statistics for the data source
     await web_socket.send_json({
         "type": "loading",
         "content": "Fetching data..."
     })
-    aggregated_data, description_string = await fetch_aggregated_data(user_id, data_source_name, start, end, granularity)
-    return description_string
+
+    key, compute = describe_result(user_id, data_source_name, start, end, granularity)
+    return await tool_result_cache.get_or_compute(key, session_id, compute)
 
 # -----------------------------------------------------------------------------------
 
@@ -94,7 +133,34 @@ DO NOT PERFORM ANY ARITHMETIC TO THE OUTPUT OF THE FUNCTION. YOU SHOULD ALWAYS R
 If the output of the function does not match your expected query, make another function call with the appropriate arguments. 
 '''
 
-def get_functions_dict(user_id: str):
+class ToolSchemaCache:
+    # The tools payload of each user, rebuilt only when the user's data sources change
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = object.__new__(cls)
+            cls._instance.entries = {}  # user_id -> (data sources, tools)
+            cls._instance.hits = 0
+            cls._instance.misses = 0
+        return cls._instance
+
+    async def get(self, user_id: str) -> list[dict]:
+        data_sources = tuple(await get_user_data_sources(user_id))
+        entry = self.entries.get(user_id)
+        if entry is None or entry[0] != data_sources:
+            self.misses += 1
+            self.entries[user_id] = (data_sources, build_functions_dict(list(data_sources)))
+        else:
+            self.hits += 1
+        return self.entries[user_id][1]
+
+tool_schema_cache = ToolSchemaCache()
+
+async def get_functions_dict(user_id: str) -> list[dict]:
+    return await tool_schema_cache.get(user_id)
+
+def build_functions_dict(data_sources: list[str]) -> list[dict]:
     # Normal functions
     return [
         # `describe` function ------------------------------------------------------------
@@ -108,7 +174,7 @@ def get_functions_dict(user_id: str):
                     "properties": {
                         "data_source_name": {
                             "type": "string",
-                            "enum": get_user_data_sources(user_id),
+                            "enum": data_sources,
                             "description": "The name of the data source to fetch data for.",
                         },
                         "start": {
@@ -140,7 +206,7 @@ def get_functions_dict(user_id: str):
                     "properties": {
                         "data_source_name": {
                             "type": "string",
-                            "enum": [s for s in get_user_data_sources(user_id) if s != "health.workout"],
+                            "enum": [s for s in data_sources if s != "health.workout"],
                             "description": "The name of the data source to visualize. Workouts are not supported for visualization and you should call describe on health.workout instead.",
                         },
                         "date": {
@@ -153,7 +219,7 @@ def get_functions_dict(user_id: str):
                             "description": "The time period to visualize over (day, week, month)"
                         }
                     },
-                    "required": ["data_source_name", "date_string", "granularity"]
+                    "required": ["data_source_name", "date", "granularity"]
                 }
             }
         }
@@ -0,0 +1,238 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+# This file defines a queue of background jobs for the side effects of a turn that the reply does not
+# wait for, e.g., summarizing a dialogue state the user just completed (`function_calls` in the state
+# YAML files) or saving the summary of the `finish` tool. Jobs run on the event loop after the reply is
+# sent, are retried with backoff, and their status is kept in the `jobs` map of the user document:
+#
+#   jobs.<job ID> = {"name", "key", "arguments", "status", "attempts", "error", "updated"}
+#
+# The job ID is derived from an idempotency key (e.g., the session and state), so a job that already
+# completed is not run again, and jobs interrupted by a restart are resumed when their user reconnects.
+
+import os
+import time
+import asyncio
+import hashlib
+import contextvars
+
+from google.cloud.firestore_v1 import DELETE_FIELD
+
+from gpt.dsm.custom_transition_function import CustomTransitionFunctions
+from gpt.utils import fetch_message_history, is_dialogue_message, to_annotated_response
+from tracing import Tracer
+from monitoring import JOBS
+from logs import get_logger
+logger = get_logger("jobs")
+tracer = Tracer()
+
+from firebase import FirebaseManager
+firebase_manager = FirebaseManager()
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_DELAY = float(os.getenv("JOB_RETRY_DELAY", "5"))  # in seconds, doubled after every attempt
+# How long to wait for queued jobs on shutdown, in seconds
+JOB_SHUTDOWN_TIMEOUT = float(os.getenv("JOB_SHUTDOWN_TIMEOUT", "20"))
+# Finished jobs are removed from the user document after this many seconds. Their records only keep jobs from
+# running twice, and job keys belong to a session, which ends after an hour without messages.
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", str(24 * 3600)))
+
+# Statuses of jobs that did not finish, which are resumed when their user connects
+UNFINISHED = {"running", "retrying"}
+# Statuses of jobs that are not run again
+FINISHED = {"done", "failed"}
+
+# Job name -> async function taking the user ID and the arguments of the job
+JOB_HANDLERS = {}
+
+
+def job(name: str):
+    # Decorator registering a job handler under the name used in `enqueue` and the state YAML files
+    def decorator(function):
+        JOB_HANDLERS[name] = function
+        return function
+    return decorator
+
+
+def user_doc_ref(user_id: str):
+    # The async reference of the user document. Jobs are only queued for users who connected, so unlike
+    # `FirebaseManager.get_user_doc`, this does not read the document to validate the user ID.
+    return firebase_manager.get_users_col(async_ref=True).document(user_id)
+
+
+def job_id(name: str, key: str) -> str:
+    # A valid Firestore field name (letters, digits and underscores)
+    return f"{name}_{hashlib.sha1(f'{name}:{key}'.encode()).hexdigest()[:16]}"
+
+
+class Job:
+    def __init__(self, name: str, user_id: str, key: str, arguments: dict, attempts: int = 0):
+        self.id = job_id(name, key)
+        self.name = name
+        self.user_id = user_id
+        self.key = key
+        self.arguments = arguments
+        self.attempts = attempts
+
+
+class JobQueue:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = object.__new__(cls)
+            cls._instance.queue = None
+            cls._instance.workers = []
+            cls._instance.active = {}  # job ID -> job, from enqueueing until it is done or failed
+        return cls._instance
+
+    def start(self):
+        # Start the workers (once per event loop). They run in an empty context, so they are not part of the trace of the turn that enqueued a job.
+        if self.workers:
+            return
+        self.queue = asyncio.Queue()
+        self.workers = [asyncio.create_task(self.work(), context=contextvars.Context()) for _ in range(JOB_WORKERS)]
+
+    def enqueue(self, name: str, user_id: str, key: str, **arguments) -> str:
+        """
+        Run a job in the background, unless a job with the same name and key is already queued, running or done
+        - name: the name of a registered job (str)
+        - user_id: the user the job belongs to (str)
+        - key: the idempotency key (str), e.g., "<session ID>:<state ID>"
+        - arguments: the keyword arguments of the handler, stored in Firestore (JSON-serializable values)
+
+        Returns: the job ID (str)
+        """
+        if name not in JOB_HANDLERS:
+            raise ValueError(f"No job named {name}")
+        return self.submit(Job(name, user_id, key, arguments))
+
+    def submit(self, job: Job) -> str:
+        if job.id in self.active:
+            return job.id
+        self.start()
+        self.active[job.id] = job
+        self.queue.put_nowait(job)
+        logger.debug("Queued job", job=job.name, job_id=job.id, user_id=job.user_id)
+        return job.id
+
+    @property
+    def queued(self) -> int:
+        return self.queue.qsize() if self.queue is not None else 0
+
+    async def work(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self.run(job)
+            except Exception as e:
+                # Failing to update the status must not stop the worker
+                logger.exception("Job worker error: %s", e, job=job.name, job_id=job.id)
+                self.active.pop(job.id, None)
+            finally:
+                self.queue.task_done()
+
+    async def run(self, job: Job):
+        user_doc = await user_doc_ref(job.user_id).get()
+        record = (user_doc.to_dict() or {}).get("jobs", {}).get(job.id, {})
+        if record.get("status") == "done":
+            JOBS.inc(job=job.name, result="skipped")
+            self.active.pop(job.id, None)
+            return
+
+        job.attempts = max(job.attempts, record.get("attempts", 0)) + 1
+        await self.persist(job, "running")
+        try:
+            with tracer.trace(f"job.{job.name}", user_id=job.user_id, job_id=job.id, attempt=job.attempts):
+                await JOB_HANDLERS[job.name](job.user_id, **job.arguments)
+        except Exception as e:
+            await self.retry_or_fail(job, e)
+            return
+        await self.persist(job, "done")
+        JOBS.inc(job=job.name, result="done")
+        self.active.pop(job.id, None)
+        logger.info("Job done", job=job.name, job_id=job.id, user_id=job.user_id, attempts=job.attempts)
+
+    async def retry_or_fail(self, job: Job, error: Exception):
+        message = f"{type(error).__name__}: {error}"
+        if job.attempts < JOB_MAX_ATTEMPTS:
+            delay = JOB_RETRY_DELAY * 2 ** (job.attempts - 1)
+            await self.persist(job, "retrying", message)
+            JOBS.inc(job=job.name, result="retried")
+            logger.warning("Job failed, retrying", job=job.name, job_id=job.id, user_id=job.user_id,
+                           attempt=job.attempts, delay=delay, error=message)
+            asyncio.get_running_loop().call_later(delay, self.queue.put_nowait, job)
+        else:
+            await self.persist(job, "failed", message)
+            JOBS.inc(job=job.name, result="failed")
+            self.active.pop(job.id, None)
+            logger.error("Job failed", job=job.name, job_id=job.id, user_id=job.user_id, attempts=job.attempts, error=message)
+
+    async def persist(self, job: Job, status: str, error: str = None):
+        await user_doc_ref(job.user_id).update({f"jobs.{job.id}": {
+            "name": job.name,
+            "key": job.key,
+            "arguments": job.arguments,
+            "status": status,
+            "attempts": job.attempts,
+            "error": error,
+            "updated": time.time(),
+        }})
+
+    async def resume(self, user_id: str, jobs: dict):
+        """
+        Queue the jobs of a user that a previous worker did not finish, and remove old finished jobs
+        - user_id: the user's Firebase ID (str)
+        - jobs: the `jobs` map of the user document (dict)
+        """
+        expired = {}
+        for existing_id, record in jobs.items():
+            if record.get("status") in UNFINISHED and record.get("name") in JOB_HANDLERS:
+                self.submit(Job(record["name"], user_id, record["key"], record.get("arguments", {}), record.get("attempts", 0)))
+            elif record.get("status") in FINISHED and time.time() - record.get("updated", 0) > JOB_RETENTION:
+                expired[f"jobs.{existing_id}"] = DELETE_FIELD
+        if expired:
+            await user_doc_ref(user_id).update(expired)
+
+    async def close(self):
+        # Give queued jobs some time to finish; unfinished ones are resumed when their user reconnects
+        if not self.workers:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), JOB_SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Stopping with unfinished jobs", jobs=len(self.active))
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
+
+
+def enqueue_function_calls(user_id: str, session_id: str, state):
+    """
+    Queue the `function_calls` of a dialogue state, once per session, after the user completed the state
+    - state: the completed state (DialogueState)
+    """
+    for name in state.function_calls or []:
+        if name in JOB_HANDLERS:
+            JobQueue().enqueue(name, user_id, f"{session_id}:{state.id}", session_id=session_id)
+        else:
+            logger.warning("No job for function call", function=name, state=state.id)
+
+
+# Jobs -----------------------------------------------------------------------------------------
+@job("summarize")
+async def summarize(user_id: str, session_id: str):
+    # Summarize the session so far into the user's `gpt-summary`
+    messages = await asyncio.to_thread(fetch_message_history, user_id, session_id)
+    dialogue_history = [to_annotated_response(message) for message in messages if is_dialogue_message(message)]
+    summary = await CustomTransitionFunctions().summarize(dialogue_history)
+    await user_doc_ref(user_id).set({"gpt-summary": summary}, merge=True)
+
+
+@job("save_summary")
+async def save_summary(user_id: str, description: str):
+    # Save the summary written by the `finish` tool
+    await user_doc_ref(user_id).set({"gpt-summary": description}, merge=True)
@@ -0,0 +1,327 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+# This file defines the backends that send the chat completion requests of OpenAIClient, selected
+# with LLM_BACKEND:
+# - live: send every request to the API (default)
+# - record: send every request to the API and save the request and response to a file store
+# - replay: answer requests from the file store, without any network access
+# - fake: answer requests with generated strategies, decisions, tool calls and replies
+# Replay and fake wait for a synthetic latency (LLM_SYNTHETIC_LATENCY) before answering, so that
+# turns can be benchmarked end-to-end offline.
+
+import os
+import re
+import json
+import time
+import random
+import asyncio
+import hashlib
+from datetime import date, timedelta
+from openai.types.chat import ChatCompletion, ChatCompletionMessage
+
+from logs import get_logger
+logger = get_logger("llm")
+
+BACKEND = os.getenv("LLM_BACKEND", "live")
+RECORDINGS_DIRECTORY = os.getenv("LLM_RECORDINGS_DIRECTORY", "../llm_recordings")
+# e.g., "none", "constant:0.5", "uniform:0.2:1.5", "lognormal:0.8:0.5" (median and sigma) or
+# "recorded" (the latency measured while recording, only for replay), in seconds
+SYNTHETIC_LATENCY = os.getenv("LLM_SYNTHETIC_LATENCY", "recorded" if BACKEND == "replay" else "none")
+# What replay does with requests that were not recorded: "fake" answers them, "error" raises
+REPLAY_MISSES = os.getenv("LLM_REPLAY_MISSES", "fake")
+FAKE_SEED = os.getenv("LLM_FAKE_SEED", "0")
+
+# How often the fake backend answers with a tool call when tools are offered but not forced
+FAKE_TOOL_CALL_PROBABILITY = 0.3
+FAKE_REPLIES = [
+    "That sounds like a great start. What would you like to focus on this week?",
+    "Thanks for sharing that. How did that make you feel?",
+    "It looks like you have been quite active lately. Would you like to look at your data together?",
+    "Would it be okay if I shared a suggestion that has worked well for others?",
+    "Let's set a small goal for the next few days. What seems realistic to you?",
+]
+FAKE_STAGE_ANSWERS = {
+    "classify_state": ["continue", "completed"],
+}
+# Items of the fake memory updates (see gpt/memory.py)
+FAKE_MEMORY_ITEMS = {
+    "facts": ["Works from home on weekdays", "Has a dog that needs two walks a day", "Used to play soccer in college"],
+    "goals": ["Walk 8,000 steps a day", "Exercise three times a week"],
+    "barriers": ["Long work days", "Knee pain after running"],
+    "plan": ["Walk the dog for 20 minutes every morning", "Try a beginner yoga class on Saturday"],
+}
+
+DATE_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+
+class RecordingNotFound(LookupError):
+    pass
+
+
+def normalize_message(message) -> dict:
+    # Keep the fields that determine the response, in a stable format. Messages may be dicts,
+    # ChatCompletionMessage objects, or dicts holding ChatCompletionMessageToolCall objects.
+    if hasattr(message, "model_dump"):
+        message = message.model_dump(exclude_none=True)
+    normalized = {"role": message.get("role")}
+    content = message.get("content")
+    if content:
+        content = " ".join(str(content).split())
+        if message.get("role") == "system":
+            # System prompts contain today's date, which would make every recording expire after a day
+            content = DATE_PATTERN.sub("<date>", content)
+        normalized["content"] = content
+    for field in ["name", "tool_call_id"]:
+        if message.get(field):
+            normalized[field] = message[field]
+    if message.get("tool_calls"):
+        normalized["tool_calls"] = []
+        for tool_call in message["tool_calls"]:
+            if hasattr(tool_call, "model_dump"):
+                tool_call = tool_call.model_dump()
+            normalized["tool_calls"].append({"name": tool_call["function"]["name"],
+                                             "arguments": tool_call["function"]["arguments"]})
+    return normalized
+
+
+def normalize_request(request: dict) -> dict:
+    # The model and request settings are left out, so that recordings survive routing changes
+    return {
+        "messages": [normalize_message(message) for message in request["messages"]],
+        "tools": request.get("tools") or [],
+        "tool_choice": request.get("tool_choice") or "auto",
+    }
+
+
+def request_key(request: dict) -> str:
+    return hashlib.sha256(json.dumps(normalize_request(request), sort_keys=True).encode()).hexdigest()
+
+
+class LatencyModel:
+    """
+    A distribution of synthetic response times
+    - spec: the distribution and its parameters in seconds (str), e.g., "uniform:0.2:1.5", see SYNTHETIC_LATENCY
+    """
+    def __init__(self, spec: str = "none"):
+        name, *parameters = spec.split(":")
+        self.name = name
+        self.parameters = [float(parameter) for parameter in parameters]
+        if name not in ["none", "recorded", "constant", "uniform", "normal", "lognormal"]:
+            raise ValueError(f"Unknown latency distribution: {spec}")
+
+    def sample(self, recorded: float = None) -> float:
+        if self.name == "recorded":
+            return recorded or 0.0
+        if self.name == "constant":
+            return self.parameters[0]
+        if self.name == "uniform":
+            return random.uniform(*self.parameters)
+        if self.name == "normal":
+            return max(random.gauss(*self.parameters), 0.0)
+        if self.name == "lognormal":
+            median, sigma = self.parameters
+            return random.lognormvariate(0, sigma) * median
+        return 0.0
+
+
+class StoredResponse:
+    # Stands in for the raw response of the openai client (see OpenAIClient.chat_completion and LLMScheduler.run)
+    def __init__(self, completion: dict, headers: dict = None):
+        self.completion = completion
+        self.headers = headers or {}
+
+    def parse(self) -> ChatCompletion:
+        return ChatCompletion.model_validate(self.completion)
+
+
+class RecordingStore:
+    """
+    Recorded requests and responses, one JSON file per request key
+    - directory: the directory holding the recordings (str)
+    """
+    def __init__(self, directory: str = RECORDINGS_DIRECTORY):
+        self.directory = directory
+        self.recordings = {}  # request key -> recording, for the recordings read so far
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def load(self, key: str) -> dict:
+        if key not in self.recordings:
+            if not os.path.exists(self.path(key)):
+                return None
+            with open(self.path(key), "r") as file:
+                self.recordings[key] = json.load(file)
+        return self.recordings[key]
+
+    def save(self, key: str, recording: dict):
+        os.makedirs(self.directory, exist_ok=True)
+        # Write to a temporary file first so that concurrent readers never see a partial recording
+        temporary_path = f"{self.path(key)}.{os.getpid()}.tmp"
+        with open(temporary_path, "w") as file:
+            json.dump(recording, file, indent=2)
+        os.replace(temporary_path, self.path(key))
+        self.recordings[key] = recording
+
+
+class LiveBackend:
+    def __init__(self, client):
+        self.client = client
+
+    async def create(self, stage: str, **request):
+        return await self.client.chat.completions.with_raw_response.create(**request)
+
+
+class RecordingBackend(LiveBackend):
+    def __init__(self, client, store: RecordingStore):
+        super().__init__(client)
+        self.store = store
+
+    async def create(self, stage: str, **request):
+        start_time = time.perf_counter()
+        raw_response = await super().create(stage, **request)
+        self.store.save(request_key(request), {
+            "stage": stage,
+            "request": normalize_request(request),
+            "response": raw_response.parse().model_dump(exclude_none=True),
+            "latency": time.perf_counter() - start_time,
+        })
+        return raw_response
+
+
+class FakeBackend:
+    """
+    Generates responses that the turn pipeline accepts: a strategy for predict_strategy, one of the
+    expected answers for the yes/no and continue/completed decisions, tool calls whose arguments
+    follow the tools' JSON schemas, and canned replies otherwise. The same request always gets the
+    same response.
+    - latency: the synthetic response time (LatencyModel)
+    - seed: changes all generated responses (str)
+    """
+    def __init__(self, latency: LatencyModel, seed: str = FAKE_SEED):
+        self.latency = latency
+        self.seed = seed
+
+    async def create(self, stage: str, **request):
+        rng = random.Random(f"{self.seed}:{request_key(request)}")
+        await asyncio.sleep(self.latency.sample())
+
+        message = self.fake_message(stage, request, rng)
+        prompt_tokens = sum(len(str(normalize_message(m).get("content", ""))) for m in request["messages"]) // 4
+        completion_tokens = len(json.dumps(message)) // 4
+        return StoredResponse({
+            "id": f"chatcmpl-fake-{rng.getrandbits(64):x}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request["model"],
+            "choices": [{"index": 0, "message": message,
+                         "finish_reason": "tool_calls" if message.get("tool_calls") else "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+    def fake_message(self, stage: str, request: dict, rng: random.Random) -> dict:
+        tools = request.get("tools") or []
+        tool_choice = request.get("tool_choice")
+        if tools and (isinstance(tool_choice, dict) or (tool_choice == "auto" and rng.random() < FAKE_TOOL_CALL_PROBABILITY)):
+            if isinstance(tool_choice, dict):
+                tools = [tool for tool in tools if tool["function"]["name"] == tool_choice["function"]["name"]] or tools
+            tool = rng.choice(tools)["function"]
+            return {"role": "assistant", "content": None, "tool_calls": [{
+                "id": f"call_{rng.getrandbits(64):x}",
+                "type": "function",
+                "function": {"name": tool["name"],
+                             "arguments": json.dumps(fake_arguments(tool.get("parameters", {}), rng))},
+            }]}
+
+        if stage == "predict_strategy":
+            # Imported here since gpt.messages imports this module through the client
+            from gpt.messages import STRATEGIES
+            content = rng.choice(STRATEGIES)
+        elif stage == "update_memory":
+            content = json.dumps({name: rng.sample(items, rng.randint(1, len(items))) for name, items in FAKE_MEMORY_ITEMS.items()})
+        elif stage in FAKE_STAGE_ANSWERS:
+            content = rng.choice(FAKE_STAGE_ANSWERS[stage])
+        else:
+            content = rng.choice(FAKE_REPLIES)
+        return {"role": "assistant", "content": content}
+
+
+class ReplayBackend:
+    """
+    Answers requests with the recorded responses
+    - store: the recordings (RecordingStore)
+    - latency: the synthetic response time (LatencyModel)
+    - fallback: the backend answering requests that were not recorded (FakeBackend, optional);
+      without it, such requests raise RecordingNotFound
+    """
+    def __init__(self, store: RecordingStore, latency: LatencyModel, fallback: FakeBackend = None):
+        self.store = store
+        self.latency = latency
+        self.fallback = fallback
+        self.hits = 0
+        self.misses = 0
+
+    async def create(self, stage: str, **request):
+        key = request_key(request)
+        recording = self.store.load(key)
+        if recording is None:
+            self.misses += 1
+            logger.warning("No recording for the request", stage=stage, key=key[:12], misses=self.misses, hits=self.hits)
+            if self.fallback is None:
+                raise RecordingNotFound(f"No recording for the {stage} request {key}")
+            return await self.fallback.create(stage, **request)
+
+        self.hits += 1
+        await asyncio.sleep(self.latency.sample(recording.get("latency")))
+        return StoredResponse(recording["response"])
+
+
+def fake_arguments(schema: dict, rng: random.Random) -> dict:
+    required = schema.get("required", [])
+    arguments = {name: fake_value(name, property_schema, rng)
+                 for name, property_schema in schema.get("properties", {}).items()
+                 if name in required or rng.random() < 0.5}
+    if isinstance(arguments.get("start"), str) and isinstance(arguments.get("end"), str):
+        arguments["start"], arguments["end"] = sorted([arguments["start"], arguments["end"]])
+    return arguments
+
+
+def fake_value(name: str, schema: dict, rng: random.Random):
+    if "enum" in schema:
+        return rng.choice(schema["enum"]) if schema["enum"] else ""
+    value_type = schema.get("type", "string")
+    if value_type == "object":
+        return fake_arguments(schema, rng)
+    if value_type == "array":
+        return [fake_value(name, schema.get("items", {}), rng) for _ in range(rng.randint(1, 3))]
+    if value_type == "integer":
+        return rng.randint(schema.get("minimum", 0), schema.get("maximum", 10))
+    if value_type == "number":
+        return round(rng.uniform(schema.get("minimum", 0), schema.get("maximum", 10)), 2)
+    if value_type == "boolean":
+        return rng.random() < 0.5
+    if "YYYY-MM-DD" in schema.get("description", "") or schema.get("format") == "date":
+        return (date.today() - timedelta(days=rng.randint(0, 30))).isoformat()
+    return rng.choice(["walking", "sleep", "today", "this week"])
+
+
+def create_backend(client, backend: str = BACKEND):
+    """
+    Create the backend that sends the chat completion requests
+    - client: the openai client used by the live and record backends (openai.AsyncClient)
+    - backend: "live", "record", "replay" or "fake" (str)
+    """
+    latency = LatencyModel(SYNTHETIC_LATENCY)
+    if backend == "live":
+        return LiveBackend(client)
+    if backend == "record":
+        return RecordingBackend(client, RecordingStore())
+    if backend == "replay":
+        fallback = FakeBackend(LatencyModel("none") if latency.name == "recorded" else latency) if REPLAY_MISSES == "fake" else None
+        return ReplayBackend(RecordingStore(), latency, fallback)
+    if backend == "fake":
+        return FakeBackend(latency)
+    raise ValueError(f"Unknown LLM backend: {backend}")
@@ -0,0 +1,171 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+# This file defines a CPU-only classifier tier for the per-turn decisions that are pure classification
+# (strategy prediction and state completion). Models are trained offline from logged
+# conversations (see scripts/train_local_classifiers.py). When a model is confident enough, its answer
+# is used and the LLM call is skipped; otherwise the caller falls back to the LLM.
+
+import os
+import re
+import json
+import math
+from collections import Counter
+
+from firebase import str_to_bool
+from logs import get_logger
+logger = get_logger("classifiers")
+
+CLASSIFIER_DIRECTORY = os.getenv("LOCAL_CLASSIFIER_DIRECTORY", "gpt/classifiers")
+USE_LOCAL_CLASSIFIERS = str_to_bool(os.getenv("USE_LOCAL_CLASSIFIERS", "True"))
+# Overrides the confidence threshold stored in every artifact
+THRESHOLD_OVERRIDE = float(os.getenv("LOCAL_CLASSIFIER_THRESHOLD")) if os.getenv("LOCAL_CLASSIFIER_THRESHOLD") else None
+ARTIFACT_FORMAT = "gptcoach-naive-bayes-v1"
+TASKS = ["strategy", "state_completion"]
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9']+")
+
+
+# Features ----------------------------------------------------------------------------------
+# The same functions build the input text during training and at inference time.
+def tokenize(text: str, prefix: str) -> list[str]:
+    words = TOKEN_PATTERN.findall((text or "").lower())
+    return [f"{prefix}:{w}" for w in words] + [f"{prefix}:{a}_{b}" for a, b in zip(words, words[1:])]
+
+def last_assistant_message(history: list) -> str:
+    for message in reversed(history):
+        if message.get("role") == "assistant" and message.get("content"):
+            return message["content"]
+    return ""
+
+def strategy_features(state_id: str, history: list, user_message: str) -> list[str]:
+    # history: messages before the user message, in GPT format (dicts with role and content)
+    return [f"state:{state_id}"] + tokenize(last_assistant_message(history), "a") + tokenize(user_message, "u")
+
+def state_completion_features(state_id: str, history: list) -> list[str]:
+    # history: messages up to and including the latest user message
+    user_message = history[-1].get("content", "") if history else ""
+    return [f"state:{state_id}"] + tokenize(last_assistant_message(history[:-1]), "a") + tokenize(user_message, "u")
+
+
+# Model -------------------------------------------------------------------------------------
+class NaiveBayesClassifier:
+    """
+    Multinomial naive Bayes over unigram and bigram features.
+    Artifacts are JSON files with the following fields:
+    - format: ARTIFACT_FORMAT (str)
+    - task: the decision this model makes (str), one of TASKS
+    - labels: the class labels (list[str])
+    - log_priors: log prior of each label (list[float])
+    - feature_log_probs: log likelihood of each feature under each label (dict[str, list[float]])
+    - threshold: minimum confidence needed to answer locally (float)
+    - metadata: training and evaluation details (dict)
+    """
+    def __init__(self, task: str, labels: list[str], log_priors: list[float], feature_log_probs: dict,
+                 threshold: float = 1.0, metadata: dict = None):
+        self.task = task
+        self.labels = labels
+        self.log_priors = log_priors
+        self.feature_log_probs = feature_log_probs
+        self.threshold = threshold
+        self.metadata = metadata or {}
+
+    @classmethod
+    def train(cls, task: str, examples: list[tuple[list[str], str]], alpha: float = 1.0, min_count: int = 2) -> "NaiveBayesClassifier":
+        # examples: list of (features, label) pairs
+        labels = sorted({label for _, label in examples})
+        label_counts = Counter(label for _, label in examples)
+        feature_counts = Counter(feature for features, _ in examples for feature in set(features))
+        vocabulary = sorted(f for f, count in feature_counts.items() if count >= min_count)
+        index = {f: i for i, f in enumerate(vocabulary)}
+
+        counts = [[0] * len(vocabulary) for _ in labels]
+        for features, label in examples:
+            row = counts[labels.index(label)]
+            for feature in features:
+                if feature in index:
+                    row[index[feature]] += 1
+
+        log_priors = [math.log(label_counts[label] / len(examples)) for label in labels]
+        totals = [sum(row) + alpha * (len(vocabulary) + 1) for row in counts]
+        feature_log_probs = {
+            feature: [round(math.log((counts[j][i] + alpha) / totals[j]), 5) for j in range(len(labels))]
+            for feature, i in index.items()
+        }
+        return cls(task, labels, log_priors, feature_log_probs)
+
+    def predict_proba(self, features: list[str]) -> dict[str, float]:
+        scores = list(self.log_priors)
+        for feature in features:
+            log_probs = self.feature_log_probs.get(feature)
+            if log_probs is None:
+                # Features that were not seen during training carry no information
+                continue
+            for j, log_prob in enumerate(log_probs):
+                scores[j] += log_prob
+        top = max(scores)
+        exp_scores = [math.exp(score - top) for score in scores]
+        total = sum(exp_scores)
+        return {label: p / total for label, p in zip(self.labels, exp_scores)}
+
+    def predict(self, features: list[str]) -> tuple[str, float]:
+        probabilities = self.predict_proba(features)
+        label = max(probabilities, key=probabilities.get)
+        return label, probabilities[label]
+
+    def save(self, file_path: str):
+        with open(file_path, "w") as file:
+            json.dump({
+                "format": ARTIFACT_FORMAT,
+                "task": self.task,
+                "labels": self.labels,
+                "log_priors": self.log_priors,
+                "feature_log_probs": self.feature_log_probs,
+                "threshold": self.threshold,
+                "metadata": self.metadata,
+            }, file)
+
+    @classmethod
+    def load(cls, file_path: str) -> "NaiveBayesClassifier":
+        with open(file_path, "r") as file:
+            data = json.load(file)
+        if data.get("format") != ARTIFACT_FORMAT:
+            raise ValueError(f"Unsupported classifier format in {file_path}: {data.get('format')}")
+        return cls(data["task"], data["labels"], data["log_priors"], data["feature_log_probs"],
+                   data["threshold"], data.get("metadata"))
+
+
+class LocalClassifiers:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = object.__new__(cls)
+            cls._instance.models = {}
+            if USE_LOCAL_CLASSIFIERS:
+                cls._instance.load()
+        return cls._instance
+
+    def load(self, directory: str = CLASSIFIER_DIRECTORY):
+        # Load whichever artifacts exist. Tasks without an artifact always fall back to the LLM.
+        for task in TASKS:
+            file_path = os.path.join(directory, f"{task}.json")
+            if os.path.exists(file_path):
+                self.models[task] = NaiveBayesClassifier.load(file_path)
+                logger.info("Loaded local classifier", task=task, threshold=self.models[task].threshold)
+
+    def predict(self, task: str, features: list[str], threshold: float = None):
+        """
+        Return the locally predicted label for `task`, or None if there is no model for the task or
+        its confidence is below the threshold (the given one, else LOCAL_CLASSIFIER_THRESHOLD, else the artifact's).
+        """
+        model = self.models.get(task)
+        if model is None:
+            return None
+        label, confidence = model.predict(features)
+        threshold = threshold or THRESHOLD_OVERRIDE or model.threshold
+        if confidence < threshold:
+            return None
+        logger.debug("Local classifier decision", task=task, label=label, confidence=round(confidence, 3))
+        return label
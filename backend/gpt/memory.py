@@ -0,0 +1,228 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+# This file defines a compact memory of each user's conversations: key facts, goals, barriers and the
+# plan, stored in the `gpt-memory` field of the user document. It is updated by a background job (see
+# gpt/jobs.py) that folds the turns since the last update into it, every few turns and whenever a
+# dialogue state is completed. The context window (see gpt/context.py) puts the memory after the shared
+# system prompt and, once the prompt gets too long, leaves out the raw turns it covers, so prompts stop
+# growing with the conversation, and a returning user's new session starts from what the coach already knows.
+
+import os
+import re
+import json
+import time
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from gpt.openai_client import OpenAIClient
+from gpt.prompts import PromptRegistry
+from gpt.jobs import job, job_id, JobQueue, user_doc_ref, FINISHED
+from gpt.utils import fetch_message_history, is_dialogue_message, to_gpt_message
+from logs import get_logger, log_payload
+logger = get_logger("memory")
+prompt_logger = get_logger("prompts")
+openai_client = OpenAIClient()
+prompt_registry = PromptRegistry()
+
+MEMORY_FIELD = "gpt-memory"
+# The memory is updated once this many user turns are not covered by it
+MEMORY_UPDATE_TURNS = int(os.getenv("MEMORY_UPDATE_TURNS", "3"))
+MEMORY_MAX_ITEMS = int(os.getenv("MEMORY_MAX_ITEMS", "8"))
+MEMORY_MAX_ITEM_CHARS = 200
+# Sessions whose progress is kept, so that late updates of an earlier session do not fold it in twice
+MEMORY_MAX_SESSIONS = 5
+# Tool results in the conversation sent to the memory update are truncated to this many characters
+MEMORY_TOOL_RESULT_CHARS = 300
+# Memories kept in this worker, the least recently used are dropped (and read again on connect)
+MEMORY_CACHE_SIZE = int(os.getenv("MEMORY_CACHE_SIZE", "1000"))
+
+# Section of the memory -> heading in the prompt
+MEMORY_SECTIONS = {
+    "facts": "Key facts",
+    "goals": "Goals",
+    "barriers": "Barriers",
+    "plan": "Plan",
+}
+
+JSON_OBJECT_PATTERN = re.compile(r"\{.*\}", re.DOTALL)
+
+
+class ConversationMemory:
+    """
+    What the coach remembers about a user
+    - sections: the items of each section of MEMORY_SECTIONS (dict of str -> list of str)
+    - sessions: the number of dialogue messages of each session that are folded into the memory (dict of str -> int)
+    - summary: the summary written by the summarize job or the `finish` tool (str, optional)
+    """
+    def __init__(self, sections: dict = None, sessions: dict = None, summary: str = None, updated: float = None):
+        self.sections = {name: list((sections or {}).get(name, [])) for name in MEMORY_SECTIONS}
+        self.sessions = dict(sessions or {})
+        self.summary = summary
+        self.updated = updated
+
+    @classmethod
+    def from_user_data(cls, user_data: dict) -> "ConversationMemory":
+        stored = user_data.get(MEMORY_FIELD) or {}
+        return cls(stored.get("sections"), stored.get("sessions"), user_data.get("gpt-summary"), stored.get("updated"))
+
+    def to_dict(self) -> dict:
+        return {"sections": self.sections, "sessions": self.sessions, "updated": self.updated}
+
+    def is_empty(self) -> bool:
+        return not self.summary and not any(self.sections.values())
+
+    def covers(self, session_id: str) -> int:
+        # The number of dialogue messages of the session at the start of its history that the memory covers
+        return self.sessions.get(session_id, 0)
+
+    def render(self) -> str:
+        # The system message that stands in for the covered turns and earlier sessions, or None if there is nothing to remember
+        if self.is_empty():
+            return None
+        lines = ["What you remember about the client from earlier in this and previous conversations:"]
+        if self.summary:
+            lines.append(f"Summary: {self.summary}")
+        for name, heading in MEMORY_SECTIONS.items():
+            if self.sections[name]:
+                lines.append(f"{heading}:")
+                lines.extend(f"- {item}" for item in self.sections[name])
+        return "\n".join(lines)
+
+
+def parse_sections(content: str) -> dict:
+    # The sections of the LLM's JSON answer, capped to MEMORY_MAX_ITEMS short items each
+    match = JSON_OBJECT_PATTERN.search(content or "")
+    if not match:
+        raise ValueError(f"The memory update is not a JSON object: {content!r:.200}")
+    data = json.loads(match.group(0))
+    sections = {}
+    for name in MEMORY_SECTIONS:
+        items = data.get(name) or []
+        if isinstance(items, str):
+            items = [items]
+        sections[name] = [str(item)[:MEMORY_MAX_ITEM_CHARS] for item in items if item][:MEMORY_MAX_ITEMS]
+    return sections
+
+
+def format_conversation(messages: list) -> str:
+    lines = []
+    for message in messages:
+        content = message.get("content") or ""
+        if message.get("role") == "tool":
+            if len(content) > MEMORY_TOOL_RESULT_CHARS:
+                content = content[:MEMORY_TOOL_RESULT_CHARS] + "... (truncated)"
+            lines.append(f"{message.get('name')} returned: {content}")
+        elif content:
+            lines.append(f"{message.get('role')}: {content}")
+    return "\n".join(lines)
+
+
+class UserMemories:
+    # The memories of the connected users, kept up to date by the memory update job
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = object.__new__(cls)
+            cls._instance.memories = OrderedDict()  # user ID -> ConversationMemory
+            cls._instance.locks = {}  # user ID -> [lock serializing the updates, number of updates holding or waiting for it]
+        return cls._instance
+
+    def get(self, user_id: str) -> ConversationMemory:
+        memory = self.memories.get(user_id)
+        if memory is None:
+            return ConversationMemory()
+        self.memories.move_to_end(user_id)
+        return memory
+
+    def put(self, user_id: str, memory: ConversationMemory):
+        self.memories[user_id] = memory
+        self.memories.move_to_end(user_id)
+        while len(self.memories) > MEMORY_CACHE_SIZE:
+            self.memories.popitem(last=False)
+
+    @asynccontextmanager
+    async def updating(self, user_id: str):
+        # Hold the lock of the user's memory updates. Locks are removed once no update needs them.
+        entry = self.locks.setdefault(user_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[user_id]
+
+    def load(self, user_id: str, user_data: dict, session_id: str):
+        """
+        Keep the memory of a user who connected, and fold in the rest of the previous session if needed
+        - user_data: the user document (dict), which the websocket endpoint already read
+        - session_id: the session the user continues or starts (str)
+        """
+        memory = ConversationMemory.from_user_data(user_data)
+        self.put(user_id, memory)
+        # In case the worker of the previous session stopped before folding in its last turns. Only the most
+        # recent session is checked (session IDs sort by their start time), the earlier ones were checked when
+        # the user connected after them.
+        previous_session_ids = [previous_session_id for previous_session_id in memory.sessions if previous_session_id != session_id]
+        if not previous_session_ids:
+            return
+        previous_session_id = max(previous_session_ids)
+        key = f"{previous_session_id}:{memory.sessions[previous_session_id]}:end"
+        if user_data.get("jobs", {}).get(job_id("update_memory", key), {}).get("status") in FINISHED:
+            # Already checked since the memory was last updated
+            return
+        JobQueue().enqueue("update_memory", user_id, key, session_id=previous_session_id)
+
+    def maybe_update(self, user_id: str, session_id: str, history: list, force: bool = False):
+        """
+        Queue an update of the memory if enough turns of the session are not covered by it
+        - history: the dialogue messages of the session (list of dict), see ConversationSession.history_for_gpt
+        - force: update even if fewer than MEMORY_UPDATE_TURNS turns are new (bool), e.g., after completing a state
+        """
+        job_queue = JobQueue()
+        if any(job.name == "update_memory" and job.user_id == user_id for job in job_queue.active.values()):
+            # The queued update folds in these turns too
+            return
+        covered = self.get(user_id).covers(session_id)
+        new_turns = sum(1 for message in history[covered:] if message.get("role") == "user")
+        if new_turns and (force or new_turns >= MEMORY_UPDATE_TURNS):
+            job_queue.enqueue("update_memory", user_id, f"{session_id}:{len(history)}", session_id=session_id)
+
+
+@job("update_memory")
+async def update_memory(user_id: str, session_id: str):
+    # Fold the dialogue messages of a session that the memory does not cover yet into it
+    memories = UserMemories()
+    async with memories.updating(user_id):
+        # Read the stored memory, in case another worker updated it
+        user_data = (await user_doc_ref(user_id).get()).to_dict() or {}
+        memory = ConversationMemory.from_user_data(user_data)
+        history = await asyncio.to_thread(fetch_message_history, user_id, session_id)
+        messages = [to_gpt_message(message) for message in history if is_dialogue_message(message)]
+        start, end = memory.covers(session_id), len(messages)
+        if end <= start:
+            memories.put(user_id, memory)
+            return
+
+        prompt = prompt_registry.get("update_memory").render(
+            MEMORY=json.dumps(memory.sections, indent=1), CONVERSATION=format_conversation(messages[start:end]),
+            MAX_ITEMS=str(MEMORY_MAX_ITEMS))
+        log_payload(prompt_logger, "update_memory prompt", prompt, user_id=user_id)
+        response = await openai_client.chat_completion(stage="update_memory", messages=[{"role": "system", "content": prompt}])
+        content = response.choices[0].message.content
+        log_payload(prompt_logger, "update_memory response", content, user_id=user_id)
+
+        memory.sections = parse_sections(content)
+        memory.sessions[session_id] = end
+        # Keep the progress of the most recent sessions only (session IDs sort by their start time)
+        memory.sessions = dict(sorted(memory.sessions.items())[-MEMORY_MAX_SESSIONS:])
+        memory.updated = time.time()
+        await user_doc_ref(user_id).update({MEMORY_FIELD: memory.to_dict()})
+        memories.put(user_id, memory)
+        logger.info("Updated memory", user_id=user_id, session_id=session_id, covered=end,
+                    items=sum(len(items) for items in memory.sections.values()))
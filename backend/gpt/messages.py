@@ -2,6 +2,9 @@
 #
 # SPDX-License-Identifier: MIT
 
+import os
+import time
+import asyncio
 from fastapi import WebSocket
 
 from gpt.openai_client import OpenAIClient
@@ -11,94 +14,91 @@ from openai.types.chat import ChatCompletionMessage, ChatCompletionMessageToolCa
 from firebase_admin import firestore
 from google.cloud.firestore_v1 import ArrayUnion
 
-from datetime import datetime
-import pytz
-
 from gpt.functions import handle_function_call, get_functions_dict
 from gpt.dsm.annotated_response import AnnotatedResponse
 from gpt.dsm.dialogue_state_manager import DialogueStateManager
-from gpt.utils import write_message_to_db
+from gpt.utils import is_dialogue_message, to_annotated_response, to_gpt_message
+from gpt.session import ConversationSession
+from gpt.context import ContextWindow
+from gpt.local_classifier import LocalClassifiers, strategy_features
+from gpt.jobs import enqueue_function_calls
+from gpt.memory import UserMemories
+from gpt.prefetch import Prefetcher
+from data.compact import DEFAULT_MAX_CHARS
+from tracing import Tracer, traced
+from monitoring import TURN_SECONDS
+from logs import get_logger, log_payload
+logger = get_logger("turn")
+prompt_logger = get_logger("prompts")
+tracer = Tracer()
+local_classifiers = LocalClassifiers()
 
 from firebase import FirebaseManager
 firebase_manager = FirebaseManager()
 
-# Load system prompts
-with open("../prompts/system_prompt.txt", "r") as file:
-    GPT_SYSTEM_PROMPT = file.read()
-    GPT_SYSTEM_PROMPT = GPT_SYSTEM_PROMPT.replace("{DATE_STRING}", datetime.now(tz=pytz.timezone("US/Pacific")).strftime("%Y-%m-%d"))
-with open("../prompts/strategies.txt", "r") as file:
-    GPT_PROMPT_STRATEGIES = file.read()
-with open("../prompts/predict_strategy.txt", "r") as file:
-    GPT_PROMPT_PREDICT_STRATEGY = file.read()    
-with open("../prompts/generate_response.txt", "r") as file:
-    GPT_PROMPT_GENERATE_RESPONSE = file.read()    
-with open("../prompts/few_shot_function_calls.txt", "r") as file:
-    GPT_PROMPT_FEW_SHOT_FUNCTION_CALLS = file.read()        
-with open("../prompts/tool_call_use.txt", "r") as file:
-    GPT_PROMPT_TOOL_CALL_USE = file.read()    
-with open("../prompts/predict_tool_call_use.txt", "r") as file:
-    GPT_PROMPT_PREDICT_TOOL_CALL_USE = file.read()    
-
-with open("../prompts/predict_strategy_agent.txt", "r") as file:
-    AGENT_PROMPT_PREDICT_STRATEGY = file.read()
-with open("../prompts/generate_response_agent.txt", "r") as file:
-    AGENT_PROMPT_GENERATE_RESPONSE = file.read()
-with open("../prompts/tool_call_use_agent.txt", "r") as file:
-    AGENT_PROMPT_TOOL_CALL_USE = file.read()    
-with open("../prompts/predict_tool_call_use_agent.txt", "r") as file:
-    AGENT_PROMPT_PREDICT_TOOL_CALL_USE = file.read()    
+from gpt.prompts import PromptRegistry
+prompt_registry = PromptRegistry()
+
+# Maximum number of tool calls of one assistant message that run at the same time
+MAX_CONCURRENT_TOOL_CALLS = int(os.getenv("MAX_CONCURRENT_TOOL_CALLS", "4"))
+# Maximum number of messages in one page of the history (see `history_page`)
+MAX_HISTORY_PAGE = 200
+
+STRATEGIES = [
+    "Advise with Permission", 
+    "Affirm", 
+    "Facilitate", 
+    "Filler", 
+    "Giving Information", 
+    "Question", 
+    "Raise Concern", 
+    "Reflect", 
+    "Reframe", 
+    "Support", 
+    "Structure"
+]
 
 
 # Helper functions -----------------------------------------------------------------------------
-def fetch_message_history(user_id: str, session_id: str) -> list:
-    messages_doc_ref = firebase_manager.get_user_doc(user_id).collection('gpt-messages').document(session_id)
-    messages_doc = messages_doc_ref.get()
-
-    if not messages_doc.exists:
-        # Document does not exist - make an empty list
-        messages_doc_ref.set({"messages": []}, merge=True)
-        return []
-
-    return messages_doc.to_dict().get("messages", [])    
+async def run_tool_calls(tool_calls: list[ChatCompletionMessageToolCall], websocket: WebSocket, session: ConversationSession) -> list[str]:
+    """
+    Run the tool calls of one assistant message concurrently, at most MAX_CONCURRENT_TOOL_CALLS at a time.
+    Visualizations are sent to the websocket by each call as soon as it is ready.
+
+    Returns: the result of each tool call (list of str), in the order of `tool_calls`
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_TOOL_CALLS)
+
+    async def run_tool_call(tool_call: ChatCompletionMessageToolCall) -> str:
+        async with semaphore:
+            with tracer.span(f"tool.{tool_call.function.name}", arguments=tool_call.function.arguments) as span:
+                result = await handle_function_call(tool_call, websocket, session)
+                span.set(result_chars=len(result) if result is not None else 0)
+
+        await websocket.send_json({
+            "type": "loading",
+            "content": "Analyzing data..."
+        })
+
+        if result == None:
+            result = "I could not fetch anything because there was no data. Please don't be mad."
+
+        # Data descriptions are already compacted locally (see data/compact.py); this only guards other results
+        if len(result) > DEFAULT_MAX_CHARS:
+            logger.warning("Tool call result too long, truncating", tool=tool_call.function.name, characters=len(result))
+            result = result[:DEFAULT_MAX_CHARS] + "\n... (truncated)"
+        return result
+
+    # gather keeps the order of the tool calls, which the tool messages must follow
+    return await asyncio.gather(*(run_tool_call(tool_call) for tool_call in tool_calls))
 
 # Helper functions -----------------------------------------------------------------------------
 def get_annotated_message_history(messages: list):
-    dialogue_history = []
-    print("MESSAGES: ", messages)
-    tool_call_dict = None    
-    for msg in messages:
-        if msg.get('rewind') or msg.get('type') == 'visualization':
-            continue 
-        # Each message in messages has 'role', 'response', 'start_state', 'end_state', and 'transition' fields        
-        role = msg.get('role')        
-        response = msg.get('response')
-        start_state = msg.get('start_state', []) 
-        end_state = msg.get('end_state', [])
-        transition = msg.get('transition', None)
-        tool_calls = msg.get('tool_calls', None)
-
-        if role == "tool":
-            tool_call_dict = {'name': msg.get('name'), 'tool_call_id': msg.get('tool_call_id')}
-        # Create an AnnotatedResponse object for each message
-        annotated_response = AnnotatedResponse(role, response, start_state, end_state, transition, tool_calls, tool_call_dict)
-        dialogue_history.append(annotated_response)
-
-    return dialogue_history
+    return [to_annotated_response(msg) for msg in messages if is_dialogue_message(msg)]
 
 def get_message_history_for_gpt(messages: list):
     # Converts annotated messages to messages for gpt
-    dialogue_history = []
-    for msg in messages:
-        if msg.get('rewind') or msg.get('type') == 'visualization':
-            continue 
-        message_dict = {"role": msg.get('role'), "content": msg.get('response')}
-        if msg.get('tool_calls'):
-            message_dict["tool_calls"] = msg.get('tool_calls')
-        if msg.get('role') == "tool":
-            message_dict["tool_call_id"] = msg.get('tool_call_id')
-            message_dict["name"] = msg.get('name')
-        dialogue_history.append(message_dict)
-    return dialogue_history    
+    return [to_gpt_message(msg) for msg in messages if is_dialogue_message(msg)]
 
 
 def fetch_user_summary(user_id: str) -> str:
@@ -110,45 +110,72 @@ def write_user_summary_to_db(user_id: str, description: str):
     # Write the user's summary to firebase (assuming their document exists already)
     firebase_manager.get_user_doc(user_id).set({"gpt-summary": description}, merge=True)    
 
-def write_function_to_db(user_id: str, session_id: str, tool_call: ChatCompletionMessageToolCall, result, state_metadata=None):
-    messages_doc_ref = firebase_manager.get_user_doc(user_id).collection('gpt-messages').document(session_id)        
-
-    message_dict = {
-                "tool_call_id": tool_call.id,
-                "role": "tool",
-                "name": tool_call.function.name,
-                "response": result
-            }
-    
-    if state_metadata:
-        message_dict["start_state"] = state_metadata["start_state"]
-        message_dict["end_state"] = state_metadata["end_state"]
-        message_dict["transition"] = state_metadata["transition"]
-        message_dict["strategy"] = state_metadata["strategy"]
-
-    messages_doc_ref.update({
-        "messages": ArrayUnion([message_dict])
-    })
-
-async def get_gpt_response(user_id: str, messages: list, tool_call=True, force_tool_call=False):
+async def get_gpt_response(user_id: str, messages: list, tool_call=True, force_tool_call=False, stage="default", context: ContextWindow = None):
     # Send a list of messages to GPT and return the response
     if tool_call:
         response = await openai_client.chat_completion(
+            stage=stage,
+            context=context,
             messages=messages,
-            tools=get_functions_dict(user_id),
+            tools=await get_functions_dict(user_id),
             tool_choice={"type": "function", "function": {"name": "visualize"}} if force_tool_call else 'auto'
         )
     else:
         response = await openai_client.chat_completion(
+            stage=stage,
+            context=context,
             messages=messages        
         )
     return response
 
-async def resume_conversation(user_id: str, session_id: str, websocket: WebSocket):
-    # Resume a conversation with a user
-    print("Resuming conversation")
-    # Reset the frontend to clear the chat 
-    message_history = fetch_message_history(user_id, session_id)
+def replay_frames(messages: list) -> list[dict]:
+    # The frames showing the stored messages of a session in the chat, in order
+    frames = []
+    for message in messages:
+        if not message.get('rewind'):
+            if (message.get('role') != "tool") and (message.get('response')):  
+                # Handle tool call messages to not be sent to the frontend          
+                if ("NO RESPONE FROM GPT" not in message.get('response')) or ("Message: None" not in message.get('response')):   
+                    frames.append({
+                        "type": "message",
+                        "role": message.get('role'),
+                        "content": message.get('response'),
+                        "state": message.get('end_state'),
+                        "strategy": message.get('strategy')
+                    })
+            if (message.get('type')=="visualization") :
+                frames.append(message)
+    return frames
+
+
+def history_page(frames: list[dict], before: int, limit: int, initial: bool = False) -> dict:
+    """
+    Return one frame with up to `limit` history frames before position `before`
+    - frames: the frames replaying the session (list of dict), see `replay_frames`
+    - before: the position of the oldest message the client already shows (int), len(frames) for the latest page
+    - initial: whether this page replaces the chat of the client (bool), i.e., is sent on connect
+    """
+    before = max(0, min(before, len(frames)))
+    start = max(0, before - max(1, min(limit, MAX_HISTORY_PAGE)))
+    return {
+        "type": "history",
+        "messages": frames[start:before],
+        "start": start,
+        "total": len(frames),
+        "has_more": start > 0,
+        "initial": initial,
+    }
+
+
+@traced("resume", root=True)
+async def resume_conversation(session: ConversationSession, websocket: WebSocket, page_size: int = 0):
+    """
+    Resume a conversation with a user by replaying its history to the client
+    - page_size: 0 to send one frame per message after a reset frame, otherwise the number of latest messages
+      sent in a single `history` frame (int). Older messages are sent when the client asks for them, see `history_page`.
+    """
+    logger.info("Resuming conversation", user_id=session.user_id, session_id=session.session_id, page_size=page_size)
+    message_history = await asyncio.to_thread(session.load)
     if len(message_history) == 0:
         msg = "Hello, it's wonderful to meet you! I'm a health coaching chatbot and am excited that you're here to start this journey with me. How are you doing today?"
         intro_message = {
@@ -158,209 +185,131 @@ async def resume_conversation(user_id: str, session_id: str, websocket: WebSocke
             "strategy": "Filler",
             "content": msg
         }                
-        await websocket.send_json(intro_message)   
+        if not page_size:
+            await websocket.send_json(intro_message)   
         # Database parses text with key "response" not "content", which GPT uses, so we have to change it
-        write_message_to_db(user_id, session_id, {
+        await session.append({
             "type": "message", 
             "role": "assistant",
             "end_state": "root",
             "strategy": "Filler",
             "response": msg
         })        
+        session.replay = [intro_message]
 
     else:
-        reset_message = {
-            "type": "reset"
-        }
-        await websocket.send_json(reset_message) 
-        for message in message_history:
-            if not message.get('rewind'):
-                if (message.get('role') != "tool") and (message.get('response')):  
-                    # Handle tool call messages to not be sent to the frontend          
-                    if ("NO RESPONE FROM GPT" not in message.get('response')) or ("Message: None" not in message.get('response')):   
-                        await websocket.send_json({
-                            "type": "message",
-                            "role": message.get('role'),
-                            "content": message.get('response'),
-                            "state": message.get('end_state'),
-                            "strategy": message.get('strategy')
-                        })
-                if (message.get('type')=="visualization") :
-                    await websocket.send_json(message)      
-
-def update_message_from_db(user_id: str, session_id: str, message_idx, field, updated_value):
-    messages_doc_ref = firebase_manager.get_user_doc(user_id).collection('gpt-messages').document(session_id) 
-    messages_doc = messages_doc_ref.get()    
-    messages = messages_doc.to_dict().get("messages", [])   
-    
-    messages[message_idx][field] = updated_value
-    
-    messages_doc_ref.update({
-    "messages": messages
-    })    
-    messages_doc_ref = firebase_manager.get_user_doc(user_id).collection('gpt-messages').document(session_id) 
-    messages_doc = messages_doc_ref.get()
+        session.replay = replay_frames(message_history)
+        if not page_size:
+            # Reset the frontend to clear the chat 
+            reset_message = {
+                "type": "reset"
+            }
+            await websocket.send_json(reset_message) 
+            for frame in session.replay:
+                await websocket.send_json(frame)
+
+    if page_size:
+        # A single frame with the latest messages replaces the chat, so reconnecting costs the same however long the session is
+        await websocket.send_json(history_page(session.replay, len(session.replay), page_size, initial=True))
 
 
-async def rewind_conversation(user_id: str, session_id: str, websocket: WebSocket):
+@traced("rewind", root=True)
+async def rewind_conversation(session: ConversationSession, websocket: WebSocket):
     # Resume a conversation with a user    
-    message_history = fetch_message_history(user_id, session_id)
-    
-    # Update the rewind field of the last user message with rewind as False
-    for i in range(len(message_history) - 1, -1, -1):
-        message = message_history[i]
-        if (message.get('role') == "user") and (not message.get("rewind")):                        
-            user_msg_idx = i            
-            update_message_from_db(user_id, session_id, user_msg_idx, "rewind", True)            
-            break
-    
-    # Update the rewind field of all the messages after the last user message with rewind as False
-    for j in range(user_msg_idx, len(message_history)):
-        if not message.get("rewind"):  
-            update_message_from_db(user_id, session_id, j, "rewind", True)
+    user_id, session_id = session.user_id, session.session_id
+    # The rewind is stored with one write, and the pages of older messages no longer contain the rewound messages
+    await session.rewind()
+    session.replay = replay_frames(session.messages)
 
     # Send confirmation to the frontend to sync the rewind    
     await websocket.send_json({
         "type": "rewind_confirmation",
         "content": "success",
     })
-    print("Rewind confirmation sent to frontend")
-
-
-async def predict_strategy(user_id, user_message, annotated_system_prompt, message_history_for_gpt, prev_attempts=0, AGENT_PROMPT_PREDICT_STRATEGY=AGENT_PROMPT_PREDICT_STRATEGY):
-    STRATEGIES = [
-        "Advise with Permission", 
-        "Affirm", 
-        "Facilitate", 
-        "Filler", 
-        "Giving Information", 
-        "Question", 
-        "Raise Concern", 
-        "Reflect", 
-        "Reframe", 
-        "Support", 
-        "Structure"
-    ]
-    
-    system_prompt_strategy_prediction = " \n".join([GPT_SYSTEM_PROMPT, 
-                                                    annotated_system_prompt.response, 
-                                                    GPT_PROMPT_PREDICT_STRATEGY, 
-                                                    GPT_PROMPT_STRATEGIES])
-            
-    AGENT_PROMPT_PREDICT_STRATEGY = AGENT_PROMPT_PREDICT_STRATEGY.replace("{TASK}", annotated_system_prompt.response)        
-    AGENT_PROMPT_PREDICT_STRATEGY = AGENT_PROMPT_PREDICT_STRATEGY.replace("{STRATEGIES}", ', '.join(STRATEGIES))        
+    logger.info("Rewind confirmation sent to frontend", user_id=user_id, session_id=session_id)
+
+
+def build_stage_messages(stage: str, annotated_system_prompt: AnnotatedResponse, conversation: list, agent_prompt: str = None,
+                         examples: str = None) -> list:
+    # All stages of a turn start with the same system prompt and conversation, so the provider can reuse
+    # its prompt cache across stages. The stage-specific instructions (including the dialogue state prompt 
+    # and the few-shot examples selected for the turn) and the agent prompt go at the end.
+    stage_prompt = prompt_registry.stage_prompt(stage, annotated_system_prompt.end_state, annotated_system_prompt.response, examples)
+    messages = [{"role": "system", "content": prompt_registry.shared_system_prompt()}] + \
+                conversation + \
+                [{"role": "system", "content": stage_prompt}]
+    if agent_prompt:
+        messages.append({"role": "assistant", "content": agent_prompt})
+    return messages
+
+
+async def predict_strategy(user_id, user_message, annotated_system_prompt, message_history_for_gpt, context: ContextWindow, prev_attempts=0):
+    # Use the local classifier if it is confident enough, otherwise ask the LLM
+    if prev_attempts == 0:
+        local_strategy = local_classifiers.predict("strategy", strategy_features(annotated_system_prompt.end_state, message_history_for_gpt, user_message))
+        if local_strategy in STRATEGIES:
+            openai_client.metrics.record_local("predict_strategy")
+            return local_strategy
+
+    AGENT_PROMPT_PREDICT_STRATEGY = prompt_registry.get("predict_strategy_agent").render(TASK=annotated_system_prompt.response, 
+                                                                                         STRATEGIES=', '.join(STRATEGIES))
     
-    print("PREDICT STRATEGY SYSTEM PROMPT: ", system_prompt_strategy_prediction)
-    print("PREDICT STRATEGY AGENT PROMPT: ", AGENT_PROMPT_PREDICT_STRATEGY)
+    log_payload(prompt_logger, "predict_strategy agent prompt", AGENT_PROMPT_PREDICT_STRATEGY, user_id=user_id)
     # Message for strategy prediction that is being sent to GPT: Concats the system prompt, message history, user message, and a prompt for the user to select a strategy        
-    strategy_prediction_message = [{"role": "system", "content": system_prompt_strategy_prediction}] + \
-                            message_history_for_gpt + \
-                            [{"role": "user", "content": user_message}] + \
-                            [{"role": "assistant", "content": AGENT_PROMPT_PREDICT_STRATEGY}]
+    strategy_prediction_message = build_stage_messages("predict_strategy", annotated_system_prompt, 
+                                                       message_history_for_gpt + [{"role": "user", "content": user_message}], 
+                                                       AGENT_PROMPT_PREDICT_STRATEGY)
     
-    response = await get_gpt_response(user_id, strategy_prediction_message, tool_call=False)
+    response = await get_gpt_response(user_id, strategy_prediction_message, tool_call=False, stage="predict_strategy", context=context)
     strategy_prediction = response.choices[0].message.content
-    print("PREDICT STRATEGY MESSAGE: ", strategy_prediction)
+    logger.info("Predicted strategy", user_id=user_id, strategy=strategy_prediction)
     
     if strategy_prediction not in STRATEGIES:
         if prev_attempts < 3:
-            print("Strategy prediction failed. Trying again...")
-            return await predict_strategy(user_id, user_message, annotated_system_prompt, message_history_for_gpt, prev_attempts + 1)
+            logger.warning("Invalid strategy prediction, trying again", user_id=user_id, attempt=prev_attempts + 1)
+            return await predict_strategy(user_id, user_message, annotated_system_prompt, message_history_for_gpt, context, prev_attempts + 1)
         else:
             return "Filler" 
     return strategy_prediction 
 
 
-async def should_use_tool(user_id, strategy_description, annotated_system_prompt, message_history_for_gpt, prev_attempts=0, AGENT_PROMPT_TOOL_CALL_USE=AGENT_PROMPT_TOOL_CALL_USE):
-    TOOL_CALL_USE = [
-        "yes", 
-        "no"
-    ]
-
-    system_prompt_tool_call_use = " \n".join([GPT_SYSTEM_PROMPT, 
-                                              annotated_system_prompt.response, 
-                                              GPT_PROMPT_TOOL_CALL_USE,
-                                              GPT_PROMPT_FEW_SHOT_FUNCTION_CALLS
-                                              ])     
-
-    AGENT_PROMPT_TOOL_CALL_USE = AGENT_PROMPT_TOOL_CALL_USE.replace("{TASK}", annotated_system_prompt.response)
-    AGENT_PROMPT_TOOL_CALL_USE = AGENT_PROMPT_TOOL_CALL_USE.replace("{STRATEGY_DESCRIPTION}", strategy_description)
-    # Message for strategy prediction that is being sent to GPT: Concats the system prompt, message history, user message, and a prompt for the user to select a strategy        
-    
-    print("SHOULD USE TOOL SYSTEM PROMPT: ", system_prompt_tool_call_use)
-    print("SHOULD USE TOOL AGENT PROMPT: ", AGENT_PROMPT_TOOL_CALL_USE)
-
-    tool_call_use_message = [{"role": "system", "content": system_prompt_tool_call_use}] + \
-                            message_history_for_gpt + \
-                            [{"role": "assistant", "content": AGENT_PROMPT_TOOL_CALL_USE}]
-    
-    response = await get_gpt_response(user_id, tool_call_use_message, tool_call=False)
-    tool_call_use = response.choices[0].message.content.lower()    
-    print("SHOULD USE TOOL RESPONSE: ", tool_call_use)
-    
-    if tool_call_use not in TOOL_CALL_USE:
-        if prev_attempts < 3:
-            print("TOOL CALL prediction failed. Trying again...")
-            return await tool_call_use(user_id, strategy_description, annotated_system_prompt, message_history_for_gpt, prev_attempts + 1)
-        else:
-            return "no" 
-    return "yes"
-    return tool_call_use 
-
-async def generate_tool_call(user_id, strategy_description, annotated_system_prompt, message_history_for_gpt, AGENT_PROMPT_PREDICT_TOOL_CALL_USE=AGENT_PROMPT_PREDICT_TOOL_CALL_USE):
+async def generate_tool_call(user_id, strategy_description, annotated_system_prompt, message_history_for_gpt, context: ContextWindow, examples=None):
     # Predict the tool call to use based on the strategy and the GPT response
+    AGENT_PROMPT_PREDICT_TOOL_CALL_USE = prompt_registry.get("predict_tool_call_use_agent").render(TASK=annotated_system_prompt.response, 
+                                                                                                   STRATEGY_DESCRIPTION=strategy_description)
+
+    log_payload(prompt_logger, "generate_tool_call agent prompt", AGENT_PROMPT_PREDICT_TOOL_CALL_USE, user_id=user_id)
 
-        # Predict the response given the strategy
-    system_prompt_tool_call_prediction = " \n".join([GPT_SYSTEM_PROMPT, 
-                                                     annotated_system_prompt.response, 
-                                                     GPT_PROMPT_PREDICT_TOOL_CALL_USE, 
-                                                     GPT_PROMPT_FEW_SHOT_FUNCTION_CALLS]) 
-            
-    AGENT_PROMPT_PREDICT_TOOL_CALL_USE = AGENT_PROMPT_PREDICT_TOOL_CALL_USE.replace("{TASK}", annotated_system_prompt.response)                
-    AGENT_PROMPT_PREDICT_TOOL_CALL_USE = AGENT_PROMPT_PREDICT_TOOL_CALL_USE.replace("{STRATEGY_DESCRIPTION}", strategy_description)                
-
-    print("GENERATE TOOL CALL SYSTEM PROMPT: ", system_prompt_tool_call_prediction)
-    print("GENERATE TOOL CALL AGENT PROMPT: ", AGENT_PROMPT_PREDICT_TOOL_CALL_USE)
-
-    tool_call_prediction_message= [{"role": "system", "content": system_prompt_tool_call_prediction}] + \
-        message_history_for_gpt + \
-        [{"role": "assistant", "content": AGENT_PROMPT_PREDICT_TOOL_CALL_USE}]
+    tool_call_prediction_message = build_stage_messages("generate_tool_call", annotated_system_prompt, message_history_for_gpt, AGENT_PROMPT_PREDICT_TOOL_CALL_USE, examples)
         
-    response = await get_gpt_response(user_id, tool_call_prediction_message, tool_call=True, force_tool_call=True)  
-    print("GENERATE TOOL CALL RESPONSE:", response, "\n\n\n")    
+    response = await get_gpt_response(user_id, tool_call_prediction_message, tool_call=True, force_tool_call=True, stage="generate_tool_call", context=context)  
+    log_payload(prompt_logger, "generate_tool_call response", response, user_id=user_id)
     return response 
 
 
-async def predict_gpt_response(user_id, user_message, strategy, strategy_description, system_prompt_response_prediction, annotated_system_prompt, message_history_for_gpt, AGENT_PROMPT_GENERATE_RESPONSE=AGENT_PROMPT_GENERATE_RESPONSE):        
-        # Predict the response given the strategy
-   
-    AGENT_PROMPT_GENERATE_RESPONSE = AGENT_PROMPT_GENERATE_RESPONSE.replace("{TASK}", annotated_system_prompt.response)
-    AGENT_PROMPT_GENERATE_RESPONSE = AGENT_PROMPT_GENERATE_RESPONSE.replace("{STRATEGY_DESCRIPTION}", strategy_description)
-    AGENT_PROMPT_GENERATE_RESPONSE = AGENT_PROMPT_GENERATE_RESPONSE.replace("{STRATEGY}", strategy)
-    response_prediction_message = [{"role": "system", "content": system_prompt_response_prediction}] + \
-                        message_history_for_gpt + \
-                        [{"role": "user", "content": user_message}] + \
-                        [{"role": "assistant", "content": AGENT_PROMPT_GENERATE_RESPONSE}]
+async def predict_gpt_response(user_id, user_message, strategy, strategy_description, annotated_system_prompt, message_history_for_gpt, context: ContextWindow, examples=None):        
+    # Predict the response given the strategy
+    AGENT_PROMPT_GENERATE_RESPONSE = prompt_registry.get("generate_response_agent").render(TASK=annotated_system_prompt.response, 
+                                                                                           STRATEGY_DESCRIPTION=strategy_description, 
+                                                                                           STRATEGY=strategy)
+    response_prediction_message = build_stage_messages("generate_response", annotated_system_prompt, 
+                                                       message_history_for_gpt + [{"role": "user", "content": user_message}], 
+                                                       AGENT_PROMPT_GENERATE_RESPONSE, examples)
     
-    print("GPT RESPONSE SYSTEM PROMPT: ", system_prompt_response_prediction)
-    print("GPT RESPONSE AGENT PROMPT: ", AGENT_PROMPT_GENERATE_RESPONSE)
-
-    # print("RESPONSE PREDICTION")
-    # for msg in response_prediction_message:
-    #     print(f"{msg['role']}: {msg['content']}")
+    log_payload(prompt_logger, "generate_response agent prompt", AGENT_PROMPT_GENERATE_RESPONSE, user_id=user_id)
     
-    response = await get_gpt_response(user_id, response_prediction_message, tool_call=True)        
-    print("GPT RESPONSE MESSAGE: ", response)
+    response = await get_gpt_response(user_id, response_prediction_message, tool_call=True, stage="generate_response", context=context)        
+    log_payload(prompt_logger, "generate_response response", response, user_id=user_id)
     return response     
 
 DEMO = True
-async def process_message(user_message: str, user_id: str, session_id: str, dialogue_manager: DialogueStateManager, websocket: WebSocket):
+@traced("turn", root=True)
+async def process_message(user_message: str, session: ConversationSession, dialogue_manager: DialogueStateManager, websocket: WebSocket, budget_scale: float = 1.0):
     # Send the a message (from a specific user) to GPT
     # Send all frontend-bound function calls and response message back over the web socket
+    # `budget_scale` shrinks the prompt budget of every stage (used to retry after a context length error)
     # Initialize client if not already    
-    with open("../prompts/generate_response_agent.txt", "r") as file:
-        AGENT_PROMPT_GENERATE_RESPONSE = file.read()    
-
+    turn_start = time.perf_counter()
     await websocket.send_json({
         "type": "loading",
         "content": "Processing message..."
@@ -369,86 +318,55 @@ async def process_message(user_message: str, user_id: str, session_id: str, dial
     # Create a user annotated message based on user input to frontend
     user_annotated_message = AnnotatedResponse(role='user', response=user_message)    
 
-    # Fetch history and summary
-    message_history = fetch_message_history(user_id, session_id)
-    annotated_message_history = get_annotated_message_history(message_history)                
-    message_history_for_gpt = get_message_history_for_gpt(message_history)
-    annotated_message_history.append(user_annotated_message)
+    # The history is kept up to date in memory, so only this turn's messages are new
+    user_id, session_id = session.user_id, session.session_id
+    turn_span = tracer.current().set(user_id=user_id, session_id=session_id, budget_scale=budget_scale)
+    message_history_for_gpt = list(session.history_for_gpt)
+    annotated_message_history = session.annotated_history + [user_annotated_message]
+    # All LLM calls of this turn fit their prompts into the same context window, which stands in the
+    # user's memory for the older turns it covers
+    memory = UserMemories().get(user_id)
+    context = ContextWindow(states=session.states, budget_scale=budget_scale, user_id=user_id,
+                            memory=memory.render(), memory_covers=memory.covers(session_id))
     
     # Get the next state from the dialogue state tree and the corresponding system prompt
-    annotated_system_prompt = await dialogue_manager.get_next_system_prompt(annotated_message_history) 
+    annotated_system_prompt = await dialogue_manager.get_next_system_prompt(annotated_message_history, context) 
+    # Start fetching the data of tool calls that are likely in this state while the strategy and reply are generated
+    prefetcher = Prefetcher()
+    prefetcher.prefetch(user_id, session_id, state=annotated_system_prompt.end_state)
 
     # Refine this because redefine the object is wasteful
     user_annotated_message = AnnotatedResponse(role='user', response=user_message, 
                                                start_state=annotated_system_prompt.start_state[:-1], 
                                                end_state=annotated_system_prompt.start_state[-1], 
                                                transition=annotated_system_prompt.end_state)    
-    write_message_to_db(user_id, session_id, user_annotated_message)    
+    await session.append(user_annotated_message)    
  
     # Get the strategy from the response
-    strategy = await predict_strategy(user_id, user_message, annotated_system_prompt, message_history_for_gpt)
+    strategy = await predict_strategy(user_id, user_message, annotated_system_prompt, message_history_for_gpt, context)
+    prefetcher.prefetch(user_id, session_id, strategy=strategy)
 
     # Get the strategy description based on the predicted strategy    
-    with open(f"../prompts/strategies/{''.join('_' if c == ' ' else c for c in strategy.lower())}.txt", "r") as file:
-        STRATEGY_DESCRIPTION = file.read()    
-
-    # # Predict the response given the strategy
-    # system_prompt_response_prediction = " \n".join([GPT_SYSTEM_PROMPT] + 
-    #                            [annotated_system_prompt.response] + 
-    #                            [GPT_PROMPT_GENERATE_RESPONSE] + 
-    #                            [GPT_PROMPT_STRATEGIES] + 
-    #                            [GPT_PROMPT_FEW_SHOT_FUNCTION_CALLS])
-        
-    # AGENT_PROMPT_GENERATE_RESPONSE = AGENT_PROMPT_GENERATE_RESPONSE.replace("{TASK}", annotated_system_prompt.response)
-    # AGENT_PROMPT_GENERATE_RESPONSE = AGENT_PROMPT_GENERATE_RESPONSE.replace("{STRATEGY_DESCRIPTION}", STRATEGY_DESCRIPTION)
-    # AGENT_PROMPT_GENERATE_RESPONSE = AGENT_PROMPT_GENERATE_RESPONSE.replace("{STRATEGY}", strategy)
-    # response_prediction_message = [{"role": "system", "content": system_prompt_response_prediction}] + \
-    #                     message_history_for_gpt + \
-    #                     [{"role": "user", "content": user_message}] + \
-    #                     [{"role": "assistant", "content": AGENT_PROMPT_GENERATE_RESPONSE}]
-    
-    # print("RESPONSE PREDICTION")
-    # for msg in response_prediction_message:
-    #     print(f"{msg['role']}: {msg['content']}")
-
-    # response = await get_gpt_response(user_id, response_prediction_message, tool_call=True)
-    system_prompt_response_prediction = " \n".join([GPT_SYSTEM_PROMPT, 
-                                                    annotated_system_prompt.response, 
-                                                    GPT_PROMPT_GENERATE_RESPONSE, 
-                                                    GPT_PROMPT_STRATEGIES, 
-                                                    GPT_PROMPT_FEW_SHOT_FUNCTION_CALLS])
+    STRATEGY_DESCRIPTION = prompt_registry.strategy_description(strategy)
+    # The few-shot examples relevant to this turn, selected once so that every remaining stage sends the same text
+    examples = prompt_registry.select_examples(annotated_system_prompt.end_state, annotated_system_prompt.response, strategy, user_message)
  
-    gpt_response = await predict_gpt_response(user_id, user_message, strategy, STRATEGY_DESCRIPTION, system_prompt_response_prediction, annotated_system_prompt, message_history_for_gpt)
+    gpt_response = await predict_gpt_response(user_id, user_message, strategy, STRATEGY_DESCRIPTION, annotated_system_prompt, message_history_for_gpt, context, examples)
     
     reply_message = gpt_response.choices[0].message
-    print("INTERMEDIATE RESPONSE: ", reply_message)
+    log_payload(prompt_logger, "intermediate response", reply_message, user_id=user_id)
     
-    tool_call_use_response = 'no' 
-    
-    # If the response does not contain tool calls, manually chain-of-thought prompt to use a tool
+    # If the response does not contain tool calls, manually chain-of-thought prompt to use a tool.
+    # Asking whether to use one first would not change anything, since a tool is always used.
     if not reply_message.tool_calls:    
         tool_call_use_message_history = message_history_for_gpt + [{"role": "user", "content": user_message}] + [reply_message]             
-        tool_call_use_response = await should_use_tool(user_id, STRATEGY_DESCRIPTION, annotated_system_prompt, tool_call_use_message_history)    
-
-        if tool_call_use_response == 'yes':
-            predict_tool_call_use_response = await generate_tool_call(user_id, STRATEGY_DESCRIPTION, annotated_system_prompt, tool_call_use_message_history)
-            print("TOOL CALL RESPONSE: ", predict_tool_call_use_response)
+        predict_tool_call_use_response = await generate_tool_call(user_id, STRATEGY_DESCRIPTION, annotated_system_prompt, tool_call_use_message_history, context, examples)
+        reply_message = predict_tool_call_use_response.choices[0].message
 
-            reply_message = predict_tool_call_use_response.choices[0].message
-            reply_json = {
-                "role": reply_message.role,
-                "tool_calls": reply_message.tool_calls
-            }
-        else:
-            reply_json = {
-                "role": reply_message.role,
-                "content": reply_message.content
-            }
-    else:
-        reply_json = {
-            "role": reply_message.role,
-            "tool_calls": reply_message.tool_calls
-        }
+    reply_json = {
+        "role": reply_message.role,
+        "tool_calls": reply_message.tool_calls
+    }
 
     agent_state_metadata = {
         "start_state": annotated_system_prompt.start_state,
@@ -457,53 +375,40 @@ async def process_message(user_message: str, user_id: str, session_id: str, dial
         "transition": None
     }
 
-    write_message_to_db(user_id, session_id, reply_message, agent_state_metadata)    
+    await session.append(reply_message, agent_state_metadata)    
 
-    messages = [{"role": "system", "content": system_prompt_response_prediction}] + \
-                        message_history_for_gpt + \
-                        [{"role": "user", "content": user_message}] + \
-                        [reply_json]
+    conversation = message_history_for_gpt + \
+                    [{"role": "user", "content": user_message}] + \
+                    [reply_json]
     
     tool_calls = reply_message.tool_calls
+    prefetcher.record_turn(annotated_system_prompt.end_state, strategy, tool_calls)
+    turn_span.set(state=annotated_system_prompt.end_state, strategy=strategy, 
+                  tool_calls=len(tool_calls) if tool_calls else 0)
 
     # Call all functions
     if tool_calls:
-        print("Tool calls: ", tool_calls)
-        for tool_call in tool_calls:
-            result = await handle_function_call(tool_call, websocket, user_id, session_id)
-            # result = await handle_function_call(tool_call)
-
-            await websocket.send_json({
-                "type": "loading",
-                "content": "Analyzing data..."
-            })
-
-            if result == None:
-                result = "I could not fetch anything because there was no data. Please don't be mad."
-            
-            if len(result) > 1500:
-                print("Data too long. Summarizing...")
-                summarize_system_prompt = "Please summarize the following conversation between a user and an AI health coach."
-                summarize_result_prompt = [{"role": "system", "content": " \n".join([summarize_system_prompt] + [result])}]
-                summarized_result = await get_gpt_response(user_id, summarize_result_prompt, tool_call=False)
-                result = "Summarized function call data: \n\n" + summarized_result.choices[0].message.content                
-
-            messages.append({
+        logger.info("Running tool calls", user_id=user_id, tools=[tool_call.function.name for tool_call in tool_calls])
+        results = await run_tool_calls(tool_calls, websocket, session)
+        for tool_call, result in zip(tool_calls, results):
+            conversation.append({
                 "tool_call_id": tool_call.id,
                 "role": "tool",
                 "name": tool_call.function.name,
                 "content": result
             })
-
-            write_function_to_db(user_id, session_id, tool_call, result)
+            await session.append_tool_result(tool_call, result)
 
         # Call response again, without ability to call functions
+        messages = build_stage_messages("generate_response", annotated_system_prompt, conversation, examples=examples)
         second_response = await openai_client.chat_completion(
+            stage="respond_with_tool_results",
+            context=context,
             messages=messages
         )
 
         reply_message = second_response.choices[0].message
-        write_message_to_db(user_id, session_id, reply_message, agent_state_metadata)
+        await session.append(reply_message, agent_state_metadata)
 
     await websocket.send_json({
         "type": "message",
@@ -512,4 +417,14 @@ async def process_message(user_message: str, user_id: str, session_id: str, dial
         "content": reply_message.content,      
         "state": annotated_system_prompt.end_state,
         "strategy": strategy  
-    })
\ No newline at end of file
+    })
+    TURN_SECONDS.observe(time.perf_counter() - turn_start, state=annotated_system_prompt.end_state, strategy=strategy)
+
+    # Side effects of a completed state (its `function_calls`, e.g., summarize) run in the background after the reply
+    previous_state = annotated_system_prompt.start_state[-1] if annotated_system_prompt.start_state else None
+    state_completed = bool(previous_state) and previous_state != annotated_system_prompt.end_state
+    if state_completed:
+        completed_state = dialogue_manager.get_state(previous_state)
+        if completed_state:
+            enqueue_function_calls(user_id, session_id, completed_state)
+    UserMemories().maybe_update(user_id, session_id, session.history_for_gpt, force=state_completed)
\ No newline at end of file
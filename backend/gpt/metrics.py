@@ -0,0 +1,94 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+# This file keeps per-stage counters (calls, tokens, latency) for the LLM calls made while processing a turn
+
+from collections import defaultdict, Counter
+from monitoring import LLM_REQUEST_SECONDS, LLM_TOKENS, LLM_LOCAL_DECISIONS
+from logs import get_logger
+logger = get_logger("llm")
+
+
+def get_cached_tokens(usage) -> int:
+    # Newer API responses report prompt cache hits in usage.prompt_tokens_details.cached_tokens.
+    # Older client versions keep unknown fields as plain dicts, so handle both.
+    details = getattr(usage, "prompt_tokens_details", None)
+    if details is None:
+        return 0
+    if isinstance(details, dict):
+        return details.get("cached_tokens") or 0
+    return getattr(details, "cached_tokens", 0) or 0
+
+
+class StageMetrics:
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+        self.total_latency = 0.0  # in seconds
+        self.max_latency = 0.0
+        self.models = Counter()
+        self.local_decisions = 0  # calls skipped because a local classifier answered
+
+    @property
+    def cache_hit_ratio(self) -> float:
+        return self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+
+    @property
+    def mean_latency(self) -> float:
+        return self.total_latency / self.calls if self.calls else 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cache_hit_ratio": round(self.cache_hit_ratio, 4),
+            "mean_latency": round(self.mean_latency, 4),
+            "max_latency": round(self.max_latency, 4),
+            "models": dict(self.models),
+            "local_decisions": self.local_decisions,
+        }
+
+
+class LLMMetrics:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = object.__new__(cls)
+            cls._instance.stages = defaultdict(StageMetrics)
+        return cls._instance
+
+    def record(self, stage: str, model: str, response, latency: float):
+        # Record the model, latency (in seconds) and token usage of a chat completion for the given stage
+        usage = getattr(response, "usage", None)
+        metrics = self.stages[stage]
+        metrics.calls += 1
+        metrics.models[model] += 1
+        metrics.total_latency += latency
+        metrics.max_latency = max(metrics.max_latency, latency)
+        LLM_REQUEST_SECONDS.observe(latency, stage=stage, model=model)
+        if usage is None:
+            logger.info("LLM call", stage=stage, model=model, latency=round(latency, 3))
+            return
+        cached_tokens = get_cached_tokens(usage)
+        metrics.prompt_tokens += usage.prompt_tokens
+        metrics.cached_tokens += cached_tokens
+        metrics.completion_tokens += usage.completion_tokens
+        LLM_TOKENS.inc(usage.prompt_tokens, stage=stage, model=model, type="prompt")
+        LLM_TOKENS.inc(cached_tokens, stage=stage, model=model, type="cached")
+        LLM_TOKENS.inc(usage.completion_tokens, stage=stage, model=model, type="completion")
+        logger.info("LLM call", stage=stage, model=model, latency=round(latency, 3), prompt_tokens=usage.prompt_tokens,
+                    cached_tokens=cached_tokens, completion_tokens=usage.completion_tokens)
+
+    def record_local(self, stage: str):
+        # Record a decision that was made by a local classifier instead of an LLM call
+        self.stages[stage].local_decisions += 1
+        LLM_LOCAL_DECISIONS.inc(stage=stage)
+
+    def summary(self) -> dict:
+        return {stage: metrics.to_dict() for stage, metrics in self.stages.items()}
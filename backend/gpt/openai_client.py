@@ -2,10 +2,22 @@
 #
 # SPDX-License-Identifier: MIT
 
+import os
+import time
 import openai
+from gpt.metrics import LLMMetrics, get_cached_tokens
+from gpt.context import ContextWindow, count_prompt_tokens
+from gpt.routing import ModelRouter
+from gpt.scheduler import LLMScheduler
+from gpt.llm_backend import create_backend
+from tracing import Tracer
 
-API_KEY = ''
-BASE_MODEL = 'gpt-4'
+API_KEY = os.getenv("OPENAI_API_KEY", '')
+# Point the client at another server, e.g., a local mock (see scripts/mock_openai_server.py)
+BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+
+# Completion tokens assumed for the rate limit when a stage does not set max_tokens
+ESTIMATED_COMPLETION_TOKENS = 500
 
 class OpenAIClient:
     _instance = None
@@ -13,12 +25,43 @@ class OpenAIClient:
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(OpenAIClient, cls).__new__(cls)
-            cls._instance.model = BASE_MODEL
-            cls._instance.client = openai.AsyncClient(api_key=API_KEY)
+            # Retries are done by the scheduler, which knows the deadline of each call
+            cls._instance.client = openai.AsyncClient(api_key=API_KEY, base_url=BASE_URL, max_retries=0)
+            # Sends the requests to the API, or answers them offline (see gpt/llm_backend.py)
+            cls._instance.backend = create_backend(cls._instance.client)
+            cls._instance.router = ModelRouter()
+            cls._instance.metrics = LLMMetrics()
+            cls._instance.scheduler = LLMScheduler()
+            cls._instance.tracer = Tracer()
         return cls._instance
 
-    async def chat_completion(self, **kwargs):
-        return await self._instance.client.chat.completions.create(model=self._instance.model, **kwargs)
+    async def chat_completion(self, stage="default", model=None, context: ContextWindow = None, **kwargs):
+        # `stage` names the call site (e.g., "predict_strategy"). It selects the model and request 
+        # settings from the routing table, the prompt budget, and the metrics bucket.
+        # The model is chosen per request; no global client state is changed.
+        route = self._instance.router.route(stage)
+        model = model or route.model
+        for setting in ["max_tokens", "temperature", "timeout"]:
+            if getattr(route, setting) is not None and setting not in kwargs:
+                kwargs[setting] = getattr(route, setting)
+
+        context = context or ContextWindow()
+        kwargs["messages"] = context.fit(stage, kwargs["messages"], model, kwargs.get("tools"))
+
+        tokens = count_prompt_tokens(kwargs["messages"], model, kwargs.get("tools")) + \
+            (kwargs.get("max_tokens") or ESTIMATED_COMPLETION_TOKENS)
 
-    def update_model(self, new_model):
-        self._instance.model = new_model
\ No newline at end of file
+        with self._instance.tracer.span(f"llm.{stage}", stage=stage, model=model, estimated_tokens=tokens) as span:
+            start_time = time.perf_counter()
+            raw_response = await self._instance.scheduler.run(
+                stage, context.user_id,
+                lambda: self._instance.backend.create(stage, model=model, **kwargs),
+                tokens, route.deadline
+            )
+            response = raw_response.parse()
+            self._instance.metrics.record(stage, model, response, time.perf_counter() - start_time)
+            usage = getattr(response, "usage", None)
+            if usage is not None:
+                span.set(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens,
+                         cached_tokens=get_cached_tokens(usage))
+        return response
@@ -0,0 +1,178 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+# This file defines a prefetcher that computes the results of likely tool calls while the LLM calls of a
+# turn are still running, so that the tool call finds them in the tool result cache (see gpt/tool_cache.py).
+# Which calls are likely is learned from the tool calls made in each dialogue state and with each strategy:
+# from logged conversations (see scripts/build_prefetch_statistics.py) and from the turns of this worker.
+# Dates in the arguments are stored relative to the day of the turn, e.g., "the last 7 days".
+
+import os
+import json
+from datetime import datetime, date, timedelta
+from collections import Counter, defaultdict
+import pytz
+import pandas as pd
+
+from firebase import str_to_bool
+from gpt.functions import FUNCTION_RESULTS, tool_result_cache
+from gpt.prompts import TIMEZONE
+from tracing import Tracer
+from logs import get_logger
+logger = get_logger("prefetch")
+tracer = Tracer()
+
+PREFETCH = str_to_bool(os.getenv("PREFETCH", "True"))
+PREFETCH_STATISTICS_FILE = os.getenv("PREFETCH_STATISTICS_FILE", "gpt/classifiers/prefetch.json")
+# A call is prefetched if it was made in at least this fraction of the turns in the state or with the strategy
+PREFETCH_MIN_PROBABILITY = float(os.getenv("PREFETCH_MIN_PROBABILITY", "0.3"))
+# States and strategies seen in fewer turns are not used
+PREFETCH_MIN_TURNS = int(os.getenv("PREFETCH_MIN_TURNS", "5"))
+PREFETCH_MAX_CALLS = int(os.getenv("PREFETCH_MAX_CALLS", "2"))
+# Calls kept per state and strategy, the least frequent are dropped beyond that
+MAX_SIGNATURES = 50
+ARTIFACT_FORMAT = "gptcoach-prefetch-v1"
+
+DATE_ARGUMENTS = ("start", "end", "date")
+
+
+def today() -> date:
+    return datetime.now(tz=pytz.timezone(TIMEZONE)).date()
+
+
+def call_signature(name: str, arguments: dict, day: date) -> str:
+    """
+    Return the call with its dates relative to `day`, e.g., {"start": "-7", "end": "-1 23:59:59"}, as a JSON string.
+    Raises a ValueError if a date cannot be parsed.
+    """
+    relative = {}
+    for argument, value in arguments.items():
+        if argument in DATE_ARGUMENTS and isinstance(value, str) and value:
+            timestamp = pd.to_datetime(value)
+            relative[argument] = f"{(timestamp.date() - day).days:+d}"
+            if len(value) > len("YYYY-MM-DD"):
+                relative[argument] += timestamp.strftime(" %H:%M:%S")
+        else:
+            relative[argument] = value
+    return json.dumps({"name": name, "arguments": relative}, sort_keys=True)
+
+
+def call_from_signature(signature: str, day: date) -> tuple[str, dict]:
+    # The function name and arguments of the call for the turn on `day`
+    call = json.loads(signature)
+    arguments = {}
+    for argument, value in call["arguments"].items():
+        if argument in DATE_ARGUMENTS and isinstance(value, str) and value:
+            offset, _, time_of_day = value.partition(" ")
+            value = (day + timedelta(days=int(offset))).isoformat() + (f" {time_of_day}" if time_of_day else "")
+        arguments[argument] = value
+    return call["name"], arguments
+
+
+def turn_contexts(state: str = None, strategy: str = None) -> list[str]:
+    return ([f"state:{state}"] if state else []) + ([f"strategy:{strategy}"] if strategy else [])
+
+
+class ToolCallStatistics:
+    """
+    How often each call was made in the turns of each context (a dialogue state or a strategy)
+    - turns: the number of turns of each context (dict of str -> int), e.g., {"state:past_experience": 40}
+    - calls: the number of turns of each context that made each call (dict of str -> dict of str -> int), see `call_signature`
+    """
+    def __init__(self, turns: dict = None, calls: dict = None):
+        self.turns = Counter(turns or {})
+        self.calls = defaultdict(Counter, {context: Counter(counts) for context, counts in (calls or {}).items()})
+
+    def record(self, contexts: list[str], signatures: set[str]):
+        # Count one turn of each context, and the calls it made
+        for context in contexts:
+            self.turns[context] += 1
+            counts = self.calls[context]
+            counts.update(signatures)
+            if len(counts) > MAX_SIGNATURES:
+                self.calls[context] = Counter(dict(counts.most_common(MAX_SIGNATURES)))
+
+    def likely(self, context: str, min_probability: float = PREFETCH_MIN_PROBABILITY, min_turns: int = PREFETCH_MIN_TURNS) -> dict:
+        # Calls made in at least `min_probability` of the turns of the context -> their probability
+        turns = self.turns.get(context, 0)
+        if turns < min_turns:
+            return {}
+        return {signature: count / turns for signature, count in self.calls.get(context, {}).items() if count / turns >= min_probability}
+
+    def save(self, file_path: str, metadata: dict = None):
+        with open(file_path, "w") as file:
+            json.dump({
+                "format": ARTIFACT_FORMAT,
+                "turns": self.turns,
+                "calls": self.calls,
+                "metadata": metadata or {},
+            }, file)
+
+    @classmethod
+    def load(cls, file_path: str) -> "ToolCallStatistics":
+        with open(file_path, "r") as file:
+            data = json.load(file)
+        if data.get("format") != ARTIFACT_FORMAT:
+            raise ValueError(f"Unsupported prefetch statistics format in {file_path}: {data.get('format')}")
+        return cls(data["turns"], data["calls"])
+
+
+class Prefetcher:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = object.__new__(cls)
+            cls._instance.statistics = ToolCallStatistics()
+            if PREFETCH and os.path.exists(PREFETCH_STATISTICS_FILE):
+                cls._instance.statistics = ToolCallStatistics.load(PREFETCH_STATISTICS_FILE)
+                logger.info("Loaded prefetch statistics", contexts=len(cls._instance.statistics.turns))
+        return cls._instance
+
+    def record_turn(self, state: str, strategy: str, tool_calls: list):
+        """
+        Count the tool calls of a turn towards the statistics of its state and strategy
+        - tool_calls: the tool calls of the reply (list of ChatCompletionMessageToolCall), or None
+        """
+        day, signatures = today(), set()
+        for tool_call in tool_calls or []:
+            if tool_call.function.name not in FUNCTION_RESULTS:
+                continue
+            try:
+                signatures.add(call_signature(tool_call.function.name, json.loads(tool_call.function.arguments), day))
+            except ValueError:
+                continue
+        self.statistics.record(turn_contexts(state, strategy), signatures)
+
+    def prefetch(self, user_id: str, session_id: str, state: str = None, strategy: str = None) -> int:
+        """
+        Start computing the results of the calls that are likely in the dialogue state or with the strategy
+        of the turn, in the background. Returns the number of computations started.
+        """
+        if not PREFETCH:
+            return 0
+        likely = {}
+        for context in turn_contexts(state, strategy):
+            for signature, probability in self.statistics.likely(context).items():
+                likely[signature] = max(probability, likely.get(signature, 0))
+
+        day, started = today(), 0
+        for signature in sorted(likely, key=likely.get, reverse=True)[:PREFETCH_MAX_CALLS]:
+            name, arguments = call_from_signature(signature, day)
+            try:
+                key, compute = FUNCTION_RESULTS[name](user_id=user_id, **arguments)
+            except Exception as e:
+                # The tool call would fail the same way
+                logger.debug("Cannot prefetch call", user_id=user_id, call=signature, error=repr(e))
+                continue
+
+            async def traced_compute(name=name, compute=compute):
+                with tracer.trace("prefetch", tool=name, user_id=user_id):
+                    return await compute()
+
+            if tool_result_cache.warm(key, session_id, traced_compute):
+                started += 1
+                logger.debug("Prefetching call", user_id=user_id, state=state, strategy=strategy,
+                             call=signature, probability=round(likely[signature], 2))
+        return started
@@ -0,0 +1,222 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+# This file defines a registry that loads all prompt templates once and caches the
+# shared system prompt and the stage instructions used by each stage of a turn
+
+import os
+import re
+import asyncio
+from datetime import datetime
+import pytz
+
+from gpt.examples import ExampleIndex, EXAMPLE_PROMPTS, build_query
+from logs import get_logger
+logger = get_logger("config")
+
+PROMPTS_DIRECTORY = "../prompts"
+STRATEGIES_DIRECTORY = os.path.join(PROMPTS_DIRECTORY, "strategies")
+TIMEZONE = "US/Pacific"
+
+PLACEHOLDER_PATTERN = re.compile(r"\{([A-Z_]+)\}")
+
+# Placeholders that each template is allowed to contain. Templates not listed here must be static.
+ALLOWED_PLACEHOLDERS = {
+    "system_prompt": {"DATE_STRING"},
+    "stage_prompt": {"TASK", "INSTRUCTIONS"},
+    "predict_strategy_agent": {"TASK", "STRATEGIES"},
+    "generate_response_agent": {"TASK", "STRATEGY_DESCRIPTION", "STRATEGY"},
+    "tool_call_use_agent": {"TASK", "STRATEGY_DESCRIPTION"},
+    "predict_tool_call_use_agent": {"TASK", "STRATEGY_DESCRIPTION"},
+    "update_memory": {"MEMORY", "CONVERSATION", "MAX_ITEMS"},
+}
+
+# The system prompt shared by every stage of a turn. It is kept byte-identical across stages
+# (and across turns on the same day) so that the provider can reuse its prompt cache.
+# Of the prompts in EXAMPLE_PROMPTS only the introduction is shared, their examples are selected
+# for each turn (see gpt/examples.py).
+SHARED_SYSTEM_PROMPT = ["system_prompt", "few_shot_function_calls"]
+
+# The stage-specific instructions, placed after the conversation history together with the
+# prompt of the current dialogue state
+STAGE_INSTRUCTIONS = {
+    "predict_strategy": "predict_strategy",
+    "generate_tool_call": "predict_tool_call_use",
+    "generate_response": "generate_response",
+}
+
+# Prompts added in full to the instructions of a stage, e.g., the definitions of all strategies to choose from
+STAGE_REFERENCES = {
+    "predict_strategy": ["strategies"],
+}
+
+
+class PromptTemplate:
+    # A prompt with {PLACEHOLDER} fields, split into literal and placeholder parts once at load time
+    def __init__(self, name: str, text: str):
+        self.name = name
+        self.text = text
+        self.parts = []  # list of (is_placeholder, value) tuples
+        for i, part in enumerate(PLACEHOLDER_PATTERN.split(text)):
+            if i % 2 == 1:
+                self.parts.append((True, part))
+            elif part:
+                self.parts.append((False, part))
+        self.placeholders = frozenset(value for is_placeholder, value in self.parts if is_placeholder)
+
+    def render(self, **values) -> str:
+        # Fill in all placeholders. Values for placeholders not in the template are ignored.
+        missing = self.placeholders - values.keys()
+        if missing:
+            raise ValueError(f"Prompt '{self.name}' is missing values for {sorted(missing)}")
+        return "".join(values[value] if is_placeholder else value for is_placeholder, value in self.parts)
+
+    @classmethod
+    def from_parts(cls, name: str, parts: list[tuple[bool, str]]) -> "PromptTemplate":
+        template = cls.__new__(cls)
+        template.name = name
+        template.parts = []
+        for is_placeholder, value in parts:
+            if not is_placeholder and template.parts and not template.parts[-1][0]:
+                # Merge adjacent literals so rendering stays a single join over few parts
+                template.parts[-1] = (False, template.parts[-1][1] + value)
+            elif is_placeholder or value:
+                template.parts.append((is_placeholder, value))
+        template.placeholders = frozenset(value for is_placeholder, value in template.parts if is_placeholder)
+        template.text = "".join("{" + value + "}" if is_placeholder else value for is_placeholder, value in template.parts)
+        return template
+
+    @classmethod
+    def join(cls, name: str, templates: list["PromptTemplate"], separator: str = " \n") -> "PromptTemplate":
+        # Concatenate several templates into one, keeping their placeholders
+        parts = []
+        for i, template in enumerate(templates):
+            if i > 0:
+                parts.append((False, separator))
+            parts.extend(template.parts)
+        return cls.from_parts(name, parts)
+
+
+def strategy_file_name(strategy: str) -> str:
+    # e.g., "Advise with Permission" -> "advise_with_permission"
+    return strategy.lower().replace(" ", "_")
+
+
+def current_date_string() -> str:
+    return datetime.now(tz=pytz.timezone(TIMEZONE)).strftime("%Y-%m-%d")
+
+
+class PromptRegistry:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = object.__new__(cls)
+            cls._instance.templates = {}
+            cls._instance.strategies = {}
+            cls._instance.shared_system_prompt_template = None
+            cls._instance.examples = None
+            cls._instance.stage_prompts = {}
+            cls._instance.mtimes = {}
+            cls._instance.load()
+        return cls._instance
+
+    def prompt_files(self) -> list[str]:
+        files = [os.path.join(PROMPTS_DIRECTORY, f) for f in os.listdir(PROMPTS_DIRECTORY) if f.endswith(".txt")]
+        files += [os.path.join(STRATEGIES_DIRECTORY, f) for f in os.listdir(STRATEGIES_DIRECTORY) if f.endswith(".txt")]
+        return sorted(files)
+
+    def load(self):
+        """
+        (Re)load all prompt templates and strategy descriptions from disk and validate their placeholders.
+        Raises a ValueError if a template contains a placeholder that is not allowed for it.
+        """
+        templates, strategies, mtimes = {}, {}, {}
+        for file_path in self.prompt_files():
+            with open(file_path, "r") as file:
+                text = file.read()
+            mtimes[file_path] = os.path.getmtime(file_path)
+            name = os.path.splitext(os.path.basename(file_path))[0]
+
+            if os.path.dirname(file_path) == STRATEGIES_DIRECTORY:
+                strategies[name] = text
+                continue
+
+            template = PromptTemplate(name, text)
+            unexpected = template.placeholders - ALLOWED_PLACEHOLDERS.get(name, set())
+            if unexpected:
+                raise ValueError(f"Prompt '{name}' contains unexpected placeholders {sorted(unexpected)}")
+            templates[name] = template
+
+        required = SHARED_SYSTEM_PROMPT + list(STAGE_INSTRUCTIONS.values()) + list(EXAMPLE_PROMPTS) + ["stage_prompt"]
+        for name in required:
+            if name not in templates:
+                raise ValueError(f"Prompt '{name}' not found in {PROMPTS_DIRECTORY}")
+
+        examples = ExampleIndex({name: templates[name].text for name in EXAMPLE_PROMPTS})
+        shared = [PromptTemplate(name, examples.introductions[name]) if name in EXAMPLE_PROMPTS else templates[name]
+                  for name in SHARED_SYSTEM_PROMPT]
+
+        # Swap everything at once so concurrent readers never see a half-loaded registry
+        self.templates, self.strategies, self.mtimes, self.examples = templates, strategies, mtimes, examples
+        self.shared_system_prompt_template = PromptTemplate.join("shared_system_prompt", shared)
+        self.stage_prompts = {}
+        logger.info("Loaded prompts", templates=len(templates), strategies=len(strategies), examples=len(examples.examples))
+
+    def get(self, name: str) -> PromptTemplate:
+        return self.templates[name]
+
+    def strategy_description(self, strategy: str) -> str:
+        return self.strategies[strategy_file_name(strategy)]
+
+    def shared_system_prompt(self) -> str:
+        # The system prompt at the start of every stage's messages. Only the date is filled in per request.
+        return self.shared_system_prompt_template.render(DATE_STRING=current_date_string())
+
+    def stage_prompt(self, stage: str, state_id: str, state_prompt: str, examples: str = None) -> str:
+        """
+        Return the instructions for a stage of the turn in the given dialogue state.
+        These go at the end of the messages, after the shared system prompt and the conversation history.
+        The text is built once per (stage, state) and cached, the examples selected for the turn are appended to it.
+        """
+        key = (stage, state_id)
+        prompt = self.stage_prompts.get(key)
+        if prompt is None:
+            instructions = "\n\n".join([self.templates[STAGE_INSTRUCTIONS[stage]].text] +
+                                        [self.templates[name].text for name in STAGE_REFERENCES.get(stage, [])])
+            prompt = self.templates["stage_prompt"].render(TASK=state_prompt, INSTRUCTIONS=instructions)
+            self.stage_prompts[key] = prompt
+        if examples:
+            prompt = f"{prompt}\n\n{examples}"
+        return prompt
+
+    def select_examples(self, state_id: str, state_prompt: str, strategy: str, user_message: str) -> str:
+        """
+        Return the examples most relevant to a turn, to pass to `stage_prompt` for every stage after the strategy is known
+        - state_id: the dialogue state of the turn (str)
+        - state_prompt: the prompt of the dialogue state (str)
+        - strategy: the predicted strategy (str)
+        - user_message: the user's message (str)
+        """
+        query = build_query(state=state_id, state_prompt=state_prompt, strategy=strategy, user_message=user_message)
+        examples = self.examples
+        return examples.render(examples.select(query))
+
+    def has_changed(self) -> bool:
+        try:
+            files = self.prompt_files()
+            return set(files) != set(self.mtimes) or any(os.path.getmtime(f) != self.mtimes[f] for f in files)
+        except FileNotFoundError:
+            return True
+
+    async def watch(self, interval: float = 2.0):
+        # Poll the prompt directory and reload whenever a file is added, removed or modified
+        while True:
+            await asyncio.sleep(interval)
+            if self.has_changed():
+                logger.info("Prompt files changed on disk, reloading")
+                try:
+                    self.load()
+                except Exception as e:
+                    logger.error("Failed to reload prompts, keeping previous version: %s", e)
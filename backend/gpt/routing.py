@@ -0,0 +1,66 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+# This file defines which model (and request settings) each LLM call site uses.
+# Short classification-style decisions go to a small, fast model with a tight max_tokens,
+# while the user-facing reply keeps the strong model.
+
+import json
+from typing import Optional
+from pydantic import BaseModel
+
+from logs import get_logger
+logger = get_logger("config")
+
+STRONG_MODEL = "gpt-4"
+FAST_MODEL = "gpt-4o-mini"
+
+class StageRoute(BaseModel):
+    model: str
+    max_tokens: Optional[int] = None
+    temperature: Optional[float] = None
+    timeout: Optional[float] = None  # of each attempt, in seconds
+    deadline: Optional[float] = None  # of the whole call, including queueing and retries, in seconds
+
+DEFAULT_ROUTES = {
+    # User-facing replies
+    "generate_response": StageRoute(model=STRONG_MODEL, timeout=60, deadline=120),
+    "respond_with_tool_results": StageRoute(model=STRONG_MODEL, timeout=60, deadline=120),
+    "generate_tool_call": StageRoute(model=STRONG_MODEL, timeout=30, deadline=60),
+    # One-word decisions
+    "predict_strategy": StageRoute(model=FAST_MODEL, max_tokens=10, temperature=0, timeout=15, deadline=30),
+    "classify_state": StageRoute(model=FAST_MODEL, max_tokens=3, temperature=0, timeout=15, deadline=30),
+    # Summaries
+    "summarize_conversation": StageRoute(model=FAST_MODEL, max_tokens=500, timeout=30, deadline=60),
+    "update_memory": StageRoute(model=FAST_MODEL, max_tokens=600, temperature=0, timeout=30, deadline=60),
+    # Anything that does not name a stage
+    "default": StageRoute(model=STRONG_MODEL, timeout=60, deadline=120),
+}
+
+
+class ModelRouter:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = object.__new__(cls)
+            cls._instance.routes = dict(DEFAULT_ROUTES)
+        return cls._instance
+
+    def configure(self, routes: dict):
+        """
+        Override the routes of some stages, e.g., {"predict_strategy": {"model": "gpt-4", "max_tokens": 10}}.
+        Fields that are not given keep their default value.
+        """
+        for stage, route in routes.items():
+            base = self.routes.get(stage, self.routes["default"])
+            self.routes[stage] = StageRoute(**{**base.model_dump(), **route})
+        logger.info("Model routes: %s", {stage: route.model_dump(exclude_none=True) for stage, route in self.routes.items()})
+
+    def configure_from_file(self, file_path: str):
+        with open(file_path, "r") as file:
+            self.configure(json.load(file))
+
+    def route(self, stage: str) -> StageRoute:
+        return self.routes.get(stage, self.routes["default"])
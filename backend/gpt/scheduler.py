@@ -0,0 +1,293 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+# This file defines the scheduler that every LLM request goes through. It limits how many requests
+# are in flight (overall and per user), lets user-facing replies go ahead of auxiliary calls,
+# paces requests by the rate limits the API reports in its response headers, retries transient
+# errors with jittered backoff, and gives up once a call's deadline has passed.
+
+import os
+import re
+import time
+import heapq
+import random
+import asyncio
+import itertools
+from contextlib import asynccontextmanager
+import openai
+from tracing import Tracer
+from logs import get_logger
+logger = get_logger("llm")
+
+MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "16"))
+MAX_IN_FLIGHT_PER_USER = int(os.getenv("LLM_MAX_IN_FLIGHT_PER_USER", "3"))
+MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+RETRY_BASE_DELAY = 0.5  # in seconds
+RETRY_MAX_DELAY = 8.0
+
+# Lower values are scheduled first
+USER_FACING = 0
+AUXILIARY = 1
+STAGE_PRIORITIES = {
+    "generate_response": USER_FACING,
+    "respond_with_tool_results": USER_FACING,
+    "generate_tool_call": USER_FACING,
+}
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+
+DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+class LLMDeadlineExceeded(TimeoutError):
+    pass
+
+
+def parse_duration(value: str) -> float:
+    # Parse durations like "20ms", "1s" or "6m0s" from the rate limit headers, in seconds
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in DURATION_PATTERN.findall(value or ""))
+
+
+class TokenBucket:
+    """
+    Client-side copy of one of the API's rate limits (requests or tokens per minute).
+    The bucket is unlimited until the first response reports the limit, and is re-synced with
+    the remaining amount reported by every response after that.
+    """
+    def __init__(self):
+        self.capacity = None
+        self.level = 0.0
+        self.rate = 0.0  # refill per second
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        if self.capacity is not None:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def update(self, limit: float, remaining: float, reset: float):
+        # `reset` is the time until the limit is fully replenished
+        self.refill()
+        self.capacity = limit
+        self.level = remaining
+        self.rate = (limit - remaining) / reset if reset > 0 else limit / 60
+
+    def wait_time(self, amount: float) -> float:
+        self.refill()
+        if self.capacity is None:
+            return 0.0
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate if self.rate > 0 else 1.0
+
+    def consume(self, amount: float):
+        if self.capacity is not None:
+            self.level -= amount
+
+
+class PrioritySlots:
+    # A semaphore whose waiters are woken by priority, then in arrival order
+    def __init__(self, value: int):
+        self.value = value
+        self.waiters = []  # heap of (priority, arrival, future)
+        self.arrivals = itertools.count()
+
+    async def acquire(self, priority: int):
+        if self.value > 0 and not self.waiters:
+            self.value -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.arrivals), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The slot may have been handed over just before the cancellation
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.value += 1
+
+    @property
+    def queued(self) -> int:
+        return sum(not future.done() for _, _, future in self.waiters)
+
+
+class RateLimitQueue:
+    """
+    Waits until the request and token buckets allow a request, by priority and then in arrival order.
+    Only the first waiter takes from the buckets, and a waiter that arrives with a higher priority goes
+    ahead of the ones already waiting, e.g., a reply ahead of a memory update.
+    """
+    def __init__(self, request_bucket: TokenBucket, token_bucket: TokenBucket):
+        self.request_bucket = request_bucket
+        self.token_bucket = token_bucket
+        self.waiters = []  # heap of (priority, arrival, event)
+        self.arrivals = itertools.count()
+
+    def wake_first(self):
+        # Let the first waiter check the buckets again, e.g., after they were updated
+        if self.waiters:
+            self.waiters[0][2].set()
+
+    async def acquire(self, priority: int, tokens: int):
+        # Wait for the turn of the request, then take the request and its estimated tokens
+        waiter = (priority, next(self.arrivals), asyncio.Event())
+        heapq.heappush(self.waiters, waiter)
+        try:
+            while True:
+                wait = None  # until woken up
+                if self.waiters[0] is waiter:
+                    wait = max(self.request_bucket.wait_time(1), self.token_bucket.wait_time(tokens))
+                    if wait == 0:
+                        heapq.heappop(self.waiters)
+                        self.request_bucket.consume(1)
+                        self.token_bucket.consume(tokens)
+                        self.wake_first()
+                        return
+                waiter[2].clear()
+                try:
+                    await asyncio.wait_for(waiter[2].wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            self.waiters.remove(waiter)
+            heapq.heapify(self.waiters)
+            self.wake_first()
+            raise
+
+    @property
+    def queued(self) -> int:
+        return len(self.waiters)
+
+
+class LLMScheduler:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = object.__new__(cls)
+            cls._instance.slots = PrioritySlots(MAX_IN_FLIGHT)
+            cls._instance.user_slots = {}  # user_id -> [semaphore, number of requests holding or waiting for it]
+            cls._instance.request_bucket = TokenBucket()
+            cls._instance.token_bucket = TokenBucket()
+            cls._instance.rate_limits = RateLimitQueue(cls._instance.request_bucket, cls._instance.token_bucket)
+            cls._instance.in_flight = 0
+            cls._instance.retries = 0
+            cls._instance.deadlines_exceeded = 0
+        return cls._instance
+
+    @asynccontextmanager
+    async def user_slot(self, user_id: str):
+        if user_id is None:
+            yield
+            return
+        entry = self.user_slots.setdefault(user_id, [asyncio.Semaphore(MAX_IN_FLIGHT_PER_USER), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.user_slots[user_id]
+
+    def update_rate_limits(self, headers):
+        try:
+            if headers.get("x-ratelimit-limit-requests"):
+                self.request_bucket.update(float(headers["x-ratelimit-limit-requests"]),
+                                           float(headers["x-ratelimit-remaining-requests"]),
+                                           parse_duration(headers.get("x-ratelimit-reset-requests")))
+            if headers.get("x-ratelimit-limit-tokens"):
+                self.token_bucket.update(float(headers["x-ratelimit-limit-tokens"]),
+                                         float(headers["x-ratelimit-remaining-tokens"]),
+                                         parse_duration(headers.get("x-ratelimit-reset-tokens")))
+        except (KeyError, ValueError) as e:
+            logger.warning("Could not parse rate limit headers: %s", e)
+        self.rate_limits.wake_first()
+
+    def retry_delay(self, attempt: int, error: Exception) -> float:
+        # Use the server's retry-after if given, else exponential backoff with full jitter
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), RETRY_MAX_DELAY)
+            except ValueError:
+                pass
+        return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+    async def run(self, stage: str, user_id: str, request, tokens: int, deadline: float = None):
+        """
+        Run an LLM request once a slot and the rate limits allow it, retrying transient errors.
+        - stage: the call site (str), which sets the priority
+        - user_id: the user the request is for (str, optional), for the per-user limit
+        - request: a function without arguments that returns a coroutine sending the request and
+          returning the raw response (with headers)
+        - tokens: the estimated number of tokens of the request (int), prompt plus completion
+        - deadline: the time this call may take in total, including queueing and retries (float, seconds, optional)
+
+        Returns: the raw response of the first successful attempt
+        Raises: LLMDeadlineExceeded if the deadline passes, or the last error once retries are exhausted
+        """
+        priority = STAGE_PRIORITIES.get(stage, AUXILIARY)
+        span = Tracer().current()  # the span of the LLM stage, if traced
+        expires = time.monotonic() + deadline if deadline else None
+
+        async def before_deadline(coroutine):
+            if expires is None:
+                return await coroutine
+            try:
+                return await asyncio.wait_for(coroutine, max(expires - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                self.deadlines_exceeded += 1
+                raise LLMDeadlineExceeded(f"The {stage} request did not finish within {deadline}s")
+
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                queued = time.monotonic()
+                async with self.user_slot(user_id):
+                    await before_deadline(self.slots.acquire(priority))
+                    self.in_flight += 1
+                    try:
+                        await before_deadline(self.rate_limits.acquire(priority, tokens))
+                        # Time spent waiting for a slot and the rate limits, as opposed to the request itself
+                        span.add("queued_seconds", time.monotonic() - queued)
+                        raw_response = await before_deadline(request())
+                    finally:
+                        self.in_flight -= 1
+                        self.slots.release()
+            except RETRYABLE_ERRORS as e:
+                delay = self.retry_delay(attempt, e)
+                if attempt == MAX_RETRIES or (expires is not None and time.monotonic() + delay > expires):
+                    raise
+                self.retries += 1
+                span.add("retries")
+                logger.warning("Retrying LLM request", stage=stage, delay=round(delay, 2), error=type(e).__name__,
+                               attempt=attempt + 1, max_retries=MAX_RETRIES)
+                await asyncio.sleep(delay)
+                continue
+
+            self.update_rate_limits(raw_response.headers)
+            return raw_response
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.slots.queued,
+            "waiting_for_rate_limit": self.rate_limits.queued,
+            "retries": self.retries,
+            "deadlines_exceeded": self.deadlines_exceeded,
+            "remaining_requests": self.request_bucket.level if self.request_bucket.capacity is not None else None,
+            "remaining_tokens": self.token_bucket.level if self.token_bucket.capacity is not None else None,
+        }
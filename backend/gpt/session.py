@@ -0,0 +1,109 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+# This file defines the state of a chat session for the lifetime of its websocket. The history is
+# loaded from Firestore once, and every message this worker adds is written through to Firestore
+# and appended to the in-memory views, so preparing a turn does not re-read or re-parse the session.
+
+from openai.types.chat import ChatCompletionMessage, ChatCompletionMessageToolCall
+
+from gpt.dsm.annotated_response import AnnotatedResponse
+from gpt.utils import fetch_message_history, write_message_to_db, write_message_history, remove_messages_from_db, is_dialogue_message, to_annotated_response, to_gpt_message
+from logs import get_logger
+logger = get_logger("session")
+
+
+class ConversationSession:
+    """
+    The messages of one chat session, kept in the two formats used while processing a turn
+    - user_id: the user's Firebase ID (str)
+    - session_id: the ID of the session document in the user's `gpt-messages` collection (str)
+
+    Attributes:
+    - messages: the messages stored for the session that this worker loaded or wrote (list of dict)
+    - annotated_history: the messages with their dialogue states (list of AnnotatedResponse objects)
+    - history_for_gpt: the same messages in the chat completions format (list of dict)
+    - replay: the frames that showed the history to the client when the websocket connected or after the last
+      rewind (list of dict), from which older pages are sent (see `history_page` in gpt/messages.py)
+    """
+    def __init__(self, user_id: str, session_id: str):
+        self.user_id = user_id
+        self.session_id = session_id
+        self.messages = []
+        self.annotated_history = []
+        self.history_for_gpt = []
+        self.replay = []
+
+    def load(self) -> list:
+        """
+        (Re)load the session from Firestore, e.g., when the websocket connects or after a rewind.
+
+        Returns: all messages stored for the session (list of dict), including rewound messages and visualizations
+        """
+        messages = fetch_message_history(self.user_id, self.session_id)
+        self.messages = list(messages)
+        self.rebuild_views()
+        logger.info("Loaded session", user_id=self.user_id, session_id=self.session_id, messages=len(messages))
+        return messages
+
+    def rebuild_views(self):
+        self.annotated_history, self.history_for_gpt = [], []
+        for message in self.messages:
+            self.add_to_views(message)
+
+    def add_to_views(self, message_dict: dict):
+        if is_dialogue_message(message_dict):
+            self.annotated_history.append(to_annotated_response(message_dict))
+            self.history_for_gpt.append(to_gpt_message(message_dict))
+
+    async def append(self, message: dict | ChatCompletionMessage | AnnotatedResponse, state_metadata=None):
+        # Write a message to Firestore and add it to the in-memory views
+        message_dict = await write_message_to_db(self.user_id, self.session_id, message, state_metadata)
+        self.messages.append(message_dict)
+        self.add_to_views(message_dict)
+
+    async def discard_since(self, count: int):
+        """
+        Remove the messages appended after the first `count` ones from Firestore and the in-memory views,
+        e.g., those of a turn that failed and is processed again
+        - count: the number of messages to keep (int), the length of `messages` before the turn
+        """
+        discarded = self.messages[count:]
+        if not discarded:
+            return
+        await remove_messages_from_db(self.user_id, self.session_id, discarded)
+        del self.messages[count:]
+        self.rebuild_views()
+        logger.info("Discarded messages", user_id=self.user_id, session_id=self.session_id, messages=len(discarded))
+
+    async def rewind(self) -> int:
+        """
+        Mark the last user message that is not rewound, and all messages after it, as rewound in Firestore
+        (with one write of the session's messages) and leave them out of the in-memory views
+
+        Returns: the number of messages marked as rewound (int)
+        """
+        user_message_idx = next((i for i in range(len(self.messages) - 1, -1, -1)
+                                 if self.messages[i].get("role") == "user" and not self.messages[i].get("rewind")), None)
+        if user_message_idx is None:
+            return 0
+        messages = self.messages[:user_message_idx] + [dict(message, rewind=True) for message in self.messages[user_message_idx:]]
+        await write_message_history(self.user_id, self.session_id, messages)
+        self.messages = messages
+        self.rebuild_views()
+        logger.info("Rewound messages", user_id=self.user_id, session_id=self.session_id, messages=len(messages) - user_message_idx)
+        return len(messages) - user_message_idx
+
+    async def append_tool_result(self, tool_call: ChatCompletionMessageToolCall, result: str):
+        await self.append({
+            "tool_call_id": tool_call.id,
+            "role": "tool",
+            "name": tool_call.function.name,
+            "response": result
+        })
+
+    @property
+    def states(self) -> list:
+        # The dialogue state of each message in the history
+        return [annotated_response.end_state for annotated_response in self.annotated_history]
@@ -0,0 +1,134 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+# This file defines a cache for the results of data function calls (describe, visualize).
+# Entries are keyed on what the result depends on (user, data source, normalized time range,
+# granularity and data version), not on the websocket or session that requested them, so that
+# results are reused across reconnects and sessions. Side effects (loading frames, sending
+# visualizations) are not cached and run on every call, see gpt/functions.py. Results that a tool
+# call is likely to need can be computed ahead of it with `warm` (see gpt/prefetch.py).
+
+import time
+import asyncio
+import contextvars
+from collections import OrderedDict
+import pandas as pd
+
+from data.fetch import LIVE_DATA_TTL
+from tracing import Tracer
+from logs import get_logger
+logger = get_logger("cache")
+
+# Ranges that ended this long ago are assumed to receive no more uploads
+SETTLED_AFTER = pd.Timedelta(days=2)
+MAX_ENTRIES = 512
+
+
+def data_version(end: pd.Timestamp) -> str:
+    """
+    Return the version of the data in a time range ending at `end`.
+    Settled ranges always have the same version. Ranges that may still receive uploads get a
+    new version every LIVE_DATA_TTL seconds, so their cached results expire together with the
+    cached raw data they were computed from.
+    """
+    if pd.Timestamp(end).tz_localize(None) < pd.Timestamp.now() - SETTLED_AFTER:
+        return "settled"
+    return f"live-{int(time.time() // LIVE_DATA_TTL)}"
+
+
+class ToolResultCache:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = object.__new__(cls)
+            cls._instance.entries = OrderedDict()  # key -> (result, session_id)
+            cls._instance.pending = {}  # key -> task computing the result
+            cls._instance.hits = 0
+            cls._instance.misses = 0
+            cls._instance.cross_session_hits = 0  # hits on results computed for another session
+            cls._instance.warmed = set()  # keys computed by `warm` that no lookup used yet
+            cls._instance.prefetches = 0
+            cls._instance.prefetch_hits = 0  # lookups that found a result (or computation) started by `warm`
+        return cls._instance
+
+    async def get_or_compute(self, key: tuple, session_id: str, compute):
+        """
+        Return the cached result for `key`, or await `compute()` and cache its result.
+        Concurrent misses for the same key share one computation. Exceptions are not cached.
+        - key: the cache key (tuple), see `describe_key` and `visualize_key` in gpt/functions.py
+        - session_id: the session requesting the result (str), only used for the hit metrics
+        - compute: a function without arguments that returns a coroutine computing the result
+        """
+        if key in self.warmed:
+            self.warmed.discard(key)
+            self.prefetch_hits += 1
+        if key in self.entries:
+            result, computed_for = self.entries[key]
+            self.entries.move_to_end(key)
+            self.hits += 1
+            Tracer().current().set(cache="hit")
+            if computed_for != session_id:
+                self.cross_session_hits += 1
+            logger.debug("Tool result cache hit", tool=key[0], user_id=key[1], hits=self.hits, misses=self.misses)
+            return result
+
+        self.misses += 1
+        if key in self.pending:
+            Tracer().current().set(cache="shared")
+            return await asyncio.shield(self.pending[key])
+
+        Tracer().current().set(cache="miss")
+        self.pending[key] = asyncio.ensure_future(compute())
+        try:
+            result = await asyncio.shield(self.pending[key])
+        finally:
+            del self.pending[key]
+        self.store(key, result, session_id)
+        return result
+
+    def store(self, key: tuple, result, session_id: str):
+        self.entries[key] = (result, session_id)
+        if len(self.entries) > MAX_ENTRIES:
+            evicted, _ = self.entries.popitem(last=False)
+            self.warmed.discard(evicted)
+
+    def warm(self, key: tuple, session_id: str, compute) -> bool:
+        """
+        Start computing the result for `key` in the background, unless it is cached or already being computed.
+        A tool call for the key meanwhile waits for this computation instead of starting another one.
+        The computation runs in an empty context, so it is not part of the trace of the turn that started it.
+        Returns whether a computation was started.
+        """
+        if key in self.entries or key in self.pending:
+            return False
+        self.prefetches += 1
+        self.warmed.add(key)
+        task = asyncio.get_running_loop().create_task(compute(), context=contextvars.Context())
+        self.pending[key] = task
+
+        def done(task: asyncio.Task):
+            if self.pending.get(key) is task:
+                del self.pending[key]
+            if task.cancelled() or task.exception() is not None:
+                self.warmed.discard(key)
+                logger.debug("Prefetch failed", tool=key[0], user_id=key[1], error=repr(task.exception()) if not task.cancelled() else "cancelled")
+                return
+            self.store(key, task.result(), session_id)
+
+        task.add_done_callback(done)
+        return True
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "cross_session_hits": self.cross_session_hits,
+            "prefetches": self.prefetches,
+            "prefetch_hits": self.prefetch_hits,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "cross_session_hit_ratio": self.cross_session_hits / lookups if lookups else 0.0,
+        }
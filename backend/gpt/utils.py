@@ -5,15 +5,44 @@
 from openai.types.chat import ChatCompletionMessage, ChatCompletionMessageToolCall
 from gpt.dsm.annotated_response import AnnotatedResponse
 from firebase_admin import firestore
-from google.cloud.firestore_v1 import ArrayUnion
+from google.cloud.firestore_v1 import ArrayUnion, ArrayRemove
 
 from firebase import FirebaseManager
 firebase_manager = FirebaseManager()
 
 
-def write_message_to_db(user_id: str, session_id: str, message: dict | ChatCompletionMessage | AnnotatedResponse, state_metadata=None):
-    messages_doc_ref = firebase_manager.get_user_doc(user_id).collection('gpt-messages').document(session_id)        
+def fetch_message_history(user_id: str, session_id: str) -> list:
+    messages_doc_ref = firebase_manager.get_user_doc(user_id).collection('gpt-messages').document(session_id)
+    messages_doc = messages_doc_ref.get()
 
+    if not messages_doc.exists:
+        # Document does not exist - make an empty list
+        messages_doc_ref.set({"messages": []}, merge=True)
+        return []
+
+    return messages_doc.to_dict().get("messages", [])    
+
+def is_dialogue_message(msg: dict) -> bool:
+    # Rewound messages and visualizations are not part of the conversation with GPT
+    return not msg.get('rewind') and msg.get('type') != 'visualization'
+
+def to_annotated_response(msg: dict) -> AnnotatedResponse:
+    # Each message has 'role', 'response', 'start_state', 'end_state', and 'transition' fields
+    tool_call_dict = {'name': msg.get('name'), 'tool_call_id': msg.get('tool_call_id')} if msg.get('role') == "tool" else None
+    return AnnotatedResponse(msg.get('role'), msg.get('response'), msg.get('start_state', []), msg.get('end_state', []),
+                             msg.get('transition', None), msg.get('tool_calls', None), tool_call_dict)
+
+def to_gpt_message(msg: dict) -> dict:
+    message_dict = {"role": msg.get('role'), "content": msg.get('response')}
+    if msg.get('tool_calls'):
+        message_dict["tool_calls"] = msg.get('tool_calls')
+    if msg.get('role') == "tool":
+        message_dict["tool_call_id"] = msg.get('tool_call_id')
+        message_dict["name"] = msg.get('name')
+    return message_dict
+
+def message_to_dict(message: dict | ChatCompletionMessage | AnnotatedResponse, state_metadata=None) -> dict:
+    # Convert a message to the format stored in the database
     if isinstance(message, ChatCompletionMessage):
         if message.content or message.content != "None":
             message_dict = {"role": message.role, "response": message.content}        
@@ -35,7 +64,24 @@ def write_message_to_db(user_id: str, session_id: str, message: dict | ChatCompl
         message_dict = message
         if not message_dict.get('rewind'):
             message_dict['rewind'] = False
+    return message_dict
+
+def messages_doc_ref(user_id: str, session_id: str, async_ref=False):
+    # Messages are only written for users whose websocket was accepted, so unlike `FirebaseManager.get_user_doc`,
+    # this does not read the user document to validate the user ID
+    return firebase_manager.get_users_col(async_ref).document(user_id).collection('gpt-messages').document(session_id)
+
+async def write_message_to_db(user_id: str, session_id: str, message: dict | ChatCompletionMessage | AnnotatedResponse, state_metadata=None) -> dict:
+    message_dict = message_to_dict(message, state_metadata)
+
+    # Update the document with the new message (with the async client, so that the write does not block the event loop)
+    await messages_doc_ref(user_id, session_id, async_ref=True).update({"messages": ArrayUnion([message_dict])})
+    return message_dict
 
-    # Update the document with the new message
-    messages_doc_ref.update({"messages": ArrayUnion([message_dict])})
+async def remove_messages_from_db(user_id: str, session_id: str, message_dicts: list):
+    # Remove messages that were written with `write_message_to_db` (every stored copy that is equal to one of them)
+    await messages_doc_ref(user_id, session_id, async_ref=True).update({"messages": ArrayRemove(message_dicts)})
 
+async def write_message_history(user_id: str, session_id: str, message_dicts: list):
+    # Replace all stored messages of a session, e.g., to mark some of them as rewound
+    await messages_doc_ref(user_id, session_id, async_ref=True).update({"messages": message_dicts})
@@ -0,0 +1,87 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+# This file defines the warmup of a user's data when their websocket connects. While the session is
+# resolved and its history is replayed, the user's data sources and tool schema are loaded, and the
+# descriptions of the last WARMUP_DAYS days of their main data sources are computed into the tool result
+# cache (see gpt/tool_cache.py), so that the first `describe` calls of the session over these days, e.g.,
+# "the last 2 weeks" by day, find them there.
+
+import os
+import time
+import asyncio
+import contextvars
+from datetime import timedelta
+
+from firebase import str_to_bool
+from data.data_sources import get_user_data_sources
+from gpt.functions import tool_schema_cache, tool_result_cache, describe_result
+from gpt.prefetch import today
+from tracing import Tracer
+from logs import get_logger
+logger = get_logger("warmup")
+tracer = Tracer()
+
+WARMUP = str_to_bool(os.getenv("WARMUP", "True"))
+# Lengths of the windows to describe, in days. A window ends with the last full day, in the format of the
+# tool calls (e.g., start "2026-10-05" and end "2026-10-18 23:59:59" for the last 2 weeks on 2026-10-19).
+WARMUP_DAYS = [int(days) for days in os.getenv("WARMUP_DAYS", "7,14").split(",")]
+# Data sources to warm up if the user has them, in order, "all" for all of them
+WARMUP_DATA_SOURCES = os.getenv("WARMUP_DATA_SOURCES", "health.stepcount,health.workout")
+# Descriptions computed per connect at most. Each one also takes slots in the caches of `fetch_aggregated_data`
+# and `fetch_raw_data`, which are shared by all users.
+WARMUP_MAX_CALLS = int(os.getenv("WARMUP_MAX_CALLS", "4"))
+
+
+def recent_windows(days: list[int]) -> list[tuple[str, str]]:
+    # The start and end arguments of a `describe` call over each number of days, ending with the last full day
+    last_day = today() - timedelta(days=1)
+    return [((last_day - timedelta(days=length - 1)).isoformat(), f"{last_day.isoformat()} 23:59:59") for length in days]
+
+
+class DataWarmup:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = object.__new__(cls)
+            cls._instance.tasks = {}  # user ID -> running warmup
+        return cls._instance
+
+    def start(self, user_id: str, session_id: str) -> asyncio.Task:
+        """
+        Warm up the user's data in the background, unless a warmup for the user is already running.
+        The warmup runs in an empty context, so it is not part of the trace of the connection that started it.
+        - session_id: the session the user continues or starts (str), which the warmed results are computed for
+        """
+        if not WARMUP:
+            return None
+        task = self.tasks.get(user_id)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(self.warm(user_id, session_id), context=contextvars.Context())
+            self.tasks[user_id] = task
+            task.add_done_callback(lambda _: self.tasks.pop(user_id, None))
+        return task
+
+    async def warm(self, user_id: str, session_id: str):
+        started = time.perf_counter()
+        try:
+            with tracer.trace("warmup", user_id=user_id) as span:
+                # Lists the data sources too, which `fetch_aggregated_data` checks before every fetch
+                await tool_schema_cache.get(user_id)
+                sources = await get_user_data_sources(user_id)
+                if WARMUP_DATA_SOURCES != "all":
+                    sources = [source for source in WARMUP_DATA_SOURCES.split(",") if source in sources]
+                calls = [describe_result(user_id, source, start, end, "day")
+                         for source in sources for start, end in recent_windows(WARMUP_DAYS)][:WARMUP_MAX_CALLS]
+                # Results that are cached or being computed already are not computed again
+                tasks = [tool_result_cache.pending[key] for key, compute in calls if tool_result_cache.warm(key, session_id, compute)]
+                results = await asyncio.gather(*tasks, return_exceptions=True)
+                warmed = sum(not isinstance(result, BaseException) for result in results)
+                span.set(sources=len(sources), calls=len(tasks), warmed=warmed)
+            logger.info("Warmed up user data", user_id=user_id, sources=len(sources), calls=len(tasks), warmed=warmed,
+                        seconds=round(time.perf_counter() - started, 3))
+        except Exception as e:
+            # The tool calls fetch whatever is missing
+            logger.warning("Warmup failed: %s", e, user_id=user_id)
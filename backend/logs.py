@@ -0,0 +1,139 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+# This file sets up logging for the backend. Records go through a queue to a background thread that
+# formats and writes them, so the event loop never waits on stdout. Every module logs to a category
+# (e.g., "data" or "prompts") whose level can be set separately. Prompts, histories and responses are
+# logged with `log_payload`, which only logs a sample of them, truncated, unless LOG_PROMPTS is set.
+
+import os
+import sys
+import json
+import queue
+import random
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+
+ROOT_LOGGER = "gptcoach"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Levels of single categories, e.g., "data=DEBUG,prompts=WARNING"
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # "text" or "json"
+# Debug mode: log every prompt, history and response in full
+LOG_PROMPTS = os.getenv("LOG_PROMPTS", "False").lower() in {"true", "t", "1", "yes", "y"}
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.05"))
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "300"))
+
+# Arguments of the logging methods; other keyword arguments become fields of the record
+LOGGING_ARGUMENTS = {"exc_info", "stack_info", "stacklevel", "extra"}
+
+
+def parse_levels(value: str) -> dict:
+    levels = {}
+    for entry in value.split(","):
+        if "=" in entry:
+            category, level = entry.split("=", 1)
+            levels[category.strip()] = level.strip().upper()
+    return levels
+
+
+class StructuredLogger(logging.LoggerAdapter):
+    """
+    Logger that takes fields as keyword arguments, e.g., `logger.info("LLM call", stage=stage, model=model)`.
+    The fields are kept separate from the message, as keys of the JSON output or key=value pairs of the text output.
+    """
+    def process(self, msg, kwargs):
+        fields = {key: kwargs.pop(key) for key in list(kwargs) if key not in LOGGING_ARGUMENTS}
+        if fields:
+            kwargs["extra"] = {**kwargs.get("extra", {}), "fields": fields}
+        return msg, kwargs
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            text += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            **getattr(record, "fields", {}),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class LogSetup:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = object.__new__(cls)
+            handler = logging.StreamHandler(sys.stdout)
+            handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+            # Unbounded, so logging never blocks; records are small since payloads are truncated.
+            # The QueueHandler merges the arguments into the message (and renders tracebacks) before
+            # queueing, the listener thread formats and writes the records.
+            log_queue = queue.SimpleQueue()
+            cls._instance.listener = QueueListener(log_queue, handler, respect_handler_level=False)
+            cls._instance.listener.start()
+            atexit.register(cls._instance.stop)
+
+            root = logging.getLogger(ROOT_LOGGER)
+            root.setLevel(LOG_LEVEL)
+            root.addHandler(QueueHandler(log_queue))
+            root.propagate = False
+            for category, level in parse_levels(LOG_LEVELS).items():
+                logging.getLogger(f"{ROOT_LOGGER}.{category}").setLevel(level)
+        return cls._instance
+
+    def stop(self):
+        # Write the queued records (e.g., on shutdown). Safe to call more than once.
+        if self.listener._thread is not None:
+            self.listener.stop()
+
+
+def get_logger(category: str) -> StructuredLogger:
+    """
+    Return the logger of a category, e.g., "data" or "prompts"
+    - category: the category (str), whose level can be set with LOG_LEVELS
+    """
+    LogSetup()
+    return StructuredLogger(logging.getLogger(f"{ROOT_LOGGER}.{category}"), {})
+
+
+def log_payload(logger: StructuredLogger, label: str, payload, **fields):
+    """
+    Log a prompt, message history or response at the INFO level. With LOG_PROMPTS, every payload is
+    logged in full. Otherwise, only a fraction (LOG_PAYLOAD_SAMPLE_RATE) is logged, truncated to
+    LOG_PAYLOAD_MAX_CHARS, and payloads that are not logged are never converted to text.
+    - logger: the logger to use (StructuredLogger), usually the "prompts" category
+    - label: what the payload is (str), e.g., "predict_strategy agent prompt"
+    - payload: the payload (any object, converted with str)
+    - fields: additional fields of the record
+    """
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    if LOG_PROMPTS:
+        logger.info("%s: %s", label, payload, **fields)
+        return
+    if random.random() >= LOG_PAYLOAD_SAMPLE_RATE:
+        return
+    text = str(payload)
+    if len(text) > LOG_PAYLOAD_MAX_CHARS:
+        text = text[:LOG_PAYLOAD_MAX_CHARS] + f"... ({len(text)} characters)"
+    logger.info("%s: %s", label, text, sampled=True, **fields)
@@ -5,16 +5,40 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
+import asyncio
+import os
 
-from firebase import FirebaseManager
-from api import data_endpoints, gpt_endpoints, firebase_endpoints
+from firebase import FirebaseManager, str_to_bool
+from api import data_endpoints, gpt_endpoints, firebase_endpoints, metrics_endpoints, admin_endpoints
+from monitoring import MetricsMiddleware, EventLoopLagMonitor
+from logs import LogSetup
+from gpt.jobs import JobQueue
+from gpt.prompts import PromptRegistry
+from gpt.routing import ModelRouter
+
+# Watch the prompt files and reload them when they change (useful while iterating on prompts)
+RELOAD_PROMPTS = str_to_bool(os.getenv('RELOAD_PROMPTS', 'False'))
+# Optional JSON file overriding the model, max_tokens, temperature and timeout of each LLM stage
+MODEL_ROUTES_FILE = os.getenv('MODEL_ROUTES_FILE')
 
 async def on_startup():
     firebase_manager = FirebaseManager()
     firebase_manager.initialize_firebase_app()
 
+    prompt_registry = PromptRegistry()
+    if RELOAD_PROMPTS:
+        asyncio.create_task(prompt_registry.watch())
+
+    if MODEL_ROUTES_FILE:
+        ModelRouter().configure_from_file(MODEL_ROUTES_FILE)
+
+    EventLoopLagMonitor().start()
+    JobQueue().start()
+
 async def on_shutdown():
-    pass
+    await JobQueue().close()
+    # Write the log records that are still queued
+    LogSetup().stop()
 
 
 @asynccontextmanager
@@ -37,8 +61,11 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
 
 
 app.include_router(data_endpoints.router)
 app.include_router(gpt_endpoints.router)
 app.include_router(firebase_endpoints.router)
+app.include_router(metrics_endpoints.router)
+app.include_router(admin_endpoints.router)
@@ -0,0 +1,230 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+# This file defines the metrics served in the Prometheus text format at /metrics (see api/metrics_endpoints.py):
+# counters, gauges and histograms with labels, the metrics of the app, a middleware for HTTP requests and
+# websocket sessions, and an event loop lag monitor. Recording a value is a dictionary update, and values
+# that already exist elsewhere (cache statistics, scheduler queues) are only read when /metrics is scraped.
+# Everything runs on the event loop thread, so there is no locking.
+
+import asyncio
+import time
+from bisect import bisect_left
+from collections import deque
+
+NAMESPACE = "gptcoach"
+LAG_INTERVAL = 0.05  # in seconds
+# Recent lag samples kept for the benchmarks (about an hour at LAG_INTERVAL)
+LAG_SAMPLES = 72_000
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+TURN_BUCKETS = (0.5, 1.0, 2.0, 3.0, 5.0, 8.0, 13.0, 20.0, 30.0, 60.0)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+REGISTRY = []  # every metric, in the order they are rendered
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Metric:
+    """
+    A metric with one value per combination of label values
+    - name: the metric name without the namespace (str), e.g., "turn_duration_seconds"
+    - documentation: the help text (str)
+    - labels: the label names (tuple of str)
+    """
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = f"{NAMESPACE}_{name}"
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}  # label values -> value
+        REGISTRY.append(self)
+
+    def key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def samples(self):
+        # (suffix, label names, label values, value) of every sample
+        for key, value in self.values.items():
+            yield "", self.labels, key, value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for suffix, names, values, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(names, values)} {float(value):g}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        super().__init__(name, documentation, labels)
+        if not labels:
+            self.values[()] = 0
+
+    def set(self, value: float, **labels):
+        self.values[self.key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class CallbackMetric(Metric):
+    """
+    A gauge or counter whose values are read from elsewhere when the metrics are rendered
+    - function: returns the value of each combination of label values (dict of tuple -> float)
+    - type: "gauge" or "counter" (str)
+    """
+    def __init__(self, name: str, documentation: str, labels: tuple, function, type: str = "gauge"):
+        super().__init__(name, documentation, labels)
+        self.function = function
+        self.type = type
+
+    def samples(self):
+        for key, value in self.function().items():
+            yield "", self.labels, key, value
+
+
+class Histogram(Metric):
+    """
+    Counts observations in buckets with the given upper bounds (plus +Inf), and their sum
+    - buckets: the upper bounds of the buckets (tuple of float), in ascending order
+    """
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        entry = self.values.get(key)
+        if entry is None:
+            # [count per bucket (not cumulative), sum]
+            entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self):
+        names = self.labels + ("le",)
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield "_bucket", names, key + ("+Inf" if bound == float("inf") else f"{bound:g}",), cumulative
+            yield "_sum", self.labels, key, total
+            yield "_count", self.labels, key, cumulative
+
+
+def render() -> str:
+    # All metrics in the Prometheus text exposition format
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+# Metrics of the app ----------------------------------------------------------------------------
+WEBSOCKET_SESSIONS = Gauge("websocket_sessions", "Open websocket connections")
+HTTP_REQUESTS_IN_PROGRESS = Gauge("http_requests_in_progress", "HTTP requests being handled")
+HTTP_REQUEST_SECONDS = Histogram("http_request_duration_seconds", "Duration of HTTP requests",
+                                 ("method", "route", "status"))
+TURN_SECONDS = Histogram("turn_duration_seconds", "Duration of chat turns, from the user message to the reply",
+                         ("state", "strategy"), TURN_BUCKETS)
+TURN_ERRORS = Counter("turn_errors_total", "Chat turns that failed", ("error",))
+LLM_REQUEST_SECONDS = Histogram("llm_request_duration_seconds", "Duration of LLM calls, including queueing and retries",
+                                ("stage", "model"))
+LLM_TOKENS = Counter("llm_tokens_total", "Tokens of LLM calls, by type (prompt, cached, completion)",
+                     ("stage", "model", "type"))
+LLM_LOCAL_DECISIONS = Counter("llm_local_decisions_total", "LLM calls skipped because a local classifier answered",
+                              ("stage",))
+FIRESTORE_DOCUMENTS = Counter("firestore_documents_total", "Firestore documents read or written",
+                              ("operation", "collection"))
+JOBS = Counter("jobs_total", "Background jobs by result (done, retried, failed, skipped because already done)",
+               ("job", "result"))
+EVENT_LOOP_LAG = Histogram("event_loop_lag_seconds", f"How late the event loop wakes up a task sleeping for {LAG_INTERVAL}s",
+                           (), LAG_BUCKETS)
+
+
+class MetricsMiddleware:
+    # ASGI middleware counting open websockets and timing HTTP requests by route template (not raw path)
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "websocket":
+            WEBSOCKET_SESSIONS.inc()
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                WEBSOCKET_SESSIONS.dec()
+            return
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        HTTP_REQUESTS_IN_PROGRESS.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_REQUESTS_IN_PROGRESS.dec()
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, method=scope["method"],
+                                         route=getattr(route, "path", "unmatched"), status=status[0])
+
+
+class EventLoopLagMonitor:
+    # Measures how late the event loop wakes up a task sleeping for LAG_INTERVAL
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = object.__new__(cls)
+            cls._instance.samples = deque(maxlen=LAG_SAMPLES)
+            cls._instance.task = None
+        return cls._instance
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(LAG_INTERVAL)
+            lag = max(loop.time() - start - LAG_INTERVAL, 0.0)
+            self.samples.append(lag)
+            EVENT_LOOP_LAG.observe(lag)
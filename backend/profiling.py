@@ -0,0 +1,226 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+# This file defines the tools behind the admin endpoints (see api/admin_endpoints.py): a sampling CPU
+# profiler that writes collapsed stacks (the input of flamegraph.pl, speedscope and similar tools),
+# tracemalloc snapshots of the top allocators, and size estimates of cached values. Nothing here runs
+# unless an admin starts it, since both the profiler and tracemalloc slow the process down.
+
+import os
+import sys
+import time
+import threading
+import tracemalloc
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_PROFILE_INTERVAL = 0.005  # in seconds
+MAX_PROFILE_SECONDS = 300
+# Leaf frames of threads waiting for work (the event loop polling, idle worker threads),
+# left out of the profile unless idle samples are requested
+IDLE_FRAMES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+    ("handlers.py", "dequeue"),
+    ("thread.py", "_worker"),
+}
+
+
+def frame_name(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def collapse_stack(frame, thread_name: str) -> tuple:
+    # The frames of a stack from the root to the leaf, starting with the thread
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame.f_code))
+        frame = frame.f_back
+    names.append(thread_name)
+    return tuple(reversed(names))
+
+
+def is_idle(frame) -> bool:
+    return (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_FRAMES
+
+
+class Profiler:
+    """
+    Samples the stacks of all threads every `interval` seconds from a background thread. Samples are
+    counted per stack, so memory stays bounded by the number of distinct stacks. Since coroutines run
+    on the event loop thread, its stacks show the coroutine that was running when it was sampled.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = object.__new__(cls)
+            cls._instance.stacks = Counter()  # collapsed stack -> samples
+            cls._instance.thread = None
+            cls._instance.stopping = threading.Event()
+            cls._instance.started = None
+            cls._instance.finished = None
+            cls._instance.samples = 0
+        return cls._instance
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, seconds: float, interval: float = DEFAULT_PROFILE_INTERVAL, idle: bool = False):
+        """
+        Start profiling, discarding the previous profile. It stops after `seconds` or when `stop` is called.
+        - seconds: how long to profile (float), at most MAX_PROFILE_SECONDS
+        - interval: the time between samples (float), in seconds
+        - idle: whether to keep the samples of waiting threads (bool)
+        """
+        if self.running:
+            raise RuntimeError("A profile is already running")
+        self.stacks = Counter()
+        self.samples = 0
+        self.stopping.clear()
+        self.started, self.finished = time.time(), None
+        self.thread = threading.Thread(target=self.run, args=(min(seconds, MAX_PROFILE_SECONDS), interval, idle),
+                                       name="profiler", daemon=True)
+        self.thread.start()
+
+    def run(self, seconds: float, interval: float, idle: bool):
+        names = {}
+        deadline = time.monotonic() + seconds
+        own_id = threading.get_ident()
+        while time.monotonic() < deadline and not self.stopping.wait(interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or (not idle and is_idle(frame)):
+                    continue
+                if thread_id not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                self.stacks[collapse_stack(frame, names.get(thread_id, str(thread_id)))] += 1
+            self.samples += 1
+        self.finished = time.time()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def status(self) -> dict:
+        return {
+            "running": self.running,
+            "started": self.started,
+            "finished": self.finished,
+            "samples": self.samples,
+            "stacks": len(self.stacks),
+        }
+
+    def collapsed(self) -> str:
+        # One line per stack, "root;...;leaf count", the format read by flamegraph.pl and speedscope
+        lines = [";".join(stack) + f" {count}" for stack, count in self.stacks.most_common()]
+        return "\n".join(lines) + "\n"
+
+
+def start_tracemalloc(frames: int = 1):
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+    tracemalloc.start(frames)
+
+
+class AllocationSnapshots:
+    # Keeps the last tracemalloc snapshot, so that a new one can be compared to it
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = object.__new__(cls)
+            cls._instance.previous = None
+        return cls._instance
+
+    def top(self, limit: int = 25, group_by: str = "lineno", compare: bool = False) -> dict:
+        """
+        Return the top allocators of memory that is still allocated, with the traced total
+        - limit: the number of allocators to return (int)
+        - group_by: "lineno", "filename" or "traceback" (str)
+        - compare: whether to report the change since the previous snapshot instead (bool)
+        """
+        if not tracemalloc.is_tracing():
+            raise RuntimeError("tracemalloc is not tracing")
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        ))
+        if compare and self.previous is not None:
+            statistics = [{
+                "location": format_traceback(stat.traceback),
+                "size": stat.size,
+                "size_diff": stat.size_diff,
+                "count": stat.count,
+                "count_diff": stat.count_diff,
+            } for stat in snapshot.compare_to(self.previous, group_by)[:limit]]
+        else:
+            statistics = [{
+                "location": format_traceback(stat.traceback),
+                "size": stat.size,
+                "count": stat.count,
+            } for stat in snapshot.statistics(group_by)[:limit]]
+        self.previous = snapshot
+        current, peak = tracemalloc.get_traced_memory()
+        return {"traced_bytes": current, "peak_traced_bytes": peak, "top": statistics}
+
+
+def format_traceback(traceback: tracemalloc.Traceback) -> str:
+    return " <- ".join(f"{frame.filename}:{frame.lineno}" for frame in reversed(traceback))
+
+
+def estimate_bytes(value, seen: set = None) -> int:
+    """
+    Approximate memory used by a value and everything it references, counting shared objects once.
+    DataFrames and arrays are measured with pandas and numpy, which count their buffers.
+    - value: the value to measure (any object)
+    """
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    if isinstance(value, (pd.DataFrame, pd.Series, pd.Index)):
+        usage = value.memory_usage(deep=True)
+        return int(usage.sum()) if isinstance(usage, pd.Series) else int(usage)
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(estimate_bytes(key, seen) + estimate_bytes(item, seen) for key, item in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(estimate_bytes(item, seen) for item in value)
+    elif hasattr(value, "__dict__") and not isinstance(value, type):
+        size += estimate_bytes(vars(value), seen)
+    return size
+
+
+def memoized_entries(function) -> list:
+    """
+    Return the (key, value) pairs cached by an `alru_cache`. Values still being computed are left out.
+    This reads a private attribute of async_lru (2.0), so it returns no entries if that changes.
+    - function: the function decorated with `alru_cache`
+    """
+    cache = getattr(function, "_LRUCacheWrapper__cache", None)
+    if cache is None:
+        return []
+    entries = []
+    for key, item in list(cache.items()):
+        if item.fut.done() and not item.fut.cancelled() and item.fut.exception() is None:
+            entries.append((key, item.fut.result()))
+    return entries
+
+
+def key_user(key) -> str:
+    # The user of a cache key of the memoized functions, whose first argument is the user ID
+    if isinstance(key, str):
+        return key
+    if isinstance(key, (list, tuple)) and key and isinstance(key[0], str):
+        return key[0]
+    return "unknown"
@@ -0,0 +1,83 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Count the tool calls made in each dialogue state and with each strategy in logged conversations in the
+`gpt-messages` collections, for the prefetcher in gpt/prefetch.py.
+
+Run from the backend directory:
+    python -m scripts.build_prefetch_statistics                          # read conversations from Firestore
+    python -m scripts.build_prefetch_statistics --input sessions.json    # use an export of scripts/train_local_classifiers.py
+
+Dates in the arguments are counted relative to the day the session started (from its ID, "session-<ISO time>").
+The statistics are written to `--output` and printed with the calls that would be prefetched.
+"""
+
+import os
+import json
+import argparse
+from datetime import datetime, timezone
+
+from gpt.prefetch import (ToolCallStatistics, PREFETCH_STATISTICS_FILE, PREFETCH_MIN_PROBABILITY, PREFETCH_MIN_TURNS,
+                          call_signature, turn_contexts)
+from gpt.functions import FUNCTION_RESULTS
+from scripts.train_local_classifiers import load_sessions_from_firestore
+
+
+def session_day(session_id: str):
+    return datetime.fromisoformat(session_id.split("session-")[-1]).date()
+
+
+def build_statistics(sessions: list[dict]) -> ToolCallStatistics:
+    statistics = ToolCallStatistics()
+    for session in sessions:
+        try:
+            day = session_day(session["session_id"])
+        except ValueError:
+            continue
+        messages = [m for m in session["messages"] if not m.get('rewind') and m.get('type') != 'visualization']
+        for i, message in enumerate(messages):
+            if message.get("role") != "user":
+                continue
+            reply = next((m for m in messages[i + 1:] if m.get("role") == "assistant"), None)
+            if reply is None:
+                continue
+            signatures = set()
+            for tool_call in reply.get("tool_calls") or []:
+                function = tool_call.get("function", {})
+                if function.get("name") not in FUNCTION_RESULTS:
+                    continue
+                try:
+                    signatures.add(call_signature(function["name"], json.loads(function.get("arguments") or "{}"), day))
+                except ValueError:
+                    continue
+            statistics.record(turn_contexts(message.get("transition"), reply.get("strategy")), signatures)
+    return statistics
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Count the tool calls of each dialogue state and strategy in logged conversations")
+    parser.add_argument("--input", help="JSON file with exported sessions (default: read from Firestore)")
+    parser.add_argument("--output", default=PREFETCH_STATISTICS_FILE, help="JSON file for the statistics")
+    args = parser.parse_args()
+
+    if args.input:
+        with open(args.input, "r") as file:
+            sessions = json.load(file)
+    else:
+        sessions = load_sessions_from_firestore()
+
+    statistics = build_statistics(sessions)
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    statistics.save(args.output, {"built_at": datetime.now(timezone.utc).isoformat(), "sessions": len(sessions)})
+    for context in sorted(statistics.turns):
+        likely = statistics.likely(context, PREFETCH_MIN_PROBABILITY, PREFETCH_MIN_TURNS)
+        print(f"{context}: {statistics.turns[context]} turns, prefetching {len(likely)} calls")
+        for signature, probability in sorted(likely.items(), key=lambda item: -item[1]):
+            print(f"    {probability:.2f} {signature}")
+    print(f"Wrote statistics to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
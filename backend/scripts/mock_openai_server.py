@@ -0,0 +1,99 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+"""
+A local stand-in for the chat completions API, for testing the LLM scheduler (gpt/scheduler.py)
+without calling OpenAI. It enforces per-minute request and token limits, reports them in the same
+headers as the real API, answers with 429s once they are exhausted, and can inject latency and errors.
+
+Run from the backend directory:
+    python -m scripts.mock_openai_server --port 8001 --rpm 60 --tpm 40000 --latency 0.5 --error-rate 0.05
+
+and start the backend with OPENAI_BASE_URL=http://localhost:8001/v1
+"""
+
+import time
+import random
+import asyncio
+import argparse
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+from gpt.scheduler import TokenBucket
+
+app = FastAPI()
+settings = argparse.Namespace()
+requests_bucket, tokens_bucket = TokenBucket(), TokenBucket()
+
+
+def rate_limit_headers() -> dict:
+    def reset(bucket):
+        return f"{(bucket.capacity - bucket.level) / bucket.rate:.3f}s" if bucket.rate else "0s"
+    return {
+        "x-ratelimit-limit-requests": str(settings.rpm),
+        "x-ratelimit-remaining-requests": str(max(int(requests_bucket.level), 0)),
+        "x-ratelimit-reset-requests": reset(requests_bucket),
+        "x-ratelimit-limit-tokens": str(settings.tpm),
+        "x-ratelimit-remaining-tokens": str(max(int(tokens_bucket.level), 0)),
+        "x-ratelimit-reset-tokens": reset(tokens_bucket),
+    }
+
+
+def error(status: int, message: str, error_type: str, retry_after: float = None) -> JSONResponse:
+    headers = rate_limit_headers()
+    if retry_after is not None:
+        headers["retry-after"] = f"{retry_after:.3f}"
+    return JSONResponse({"error": {"message": message, "type": error_type, "code": None, "param": None}},
+                        status_code=status, headers=headers)
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    prompt_tokens = sum(len(str(message.get("content") or "")) // 4 + 4 for message in body["messages"])
+    completion_tokens = min(body.get("max_tokens") or 50, 50)
+
+    wait = max(requests_bucket.wait_time(1), tokens_bucket.wait_time(prompt_tokens + completion_tokens))
+    if wait > 0:
+        return error(429, "Rate limit reached", "requests", retry_after=wait)
+    requests_bucket.consume(1)
+    tokens_bucket.consume(prompt_tokens + completion_tokens)
+
+    await asyncio.sleep(random.uniform(0.5, 1.5) * settings.latency)
+    if random.random() < settings.error_rate:
+        return error(500, "The server had an error while processing your request", "server_error")
+
+    return JSONResponse({
+        "id": f"chatcmpl-mock-{time.time_ns()}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body["model"],
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": settings.reply},
+            "finish_reason": "stop",
+        }],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens},
+    }, headers=rate_limit_headers())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock chat completions server with rate limits")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--rpm", type=int, default=60, help="Requests per minute")
+    parser.add_argument("--tpm", type=int, default=40000, help="Tokens per minute")
+    parser.add_argument("--latency", type=float, default=0.5, help="Mean response time in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests that fail with a 500")
+    parser.add_argument("--reply", default="continue", help="Content of every completion")
+    parser.parse_args(namespace=settings)
+
+    requests_bucket.update(settings.rpm, settings.rpm, 0)
+    tokens_bucket.update(settings.tpm, settings.tpm, 0)
+    uvicorn.run(app, port=settings.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Summarize the traces written to TRACE_FILE (see tracing.py): the slowest turns with their span trees,
+and the time spent per stage over all turns, so that slow turns can be attributed to a stage.
+
+Run from the backend directory:
+    python -m scripts.trace_report ../traces/spans.jsonl
+    python -m scripts.trace_report ../traces/spans.jsonl --root turn --top 5 --min-duration 0.01
+"""
+
+import json
+import argparse
+from collections import defaultdict
+
+from benchmarks.stats import summarize
+
+# Spans with more siblings of the same name than this are shown as one line
+MAX_SIBLINGS = 3
+
+
+def load_traces(path: str) -> dict:
+    # trace ID -> spans of the trace
+    traces = defaultdict(list)
+    with open(path, "r") as file:
+        for line in file:
+            if line.strip():
+                span = json.loads(line)
+                traces[span["trace_id"]].append(span)
+    return traces
+
+
+def print_tree(span: dict, children: dict, min_duration: float, depth: int = 0):
+    attributes = ", ".join(f"{key}={value:.4g}" if isinstance(value, float) else f"{key}={value}"
+                           for key, value in span["attributes"].items() if key != "arguments")
+    error = f"  ERROR {span['error']}" if span["error"] else ""
+    print(f"{'  ' * depth}{span['duration']:8.3f}s  {span['name']}  {attributes}{error}")
+
+    by_name = defaultdict(list)
+    for child in children[span["span_id"]]:
+        by_name[child["name"]].append(child)
+    for child in sorted(children[span["span_id"]], key=lambda child: child["start"]):
+        siblings = by_name[child["name"]]
+        if len(siblings) > MAX_SIBLINGS:
+            if child is siblings[0]:
+                total = sum(sibling["duration"] for sibling in siblings)
+                documents = sum(sibling["attributes"].get("documents", 0) for sibling in siblings)
+                print(f"{'  ' * (depth + 1)}{total:8.3f}s  {child['name']} x{len(siblings)}  documents={documents}")
+        elif child["duration"] >= min_duration:
+            print_tree(child, children, min_duration, depth + 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize traces written by the tracing layer")
+    parser.add_argument("path", help="JSON-lines file written by the JSON-lines exporter (TRACE_FILE)")
+    parser.add_argument("--root", default="turn", help="Name of the root spans to report on")
+    parser.add_argument("--top", type=int, default=10, help="Number of slowest traces to show")
+    parser.add_argument("--min-duration", type=float, default=0.0, help="Hide spans shorter than this, in seconds")
+    args = parser.parse_args()
+
+    roots, stages = [], defaultdict(list)
+    children_by_trace = {}
+    for trace_id, spans in load_traces(args.path).items():
+        root = next((span for span in spans if span["parent_id"] is None), None)
+        if root is None or root["name"] != args.root:
+            continue
+        roots.append(root)
+        children = defaultdict(list)
+        for span in spans:
+            children[span["parent_id"]].append(span)
+            if span["parent_id"] is not None:
+                stages[span["name"]].append(span["duration"])
+        children_by_trace[trace_id] = children
+
+    print(f"{len(roots)} {args.root} traces")
+    print(json.dumps({"duration": summarize([root["duration"] for root in roots])}))
+    print("\nTime per stage (all traces):")
+    for name, durations in sorted(stages.items(), key=lambda item: -sum(item[1])):
+        summary = summarize(durations)
+        print(f"  {name:<40} total {sum(durations):9.3f}s  count {summary['count']:6}  p50 {summary['p50']:.4f}s  p95 {summary['p95']:.4f}s")
+
+    for root in sorted(roots, key=lambda root: -root["duration"])[:args.top]:
+        print(f"\nTrace {root['trace_id']}")
+        print_tree(root, children_by_trace[root["trace_id"]], args.min_duration)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Train the local classifiers used by gpt/local_classifier.py from logged conversations in the
+`gpt-messages` collections, and report how often they agree with the LLM decisions that were logged.
+
+Run from the backend directory:
+    python -m scripts.train_local_classifiers                          # read conversations from Firestore
+    python -m scripts.train_local_classifiers --export sessions.json   # ... and save them for offline runs
+    python -m scripts.train_local_classifiers --input sessions.json    # train from a previous export
+
+Sessions are split into train and test sets by session ID. For each task, the confidence threshold is the
+lowest one at which the local answers agree with the logged LLM answers at least `--target-agreement`
+of the time on the test set. Tasks that never reach the target get a threshold above 1, i.e., always use the LLM.
+Artifacts and the evaluation report (report.json, report.md) are written to `--output`.
+"""
+
+import os
+import json
+import zlib
+import argparse
+from datetime import datetime, timezone
+
+from firebase import FirebaseManager
+from gpt.dsm.dialogue_state_manager import DialogueStateManager
+from gpt.messages import get_message_history_for_gpt, STRATEGIES
+from gpt.local_classifier import (NaiveBayesClassifier, CLASSIFIER_DIRECTORY, TASKS, strategy_features,
+                                  state_completion_features)
+
+THRESHOLDS = [0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 0.97, 0.99]
+NEVER = 1.01
+
+
+def load_sessions_from_firestore() -> list[dict]:
+    firebase_manager = FirebaseManager().initialize_firebase_app()
+    sessions = []
+    for user_doc in firebase_manager.get_users_col().stream():
+        for session_doc in user_doc.reference.collection('gpt-messages').stream():
+            sessions.append({
+                "user_id": user_doc.id,
+                "session_id": session_doc.id,
+                "messages": session_doc.to_dict().get("messages", []),
+            })
+    print(f"Loaded {len(sessions)} sessions from Firestore")
+    return sessions
+
+
+def build_examples(sessions: list[dict], classifier_states: set) -> dict:
+    # Returns {task: [(session_id, features, label), ...]}
+    examples = {task: [] for task in TASKS}
+    for session in sessions:
+        messages = [m for m in session["messages"] if not m.get('rewind') and m.get('type') != 'visualization']
+        history = get_message_history_for_gpt(messages)
+        for i, message in enumerate(messages):
+            if message.get("role") != "user":
+                continue
+            state, next_state = message.get("end_state"), message.get("transition")
+            reply = next((m for m in messages[i + 1:] if m.get("role") == "assistant"), None)
+
+            if state in classifier_states and next_state:
+                label = "continue" if next_state == state else "completed"
+                examples["state_completion"].append((session["session_id"], state_completion_features(state, history[:i + 1]), label))
+
+            if reply is None:
+                continue
+            if reply.get("strategy") in STRATEGIES:
+                features = strategy_features(next_state, history[:i], message.get("response"))
+                examples["strategy"].append((session["session_id"], features, reply["strategy"]))
+    return examples
+
+
+def is_test_session(session_id: str, test_fraction: float) -> bool:
+    return zlib.crc32(session_id.encode()) % 100 < test_fraction * 100
+
+
+def evaluate(model: NaiveBayesClassifier, test_examples: list) -> dict:
+    predictions = [(*model.predict(features), label) for features, label in test_examples]
+    report = {
+        "test_examples": len(test_examples),
+        "agreement": sum(p == label for p, _, label in predictions) / len(predictions) if predictions else None,
+        "thresholds": [],
+    }
+    for threshold in THRESHOLDS:
+        covered = [(p, label) for p, confidence, label in predictions if confidence >= threshold]
+        report["thresholds"].append({
+            "threshold": threshold,
+            "coverage": len(covered) / len(predictions) if predictions else 0.0,
+            "agreement": sum(p == label for p, label in covered) / len(covered) if covered else None,
+        })
+    return report
+
+
+def choose_threshold(report: dict, target_agreement: float) -> float:
+    for row in report["thresholds"]:
+        if row["coverage"] > 0 and row["agreement"] is not None and row["agreement"] >= target_agreement:
+            return row["threshold"]
+    return NEVER
+
+
+def write_markdown_report(reports: dict, file_path: str):
+    lines = ["# Local classifier evaluation", "",
+             "Agreement is measured against the decisions logged from the LLM on held-out sessions. "
+             "Coverage is the fraction of decisions answered locally at a threshold.", ""]
+    for task, report in reports.items():
+        lines += [f"## {task}", ""]
+        if report.get("skipped"):
+            lines += [f"Skipped: {report['skipped']}", ""]
+            continue
+        lines += [f"- Labels: {', '.join(report['labels'])}",
+                  f"- Train / test examples: {report['train_examples']} / {report['test_examples']}",
+                  f"- Overall agreement: {report['agreement']:.3f}" if report['agreement'] is not None else "- Overall agreement: n/a",
+                  f"- Chosen threshold: {report['threshold']}", "",
+                  "| Threshold | Coverage | Agreement |", "|---|---|---|"]
+        for row in report["thresholds"]:
+            agreement = f"{row['agreement']:.3f}" if row["agreement"] is not None else "n/a"
+            lines.append(f"| {row['threshold']} | {row['coverage']:.3f} | {agreement} |")
+        lines.append("")
+    with open(file_path, "w") as file:
+        file.write("\n".join(lines))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train local classifiers from logged conversations")
+    parser.add_argument("--input", help="JSON file with exported sessions (default: read from Firestore)")
+    parser.add_argument("--export", help="Save the sessions read from Firestore to this JSON file")
+    parser.add_argument("--output", default=CLASSIFIER_DIRECTORY, help="Directory for the artifacts and report")
+    parser.add_argument("--test-fraction", type=float, default=0.2)
+    parser.add_argument("--target-agreement", type=float, default=0.95)
+    parser.add_argument("--min-examples", type=int, default=50, help="Tasks with fewer examples are skipped")
+    args = parser.parse_args()
+
+    if args.input:
+        with open(args.input, "r") as file:
+            sessions = json.load(file)
+    else:
+        sessions = load_sessions_from_firestore()
+        if args.export:
+            with open(args.export, "w") as file:
+                json.dump(sessions, file, default=str)
+
+    dialogue_manager = DialogueStateManager(base_directory='../prompts/dialogue/states')
+    dialogue_manager.load_states()
+    classifier_states = {state_id for state_id, state in dialogue_manager.states.items() if state.transition_type == 'StateClassifier'}
+
+    os.makedirs(args.output, exist_ok=True)
+    reports = {}
+    for task, task_examples in build_examples(sessions, classifier_states).items():
+        if len(task_examples) < args.min_examples:
+            reports[task] = {"skipped": f"only {len(task_examples)} examples (need {args.min_examples})"}
+            print(f"Skipping {task}: {reports[task]['skipped']}")
+            continue
+
+        train = [(features, label) for session_id, features, label in task_examples if not is_test_session(session_id, args.test_fraction)]
+        test = [(features, label) for session_id, features, label in task_examples if is_test_session(session_id, args.test_fraction)]
+        model = NaiveBayesClassifier.train(task, train)
+        report = evaluate(model, test)
+        report.update({"labels": model.labels, "train_examples": len(train), "threshold": choose_threshold(report, args.target_agreement)})
+
+        model.threshold = report["threshold"]
+        model.metadata = {"trained_at": datetime.now(timezone.utc).isoformat(), "evaluation": report}
+        model.save(os.path.join(args.output, f"{task}.json"))
+        reports[task] = report
+        print(f"{task}: agreement {report['agreement']}, threshold {report['threshold']}")
+
+    with open(os.path.join(args.output, "report.json"), "w") as file:
+        json.dump(reports, file, indent=2)
+    write_markdown_report(reports, os.path.join(args.output, "report.md"))
+    print(f"Wrote artifacts and report to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Tests of the token counting and the context window in gpt/context.py.
+
+Run from the backend directory:
+    python -m pytest tests
+"""
+
+import time
+import pytest
+
+from gpt import context
+from gpt.context import (ContextWindow, count_tokens, count_prompt_tokens, get_encoding, CHARS_PER_TOKEN,
+                         ENCODING_RETRY_SECONDS, MEMORY_KEEP_TURNS)
+
+MODEL = "test-model"
+
+
+class FakeEncoding:
+    def encode(self, text: str) -> list:
+        return text.split()
+
+
+@pytest.fixture(autouse=True)
+def reset_encodings():
+    yield
+    wait_for_load(MODEL)
+    context.encodings.pop(MODEL, None)
+    context.encoding_failures.pop(MODEL, None)
+
+
+def wait_for_load(model: str):
+    deadline = time.monotonic() + 5
+    while model in context.encodings_loading and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_counts_are_approximate_while_the_tokenizer_loads(monkeypatch):
+    monkeypatch.setattr(context.tiktoken, "encoding_for_model", lambda model: FakeEncoding())
+    text = "one two three four five six"
+    assert count_tokens(text, MODEL) == len(text) // CHARS_PER_TOKEN + 1
+    wait_for_load(MODEL)
+    assert count_tokens(text, MODEL) == 6
+
+
+def test_failed_load_is_retried_after_the_backoff(monkeypatch):
+    def unavailable(model):
+        raise ConnectionError("offline")
+
+    monkeypatch.setattr(context.tiktoken, "encoding_for_model", unavailable)
+    assert get_encoding(MODEL) is None
+    wait_for_load(MODEL)
+    assert MODEL in context.encoding_failures
+
+    # Within the backoff, no new load is started
+    monkeypatch.setattr(context.tiktoken, "encoding_for_model", lambda model: FakeEncoding())
+    assert get_encoding(MODEL) is None
+    assert MODEL not in context.encodings_loading
+
+    context.encoding_failures[MODEL] -= ENCODING_RETRY_SECONDS
+    assert get_encoding(MODEL) is None
+    wait_for_load(MODEL)
+    assert isinstance(get_encoding(MODEL), FakeEncoding)
+    assert MODEL not in context.encoding_failures
+
+
+def conversation(turns: int, words: int = 40) -> list:
+    # The shared system prompt, `turns` earlier turns, the current user message and the stage instructions
+    messages = [{"role": "system", "content": "You are a health coach."}]
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"user message {i} " + "word " * words})
+        messages.append({"role": "assistant", "content": f"assistant message {i} " + "word " * words})
+    messages.append({"role": "user", "content": "current message"})
+    messages.append({"role": "system", "content": "Stage instructions."})
+    return messages
+
+
+@pytest.fixture
+def approximate_counts(monkeypatch):
+    # Character-based counts, so the tests do not depend on a downloaded tokenizer
+    monkeypatch.setattr(context, "get_encoding", lambda model: None)
+    monkeypatch.setattr(context, "STAGE_BUDGETS", {"generate_response": 1000})
+
+
+def contents(messages: list) -> list:
+    return [message["content"] for message in messages]
+
+
+def test_messages_that_fit_are_unchanged(approximate_counts):
+    messages = conversation(3)
+    assert ContextWindow().fit("generate_response", messages, "gpt-4") is messages
+
+
+def test_oldest_turns_are_dropped_with_a_note(approximate_counts):
+    messages = conversation(12)
+    window = ContextWindow()
+    fitted = window.fit("generate_response", messages, "gpt-4")
+    assert count_prompt_tokens(fitted, "gpt-4") <= 1000
+    assert window.dropped_turns > 0
+    assert fitted[1]["content"].startswith("Earlier parts of the conversation were omitted")
+    assert contents(fitted[-2:]) == contents(messages[-2:])
+    assert fitted[2]["content"].startswith(f"user message {window.dropped_turns} ")
+
+    # Later stages of the turn drop at least as many turns, so they share the prefix
+    later = window.fit("generate_response", messages[:-1] + [{"role": "system", "content": "Other instructions."}], "gpt-4")
+    assert contents(later[:-1]) == contents(fitted[:-1])
+
+
+def test_memory_is_added_to_a_history_that_fits(approximate_counts):
+    messages = conversation(3)
+    fitted = ContextWindow(memory="What you remember: walks daily", memory_covers=4).fit("generate_response", messages, "gpt-4")
+    assert contents(fitted) == contents(messages[:1]) + ["What you remember: walks daily"] + contents(messages[1:])
+
+
+def test_memory_replaces_covered_turns_when_the_history_is_too_long(approximate_counts):
+    messages = conversation(12)
+    window = ContextWindow(memory="What you remember: walks daily", memory_covers=2 * 8)
+    fitted = window.fit("generate_response", messages, "gpt-4")
+    assert fitted[1]["content"] == "What you remember: walks daily"
+    # The covered turns get no note, the turns after them are kept
+    assert fitted[2]["content"] == "user message 8 " + "word " * 40
+    assert window.dropped_turns == 8
+
+
+def test_memory_substitution_threshold(approximate_counts, monkeypatch):
+    monkeypatch.setattr(context, "MEMORY_SUBSTITUTION_FRACTION", 0.5)
+    messages = conversation(6)
+    assert count_prompt_tokens(messages, "gpt-4") <= 1000
+    window = ContextWindow(memory="What you remember: walks daily", memory_covers=2 * 6)
+    fitted = window.fit("generate_response", messages, "gpt-4")
+    # All but the last MEMORY_KEEP_TURNS turns are covered
+    assert window.dropped_turns == 6 - MEMORY_KEEP_TURNS
+    assert fitted[2]["content"].startswith(f"user message {6 - MEMORY_KEEP_TURNS} ")
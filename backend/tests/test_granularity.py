@@ -0,0 +1,30 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Tests of the granularity planner in data/granularity.py.
+"""
+
+import pandas as pd
+
+from data.granularity import Granularity, count_buckets, plan_granularity, DEFAULT_MAX_ROWS
+
+
+def test_count_buckets_includes_partial_buckets():
+    start, end = pd.Timestamp("2024-09-04 10:00"), pd.Timestamp("2024-09-06")
+    assert count_buckets(start, end, Granularity("day")) == 2
+    # 2024-09-01 and 2024-09-08 are Sundays
+    assert count_buckets(pd.Timestamp("2024-09-01"), pd.Timestamp("2024-09-15"), Granularity("week")) == 2
+    assert count_buckets(pd.Timestamp("2024-09-03"), pd.Timestamp("2024-09-15"), Granularity("week")) == 2
+
+
+def test_a_month_of_days_keeps_the_requested_granularity():
+    start, end = pd.Timestamp("2024-09-01"), pd.Timestamp("2024-10-01")
+    assert plan_granularity(start, end, Granularity("day"), DEFAULT_MAX_ROWS) == "day"
+
+
+def test_too_many_buckets_are_coarsened():
+    start, end = pd.Timestamp("2024-04-01"), pd.Timestamp("2024-10-01")
+    assert count_buckets(start, end, Granularity("day")) > DEFAULT_MAX_ROWS
+    assert plan_granularity(start, end, Granularity("day"), DEFAULT_MAX_ROWS) == "week"
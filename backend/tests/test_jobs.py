@@ -0,0 +1,101 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Tests of the background jobs in gpt/jobs.py, on the in-memory Firestore stand-in (benchmarks/memory_firestore.py).
+"""
+
+import time
+import asyncio
+import pytest
+
+from firebase import FirebaseManager
+from benchmarks.memory_firestore import MemoryStore, AsyncMemoryClient
+from gpt import jobs
+from gpt.jobs import Job, JobQueue, job, job_id, user_doc_ref
+
+USER_ID = "test-jobs-user"
+
+
+class BlockingClient:
+    # The sync client blocks the event loop, so jobs must not use it
+    def __getattr__(self, name):
+        raise AssertionError(f"A job used the sync Firestore client ({name})")
+
+
+@pytest.fixture
+def job_queue(monkeypatch):
+    firebase_manager = FirebaseManager()
+    monkeypatch.setattr(firebase_manager, "db", BlockingClient(), raising=False)
+    monkeypatch.setattr(firebase_manager, "async_db", AsyncMemoryClient(MemoryStore()), raising=False)
+    monkeypatch.setattr(JobQueue, "_instance", None)
+    return JobQueue()
+
+
+async def user_data() -> dict:
+    return (await user_doc_ref(USER_ID).get()).to_dict() or {}
+
+
+def test_job_status_is_kept_in_the_user_document(job_queue):
+    async def scenario():
+        await user_doc_ref(USER_ID).set({"jobs": {}})
+        await job_queue.run(Job("save_summary", USER_ID, "session-1:done", {"description": "Walks after lunch"}))
+        return await user_data()
+
+    data = asyncio.run(scenario())
+    assert data["gpt-summary"] == "Walks after lunch"
+    record = data["jobs"][job_id("save_summary", "session-1:done")]
+    assert (record["status"], record["attempts"]) == ("done", 1)
+
+
+def test_completed_jobs_are_not_run_again(job_queue):
+    calls = []
+
+    @job("test_counting")
+    async def counting(user_id: str):
+        calls.append(user_id)
+
+    async def scenario():
+        await user_doc_ref(USER_ID).set({"jobs": {}})
+        await job_queue.run(Job("test_counting", USER_ID, "key", {}))
+        await job_queue.run(Job("test_counting", USER_ID, "key", {}))
+
+    asyncio.run(scenario())
+    assert calls == [USER_ID]
+
+
+def test_failed_jobs_are_recorded(job_queue, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_MAX_ATTEMPTS", 1)
+
+    @job("test_failing")
+    async def failing(user_id: str):
+        raise RuntimeError("LLM unavailable")
+
+    async def scenario():
+        await user_doc_ref(USER_ID).set({"jobs": {}})
+        failed = Job("test_failing", USER_ID, "key", {})
+        job_queue.active[failed.id] = failed
+        await job_queue.run(failed)
+        return await user_data()
+
+    record = asyncio.run(scenario())["jobs"][job_id("test_failing", "key")]
+    assert record["status"] == "failed"
+    assert record["error"] == "RuntimeError: LLM unavailable"
+    assert job_queue.active == {}
+
+
+def test_old_finished_jobs_are_removed(job_queue):
+    now = time.time()
+    records = {
+        "old_done": {"name": "save_summary", "key": "a", "status": "done", "updated": now - jobs.JOB_RETENTION - 1},
+        "old_failed": {"name": "save_summary", "key": "b", "status": "failed", "updated": now - jobs.JOB_RETENTION - 1},
+        "recent_done": {"name": "save_summary", "key": "c", "status": "done", "updated": now},
+    }
+
+    async def scenario():
+        await user_doc_ref(USER_ID).set({"jobs": records})
+        await job_queue.resume(USER_ID, records)
+        return await user_data()
+
+    assert list(asyncio.run(scenario())["jobs"]) == ["recent_done"]
@@ -0,0 +1,62 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Tests of the conversation memory in gpt/memory.py.
+"""
+
+import asyncio
+import pytest
+
+from gpt.jobs import JobQueue, job_id
+from gpt.memory import UserMemories, ConversationMemory, MEMORY_FIELD, parse_sections, MEMORY_MAX_ITEMS
+
+
+def test_parse_sections_caps_the_items():
+    content = 'Here it is: {"facts": "Walks to work", "goals": [' + ", ".join(f'"goal {i}"' for i in range(20)) + ']}'
+    sections = parse_sections(content)
+    assert sections["facts"] == ["Walks to work"]
+    assert len(sections["goals"]) == MEMORY_MAX_ITEMS
+    assert sections["plan"] == []
+    with pytest.raises(ValueError):
+        parse_sections("no JSON here")
+
+
+def test_render_is_empty_without_anything_to_remember():
+    assert ConversationMemory().render() is None
+    assert "Goals:\n- 10k steps" in ConversationMemory({"goals": ["10k steps"]}).render()
+
+
+def test_update_locks_are_removed_once_unused(monkeypatch):
+    monkeypatch.setattr(UserMemories, "_instance", None)
+    memories = UserMemories()
+    order = []
+
+    async def update(name: str):
+        async with memories.updating("user"):
+            order.append(f"{name} start")
+            await asyncio.sleep(0.01)
+            order.append(f"{name} end")
+
+    async def scenario():
+        await asyncio.gather(update("first"), update("second"))
+
+    asyncio.run(scenario())
+    assert order == ["first start", "first end", "second start", "second end"]
+    assert memories.locks == {}
+
+
+def test_connect_only_checks_the_previous_session_once(monkeypatch):
+    monkeypatch.setattr(UserMemories, "_instance", None)
+    enqueued = []
+    monkeypatch.setattr(JobQueue, "enqueue", lambda self, name, user_id, key, **arguments: enqueued.append(key))
+    sessions = {"session-2026-10-01": 12, "session-2026-10-10": 8, "session-2026-10-18": 4}
+    user_data = {MEMORY_FIELD: {"sections": {}, "sessions": sessions}}
+
+    UserMemories().load("user", user_data, "session-2026-10-19")
+    assert enqueued == ["session-2026-10-18:4:end"]
+
+    user_data["jobs"] = {job_id("update_memory", "session-2026-10-18:4:end"): {"status": "done"}}
+    UserMemories().load("user", user_data, "session-2026-10-19")
+    assert enqueued == ["session-2026-10-18:4:end"]
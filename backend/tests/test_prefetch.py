@@ -0,0 +1,94 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Tests of the prefetcher in gpt/prefetch.py: a prefetched result is found by the tool call it predicted.
+"""
+
+import json
+import asyncio
+from datetime import timedelta
+import pytest
+from openai.types.chat import ChatCompletionMessageToolCall
+
+from gpt import functions
+from gpt.functions import handle_function_call, tool_result_cache
+from gpt.session import ConversationSession
+from gpt.prefetch import Prefetcher, ToolCallStatistics, PREFETCH_MIN_TURNS, call_signature, call_from_signature, today
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def send_json(self, data: dict):
+        self.sent.append(data)
+
+
+def tool_call(name: str, arguments: dict) -> ChatCompletionMessageToolCall:
+    return ChatCompletionMessageToolCall(id="call_1", type="function", function={"name": name, "arguments": json.dumps(arguments)})
+
+
+@pytest.fixture
+def prefetcher():
+    prefetcher = Prefetcher()
+    statistics = prefetcher.statistics
+    prefetcher.statistics = ToolCallStatistics()
+    yield prefetcher
+    prefetcher.statistics = statistics
+
+
+def test_signature_keeps_the_dates_relative_to_the_day():
+    day = today()
+    arguments = {"data_source_name": "health.stepcount", "start": (day - timedelta(days=7)).isoformat(),
+                 "end": f"{(day - timedelta(days=1)).isoformat()}T23:59:59", "granularity": "day"}
+    signature = call_signature("describe", arguments, day)
+    assert json.loads(signature)["arguments"]["start"] == "-7"
+    assert json.loads(signature)["arguments"]["end"] == "-1 23:59:59"
+
+    name, prefetched = call_from_signature(signature, day + timedelta(days=1))
+    assert name == "describe"
+    assert prefetched["start"] == (day - timedelta(days=6)).isoformat()
+
+
+def test_prefetched_describe_key_matches_the_tool_call(prefetcher, monkeypatch):
+    computed = []
+
+    async def fetch_aggregated_data(user_id, data_source, start, end, granularity, **kwargs):
+        computed.append((data_source, start, end, granularity))
+        return [], f"{data_source} from {start} to {end}"
+
+    monkeypatch.setattr(functions, "fetch_aggregated_data", fetch_aggregated_data)
+    day = today()
+    arguments = {"data_source_name": "health.stepcount", "start": (day - timedelta(days=7)).isoformat(),
+                 "end": f"{(day - timedelta(days=1)).isoformat()}T23:59:59", "granularity": "day"}
+    call = tool_call("describe", arguments)
+    for _ in range(PREFETCH_MIN_TURNS):
+        prefetcher.record_turn("past_experience", "Reflect", [call])
+
+    async def turn():
+        assert prefetcher.prefetch("test-prefetch-describe", "session-1", state="past_experience") == 1
+        await asyncio.sleep(0)
+        hits = tool_result_cache.prefetch_hits
+        result = await handle_function_call(call, FakeWebSocket(), ConversationSession("test-prefetch-describe", "session-1"))
+        return result, tool_result_cache.prefetch_hits - hits
+
+    result, hits = asyncio.run(turn())
+    assert result == f"health.stepcount from {arguments['start']} to {arguments['end'].replace('T', ' ')}"
+    assert hits == 1
+    assert len(computed) == 1
+
+
+def test_describe_and_visualize_keys_match_for_generated_arguments():
+    day = today()
+    for name, arguments in [
+        ("describe", {"data_source_name": "health.stepcount", "start": (day - timedelta(days=30)).isoformat(),
+                      "end": day.isoformat(), "granularity": "week"}),
+        ("visualize", {"data_source_name": "health.heartrate", "date": (day - timedelta(days=2)).isoformat(), "granularity": "week"}),
+        ("visualize", {"data_source_name": "health.heartrate", "date": "", "granularity": ""}),
+    ]:
+        key, _ = functions.FUNCTION_RESULTS[name](user_id="user", **arguments)
+        _, prefetched = call_from_signature(call_signature(name, arguments, day), day)
+        prefetched_key, _ = functions.FUNCTION_RESULTS[name](user_id="user", **prefetched)
+        assert prefetched_key == key
@@ -0,0 +1,214 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Tests of the LLM scheduler in gpt/scheduler.py: priorities, deadlines, retries and rate limits.
+"""
+
+import time
+import asyncio
+import httpx
+import openai
+import pytest
+
+from gpt import scheduler
+from gpt.scheduler import (LLMScheduler, LLMDeadlineExceeded, PrioritySlots, RateLimitQueue, TokenBucket,
+                           USER_FACING, AUXILIARY, RETRY_MAX_DELAY, parse_duration)
+
+
+class FakeResponse:
+    def __init__(self, headers: dict = None):
+        self.headers = headers or {}
+
+
+def rate_limit_error(retry_after: str = None) -> openai.RateLimitError:
+    headers = {"retry-after": retry_after} if retry_after else {}
+    response = httpx.Response(429, headers=headers, request=httpx.Request("POST", "http://localhost/v1/chat/completions"))
+    return openai.RateLimitError("Rate limit reached", response=response, body=None)
+
+
+@pytest.fixture
+def llm_scheduler(monkeypatch):
+    # A new scheduler for each test, since its queues belong to the event loop of the test
+    monkeypatch.setattr(LLMScheduler, "_instance", None)
+    return LLMScheduler()
+
+
+def test_parse_duration():
+    assert parse_duration("20ms") == pytest.approx(0.02)
+    assert parse_duration("1s") == 1
+    assert parse_duration("6m0s") == 360
+    assert parse_duration(None) == 0
+
+
+def test_bucket_is_unlimited_until_updated():
+    bucket = TokenBucket()
+    assert bucket.wait_time(10_000) == 0
+    bucket.consume(10_000)
+    assert bucket.wait_time(10_000) == 0
+
+
+def test_bucket_update_sets_level_and_refill_rate():
+    bucket = TokenBucket()
+    # 60 of 600 left, fully replenished in 54s: 10 per second
+    bucket.update(600, 60, 54)
+    assert bucket.capacity == 600
+    assert bucket.wait_time(50) == 0
+    assert bucket.wait_time(100) == pytest.approx(4, abs=0.01)
+    bucket.consume(60)
+    assert bucket.wait_time(10) == pytest.approx(1, abs=0.01)
+    # Amounts larger than the capacity only wait for a full bucket
+    assert bucket.wait_time(10_000) == pytest.approx(60, abs=0.01)
+
+
+def test_responses_update_the_buckets(llm_scheduler):
+    llm_scheduler.update_rate_limits({
+        "x-ratelimit-limit-requests": "500", "x-ratelimit-remaining-requests": "499", "x-ratelimit-reset-requests": "120ms",
+        "x-ratelimit-limit-tokens": "30000", "x-ratelimit-remaining-tokens": "29000", "x-ratelimit-reset-tokens": "2s",
+    })
+    assert (llm_scheduler.request_bucket.capacity, llm_scheduler.request_bucket.level) == (500, 499)
+    assert (llm_scheduler.token_bucket.capacity, llm_scheduler.token_bucket.level) == (30000, 29000)
+    assert llm_scheduler.token_bucket.rate == pytest.approx(500)
+
+
+def test_slots_are_handed_out_by_priority_then_arrival():
+    async def scenario():
+        slots = PrioritySlots(1)
+        await slots.acquire(AUXILIARY)
+        order = []
+
+        async def waiter(name, priority):
+            await slots.acquire(priority)
+            order.append(name)
+            slots.release()
+
+        tasks = []
+        for name, priority in [("aux 1", AUXILIARY), ("reply 1", USER_FACING), ("aux 2", AUXILIARY), ("reply 2", USER_FACING)]:
+            tasks.append(asyncio.create_task(waiter(name, priority)))
+            await asyncio.sleep(0)
+        assert slots.queued == 4
+        slots.release()
+        await asyncio.gather(*tasks)
+        return order, slots.value
+
+    order, value = asyncio.run(scenario())
+    assert order == ["reply 1", "reply 2", "aux 1", "aux 2"]
+    assert value == 1
+
+
+def test_cancelled_slot_waiter_does_not_leak_the_slot():
+    async def scenario():
+        slots = PrioritySlots(1)
+        await slots.acquire(USER_FACING)
+        task = asyncio.create_task(slots.acquire(AUXILIARY))
+        await asyncio.sleep(0)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        slots.release()
+        return slots.value, slots.queued
+
+    assert asyncio.run(scenario()) == (1, 0)
+
+
+def test_rate_limit_waiters_go_by_priority():
+    async def scenario():
+        request_bucket, token_bucket = TokenBucket(), TokenBucket()
+        # Empty, refilled at 1000 tokens per second
+        token_bucket.update(1000, 0, 1)
+        queue = RateLimitQueue(request_bucket, token_bucket)
+        order = []
+
+        async def waiter(name, priority, tokens):
+            await queue.acquire(priority, tokens)
+            order.append(name)
+
+        # The memory update waits for its tokens first, the reply arrives while it waits and goes ahead of it
+        auxiliary = asyncio.create_task(waiter("memory update", AUXILIARY, 100))
+        await asyncio.sleep(0.01)
+        reply = asyncio.create_task(waiter("reply", USER_FACING, 100))
+        await asyncio.gather(auxiliary, reply)
+        return order, queue.queued
+
+    order, queued = asyncio.run(scenario())
+    assert order == ["reply", "memory update"]
+    assert queued == 0
+
+
+def test_cancelled_rate_limit_waiter_lets_the_next_one_go():
+    async def scenario():
+        token_bucket = TokenBucket()
+        token_bucket.update(1000, 0, 1)
+        queue = RateLimitQueue(TokenBucket(), token_bucket)
+        first = asyncio.create_task(queue.acquire(USER_FACING, 1000))
+        await asyncio.sleep(0.01)
+        second = asyncio.create_task(queue.acquire(AUXILIARY, 10))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        started = time.monotonic()
+        await second
+        await asyncio.gather(first, return_exceptions=True)
+        return time.monotonic() - started, queue.queued
+
+    waited, queued = asyncio.run(scenario())
+    assert waited < 0.5
+    assert queued == 0
+
+
+def test_deadline_expires_while_waiting_for_a_slot(llm_scheduler, monkeypatch):
+    monkeypatch.setattr(llm_scheduler, "slots", PrioritySlots(0))
+
+    async def request():
+        return FakeResponse()
+
+    with pytest.raises(LLMDeadlineExceeded):
+        asyncio.run(llm_scheduler.run("generate_response", "user", request, tokens=10, deadline=0.05))
+    assert llm_scheduler.deadlines_exceeded == 1
+    assert llm_scheduler.in_flight == 0
+    assert llm_scheduler.user_slots == {}
+
+
+def test_deadline_expires_during_the_request(llm_scheduler):
+    async def request():
+        await asyncio.sleep(1)
+
+    with pytest.raises(LLMDeadlineExceeded):
+        asyncio.run(llm_scheduler.run("predict_strategy", "user", request, tokens=10, deadline=0.05))
+    assert llm_scheduler.deadlines_exceeded == 1
+    assert llm_scheduler.slots.value == scheduler.MAX_IN_FLIGHT
+
+
+def test_retry_after_is_used_and_capped(llm_scheduler):
+    assert llm_scheduler.retry_delay(0, rate_limit_error("0.25")) == 0.25
+    assert llm_scheduler.retry_delay(0, rate_limit_error("120")) == RETRY_MAX_DELAY
+    assert 0 <= llm_scheduler.retry_delay(1, rate_limit_error()) <= scheduler.RETRY_BASE_DELAY * 2
+
+
+def test_retryable_errors_are_retried(llm_scheduler):
+    attempts = []
+
+    async def request():
+        attempts.append(time.monotonic())
+        if len(attempts) < 3:
+            raise rate_limit_error("0.01")
+        return FakeResponse({"x-ratelimit-limit-tokens": "1000", "x-ratelimit-remaining-tokens": "900",
+                             "x-ratelimit-reset-tokens": "6s"})
+
+    response = asyncio.run(llm_scheduler.run("generate_response", "user", request, tokens=10, deadline=5))
+    assert len(attempts) == 3
+    assert llm_scheduler.retries == 2
+    assert llm_scheduler.token_bucket.level == 900
+    assert response.headers["x-ratelimit-remaining-tokens"] == "900"
+
+
+def test_no_retry_past_the_deadline(llm_scheduler):
+    attempts = []
+
+    async def request():
+        attempts.append(1)
+        raise rate_limit_error("5")
+
+    with pytest.raises(openai.RateLimitError):
+        asyncio.run(llm_scheduler.run("generate_response", "user", request, tokens=10, deadline=1))
+    assert len(attempts) == 1
+    assert llm_scheduler.retries == 0
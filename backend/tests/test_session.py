@@ -0,0 +1,71 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Tests of the chat session in gpt/session.py, on the in-memory Firestore stand-in (benchmarks/memory_firestore.py).
+"""
+
+import asyncio
+import pytest
+
+from firebase import FirebaseManager
+from benchmarks.memory_firestore import MemoryStore, MemoryClient, AsyncMemoryClient
+from gpt.session import ConversationSession
+from gpt.utils import fetch_message_history, messages_doc_ref
+
+USER_ID = "test-session-user"
+SESSION_ID = "session-2026-10-19T08:00:00.000000+00:00"
+
+
+@pytest.fixture
+def session(monkeypatch):
+    store = MemoryStore()
+    firebase_manager = FirebaseManager()
+    monkeypatch.setattr(firebase_manager, "db", MemoryClient(store), raising=False)
+    monkeypatch.setattr(firebase_manager, "async_db", AsyncMemoryClient(store), raising=False)
+    firebase_manager.get_users_col().document(USER_ID).set({"jobs": {}})
+    session = ConversationSession(USER_ID, SESSION_ID)
+    session.load()
+    return session
+
+
+def test_discarded_turn_is_removed_from_firestore_and_the_views(session):
+    async def scenario():
+        await session.append({"role": "assistant", "response": "Hi, how did you sleep?"})
+        turn_start = len(session.messages)
+        await session.append({"role": "user", "response": "Badly"})
+        await session.append({"role": "assistant", "response": "Sorry to hear that"})
+        await session.discard_since(turn_start)
+
+    asyncio.run(scenario())
+    assert [message["response"] for message in fetch_message_history(USER_ID, SESSION_ID)] == ["Hi, how did you sleep?"]
+    assert [message["content"] for message in session.history_for_gpt] == ["Hi, how did you sleep?"]
+    assert len(session.annotated_history) == 1
+
+
+class BlockingClient:
+    # The sync client blocks the event loop, so a turn must not use it
+    def __getattr__(self, name):
+        raise AssertionError(f"The session used the sync Firestore client ({name})")
+
+
+def test_messages_are_written_with_the_async_client(session, monkeypatch):
+    monkeypatch.setattr(FirebaseManager(), "db", BlockingClient())
+    asyncio.run(session.append({"role": "user", "response": "Hello"}))
+    assert [message["content"] for message in session.history_for_gpt] == ["Hello"]
+
+
+def test_rewind_is_stored_and_left_out_of_the_views(session, monkeypatch):
+    async def scenario():
+        for role, response in [("user", "I walk a lot"), ("assistant", "Great!"), ("user", "Show my steps"), ("assistant", "Here")]:
+            await session.append({"role": role, "response": response})
+        await session.append({"type": "visualization", "data": []})
+        # The rewind only writes, it does not read the session again
+        monkeypatch.setattr(FirebaseManager(), "db", BlockingClient())
+        return await session.rewind()
+
+    assert asyncio.run(scenario()) == 3
+    assert [message["content"] for message in session.history_for_gpt] == ["I walk a lot", "Great!"]
+    stored = asyncio.run(messages_doc_ref(USER_ID, SESSION_ID, async_ref=True).get()).to_dict()["messages"]
+    assert [message["rewind"] for message in stored] == [False, False, True, True, True]
@@ -0,0 +1,95 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Tests of the tool result cache in gpt/tool_cache.py.
+"""
+
+import asyncio
+import pandas as pd
+import pytest
+
+from gpt import tool_cache
+from gpt.tool_cache import ToolResultCache, data_version
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    monkeypatch.setattr(ToolResultCache, "_instance", None)
+    return ToolResultCache()
+
+
+def counting(result, calls: list, delay: float = 0):
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(delay)
+        return result
+    return compute
+
+
+def test_data_version_of_settled_and_live_ranges():
+    assert data_version(pd.Timestamp("2024-01-01")) == "settled"
+    assert data_version(pd.Timestamp.now()).startswith("live-")
+
+
+def test_results_are_shared_across_sessions(cache):
+    calls = []
+    key = ("describe", "user", "health.stepcount", "2024-01-01", "2024-01-08", "day", "settled")
+
+    async def lookups():
+        first = await cache.get_or_compute(key, "session-1", counting("result", calls))
+        second = await cache.get_or_compute(key, "session-2", counting("other", calls))
+        return first, second
+
+    assert asyncio.run(lookups()) == ("result", "result")
+    assert len(calls) == 1
+    assert (cache.hits, cache.misses, cache.cross_session_hits) == (1, 1, 1)
+
+
+def test_concurrent_misses_share_one_computation(cache):
+    calls = []
+    key = ("visualize", "user", "health.stepcount", "2024-01-01", "2024-01-02", "day", "settled")
+
+    async def lookups():
+        return await asyncio.gather(*[cache.get_or_compute(key, "session", counting("result", calls, 0.01)) for _ in range(3)])
+
+    assert asyncio.run(lookups()) == ["result"] * 3
+    assert len(calls) == 1
+    assert cache.pending == {}
+
+
+def test_exceptions_are_not_cached(cache):
+    key = ("describe", "user", "health.stepcount", "2024-01-01", "2024-01-08", "day", "settled")
+
+    async def failing():
+        raise ValueError("No data found")
+
+    async def lookups():
+        with pytest.raises(ValueError):
+            await cache.get_or_compute(key, "session", failing)
+        return await cache.get_or_compute(key, "session", counting("result", []))
+
+    assert asyncio.run(lookups()) == "result"
+
+
+def test_warmed_result_is_used_by_the_lookup(cache):
+    calls = []
+    key = ("describe", "user", "health.stepcount", "2024-01-01", "2024-01-08", "day", "settled")
+
+    async def prefetch_then_lookup():
+        assert cache.warm(key, "session", counting("result", calls, 0.01))
+        assert not cache.warm(key, "session", counting("result", calls))
+        return await cache.get_or_compute(key, "session", counting("other", calls))
+
+    assert asyncio.run(prefetch_then_lookup()) == "result"
+    assert len(calls) == 1
+    assert (cache.prefetches, cache.prefetch_hits) == (1, 1)
+    assert cache.warmed == set()
+
+
+def test_oldest_entries_are_evicted(cache, monkeypatch):
+    monkeypatch.setattr(tool_cache, "MAX_ENTRIES", 2)
+    for i in range(3):
+        cache.store(("describe", f"user-{i}"), i, "session")
+    assert list(cache.entries) == [("describe", "user-1"), ("describe", "user-2")]
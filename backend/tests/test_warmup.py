@@ -0,0 +1,61 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+"""
+Tests of the data warmup on connect in gpt/warmup.py.
+"""
+
+import json
+import asyncio
+from datetime import timedelta
+from openai.types.chat import ChatCompletionMessageToolCall
+
+from gpt import functions, warmup
+from gpt.functions import handle_function_call, tool_result_cache
+from gpt.prefetch import today
+from gpt.session import ConversationSession
+from gpt.warmup import DataWarmup, WARMUP_MAX_CALLS
+
+USER_ID = "test-warmup-user"
+
+
+class FakeWebSocket:
+    async def send_json(self, data: dict):
+        pass
+
+
+def test_describe_of_the_last_two_weeks_uses_the_warmup(monkeypatch):
+    computed = []
+
+    async def fetch_aggregated_data(user_id, data_source, start, end, granularity, **kwargs):
+        computed.append((data_source, start, end, granularity))
+        return [], f"{data_source} from {start} to {end}"
+
+    async def get_user_data_sources(user_id):
+        return ["health.heartrate", "health.workout", "health.stepcount"]
+
+    async def get_tool_schema(user_id):
+        return []
+
+    monkeypatch.setattr(functions, "fetch_aggregated_data", fetch_aggregated_data)
+    monkeypatch.setattr(warmup, "get_user_data_sources", get_user_data_sources)
+    monkeypatch.setattr(warmup.tool_schema_cache, "get", get_tool_schema)
+    day = today()
+    arguments = {"data_source_name": "health.stepcount", "start": (day - timedelta(days=14)).isoformat(),
+                 "end": f"{(day - timedelta(days=1)).isoformat()} 23:59:59", "granularity": "day"}
+
+    async def connect_then_describe():
+        await DataWarmup().warm(USER_ID, "session-1")
+        warmed = len(computed)
+        hits = tool_result_cache.prefetch_hits
+        result = await handle_function_call(ChatCompletionMessageToolCall(id="call_1", type="function",
+                                                                         function={"name": "describe", "arguments": json.dumps(arguments)}), FakeWebSocket(), ConversationSession(USER_ID, "session-1"))
+        return warmed, result, tool_result_cache.prefetch_hits - hits
+
+    warmed, result, hits = asyncio.run(connect_then_describe())
+    assert warmed <= WARMUP_MAX_CALLS
+    assert result.startswith("health.stepcount from ")
+    assert hits == 1
+    assert len(computed) == warmed
+    assert {source for source, *_ in computed} <= {"health.stepcount", "health.workout"}
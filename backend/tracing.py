@@ -0,0 +1,403 @@
+# SPDX-FileCopyrightText: 2025 Stanford University
+#
+# SPDX-License-Identifier: MIT
+
+# This file defines a lightweight tracing layer. Every turn (and every resume or rewind) is a trace with a
+# root span; LLM stages, Firestore reads and writes, tool calls and the data stages are child spans.
+# The current span is kept in a context variable, so spans nest across awaits and concurrent tool calls.
+# Finished traces are written to a JSON-lines file (TRACE_FILE, see scripts/trace_report.py) and/or to an
+# OpenTelemetry collector (TRACE_OTLP, requires the opentelemetry-sdk and otlp exporter packages).
+# Tracing is off unless one of them is set, in which case spans cost a context variable lookup.
+# The Firestore wrapper below also counts documents for the metrics (see monitoring.py), so it is always used.
+
+import os
+import json
+import time
+import uuid
+import queue
+import random
+import inspect
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+from monitoring import FIRESTORE_DOCUMENTS
+from logs import get_logger
+logger = get_logger("tracing")
+
+TRACE_FILE = os.getenv("TRACE_FILE") or None
+TRACE_OTLP = os.getenv("TRACE_OTLP", "False").lower() in {"true", "t", "1", "yes", "y"}
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "gptcoach-backend")
+# Fraction of traces that are recorded; the others cost nothing beyond the sampling decision
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+
+# Firestore methods that get a span, and methods returning another reference or query to wrap
+FIRESTORE_READS = {"get", "stream", "list_documents"}
+FIRESTORE_WRITES = {"set", "update", "create", "delete", "add"}
+FIRESTORE_REFERENCES = {"collection", "document", "where", "limit", "order_by", "offset", "select",
+                        "start_at", "start_after", "end_at", "end_before"}
+
+
+class Span:
+    """
+    A timed operation within a trace
+    - name: what the span measures (str), e.g., "llm.predict_strategy"
+    - trace: the trace the span belongs to (Trace)
+    - parent_id: the ID of the enclosing span (str, None for the root span)
+    - attributes: details of the operation (dict), e.g., model and tokens
+    """
+    def __init__(self, name: str, trace, parent_id: str = None, attributes: dict = None):
+        self.name = name
+        self.trace = trace
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start = time.time_ns()
+        self.end = None
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+        return self
+
+    def add(self, attribute: str, amount: float = 1):
+        # Increment a counter attribute, e.g., retries
+        self.attributes[attribute] = self.attributes.get(attribute, 0) + amount
+        return self
+
+    def finish(self, error: BaseException = None):
+        self.end = time.time_ns()
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+        self.trace.spans.append(self)
+
+    @property
+    def duration(self) -> float:
+        # In seconds
+        return ((self.end or time.time_ns()) - self.start) / 1e9
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start / 1e9,
+            "duration": round(self.duration, 6),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class Trace:
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex
+        self.spans = []  # finished spans
+
+
+class NoopSpan:
+    # Stands in for a span when tracing is off or the trace is not sampled
+    def set(self, **attributes):
+        return self
+
+    def add(self, attribute: str, amount: float = 1):
+        return self
+
+
+NOOP_SPAN = NoopSpan()
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class JsonLinesExporter:
+    # Appends one JSON object per span to a file, from a background thread so the event loop never waits on disk
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.queue = queue.SimpleQueue()
+        threading.Thread(target=self.write, daemon=True).start()
+
+    def export(self, spans: list[Span]):
+        self.queue.put([json.dumps(span.to_dict(), default=str) for span in spans])
+
+    def write(self):
+        while True:
+            lines = self.queue.get()
+            try:
+                with open(self.path, "a") as file:
+                    file.write("\n".join(lines) + "\n")
+            except OSError as e:
+                logger.warning("Could not write spans to %s: %s", self.path, e)
+
+
+class OpenTelemetryExporter:
+    """
+    Re-creates finished traces as OpenTelemetry spans (with the original timestamps and nesting) and
+    sends them with the OTLP exporter, configured by the standard OTEL_EXPORTER_OTLP_* variables
+    """
+    def __init__(self):
+        from opentelemetry import trace
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+
+        provider = TracerProvider(resource=Resource.create({"service.name": TRACE_SERVICE_NAME}))
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+        self.trace = trace
+        self.tracer = provider.get_tracer(__name__)
+
+    def export(self, spans: list[Span]):
+        from opentelemetry.trace import Status, StatusCode
+
+        created = {}  # span ID -> OpenTelemetry span
+        # Parents start before their children, so they are created first
+        for span in sorted(spans, key=lambda span: span.start):
+            parent = created.get(span.parent_id)
+            context = self.trace.set_span_in_context(parent) if parent is not None else None
+            attributes = {key: value if isinstance(value, (bool, int, float, str)) else str(value)
+                          for key, value in span.attributes.items() if value is not None}
+            otel_span = self.tracer.start_span(span.name, context=context, start_time=span.start, attributes=attributes)
+            if span.error:
+                otel_span.set_status(Status(StatusCode.ERROR, span.error))
+            created[span.span_id] = otel_span
+        for span in spans:
+            created[span.span_id].end(end_time=span.end)
+
+
+class Tracer:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = object.__new__(cls)
+            cls._instance.exporters = []
+            if TRACE_FILE:
+                cls._instance.exporters.append(JsonLinesExporter(TRACE_FILE))
+            if TRACE_OTLP:
+                try:
+                    cls._instance.exporters.append(OpenTelemetryExporter())
+                except ImportError as e:
+                    logger.warning("TRACE_OTLP is set, but the OpenTelemetry SDK is not installed (%s). Not exporting to OpenTelemetry.", e)
+        return cls._instance
+
+    @property
+    def enabled(self) -> bool:
+        return len(self.exporters) > 0
+
+    def current(self):
+        # The innermost open span, or a span that ignores everything if there is none
+        return current_span.get() or NOOP_SPAN
+
+    @contextmanager
+    def trace(self, name: str, **attributes):
+        # Start a new trace with a root span. Nested calls start a child span instead.
+        if current_span.get() is not None:
+            with self.span(name, **attributes) as span:
+                yield span
+            return
+        if not self.enabled or random.random() >= TRACE_SAMPLE_RATE:
+            token = current_span.set(NOOP_SPAN)
+            try:
+                yield NOOP_SPAN
+            finally:
+                current_span.reset(token)
+            return
+
+        trace = Trace()
+        try:
+            with self._open(Span(name, trace, None, attributes)) as span:
+                yield span
+        finally:
+            self.export(trace)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        # Start a child span of the current span. Outside of a trace, this does nothing.
+        parent = current_span.get()
+        if parent is None or parent is NOOP_SPAN:
+            yield NOOP_SPAN
+            return
+        with self._open(Span(name, parent.trace, parent.span_id, attributes)) as span:
+            yield span
+
+    @contextmanager
+    def _open(self, span: Span):
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.finish(e)
+            raise
+        else:
+            span.finish()
+        finally:
+            current_span.reset(token)
+
+    def start_leaf(self, name: str, **attributes) -> Span:
+        # Start a span that has no children and is not made current, so it can be finished from another
+        # context (e.g., when a Firestore stream is exhausted). Returns None outside of a trace.
+        parent = current_span.get()
+        if parent is None or parent is NOOP_SPAN:
+            return None
+        return Span(name, parent.trace, parent.span_id, attributes)
+
+    def export(self, trace: Trace):
+        for exporter in self.exporters:
+            try:
+                exporter.export(trace.spans)
+            except Exception as e:
+                logger.warning("Could not export trace %s with %s: %s", trace.trace_id, type(exporter).__name__, e)
+
+
+def traced(name: str, root: bool = False):
+    """
+    Decorator that runs an async function in a span
+    - name: the name of the span (str)
+    - root: whether to start a new trace if there is none (bool)
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            tracer = Tracer()
+            with (tracer.trace(name) if root else tracer.span(name)):
+                return await function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Firestore -------------------------------------------------------------------------------------
+def estimate_size(data) -> int:
+    # Approximate size of a document in bytes (the length of its representation)
+    return len(repr(data)) if data is not None else 0
+
+
+def firestore_path(target) -> str:
+    if isinstance(getattr(target, "path", None), str):
+        return target.path
+    if getattr(target, "_path", None):
+        return "/".join(target._path)
+    parent = getattr(target, "_parent", None)
+    return firestore_path(parent) if parent is not None else type(target).__name__
+
+
+def collection_name(path: str) -> str:
+    # The collection a document or collection path points into, e.g., "raw" or "gpt-messages"
+    segments = path.split("/")
+    return segments[-1] if len(segments) % 2 == 1 else segments[-2]
+
+
+class FirestoreOperation:
+    # Counts the documents of one read or write for the metrics, and for its span if it is traced
+    def __init__(self, operation: str, path: str, span: Span = None):
+        self.kind = "write" if operation in FIRESTORE_WRITES else "read"
+        self.collection = collection_name(path)
+        self.span = span
+
+    def record(self, result=None, data=None):
+        # `result` is what a read returned (snapshot, list of snapshots or document reference), `data` what was written
+        if self.kind == "write":
+            documents, size = 1, (estimate_size(data) if self.span is not None else 0)
+        else:
+            snapshots = result if isinstance(result, list) else [result]
+            snapshots = [snapshot for snapshot in snapshots if getattr(snapshot, "exists", True)]
+            documents = len(snapshots)
+            size = sum(estimate_size(snapshot.to_dict()) for snapshot in snapshots
+                       if hasattr(snapshot, "to_dict")) if self.span is not None else 0
+        FIRESTORE_DOCUMENTS.inc(documents, operation=self.kind, collection=self.collection)
+        if self.span is not None:
+            self.span.add("documents", documents)
+            if size:
+                self.span.add("bytes", size)
+
+    def finish(self, error: BaseException = None):
+        if self.span is not None:
+            self.span.finish(error)
+
+
+class TracedFirestore:
+    """
+    Wraps a Firestore client, reference or query so that the documents of every read and write are counted
+    (see monitoring.py) and, within a trace, get a span with the number of documents and (approximate) bytes.
+    References and queries derived from it are wrapped as well.
+    - target: the client, reference or query to wrap
+    """
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if name in FIRESTORE_REFERENCES:
+            return lambda *args, **kwargs: TracedFirestore(attribute(*args, **kwargs))
+        if name in FIRESTORE_READS or name in FIRESTORE_WRITES:
+            return functools.partial(self._call, name, attribute)
+        return attribute
+
+    def __repr__(self):
+        return f"TracedFirestore({self._target!r})"
+
+    def _call(self, operation_name: str, method, *args, **kwargs):
+        path = firestore_path(self._target)
+        operation = FirestoreOperation(operation_name, path, Tracer().start_leaf(f"firestore.{operation_name}", path=path))
+        try:
+            result = method(*args, **kwargs)
+        except BaseException as e:
+            operation.finish(e)
+            raise
+        # The async client returns coroutines and async iterators, the sync client values and iterators
+        if inspect.iscoroutine(result):
+            return self._await(operation, result, args)
+        if hasattr(result, "__anext__"):
+            return self._iterate_async(operation, result)
+        if hasattr(result, "__next__"):
+            return self._iterate(operation, result)
+        operation.record(result, args[0] if args else None)
+        operation.finish()
+        return result
+
+    @staticmethod
+    async def _await(operation: FirestoreOperation, coroutine, args: tuple):
+        try:
+            result = await coroutine
+        except BaseException as e:
+            operation.finish(e)
+            raise
+        operation.record(result, args[0] if args else None)
+        operation.finish()
+        return result
+
+    @staticmethod
+    async def _iterate_async(operation: FirestoreOperation, iterator):
+        error = None
+        try:
+            async for item in iterator:
+                operation.record(item)
+                yield item
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            operation.finish(error)
+
+    @staticmethod
+    def _iterate(operation: FirestoreOperation, iterator):
+        error = None
+        try:
+            for item in iterator:
+                operation.record(item)
+                yield item
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            operation.finish(error)
+
+
+def traced_firestore(target):
+    """
+    Wrap a Firestore client or reference for metrics and tracing (see TracedFirestore)
+    - target: the client or reference to wrap
+    """
+    if target is None or isinstance(target, TracedFirestore):
+        return target
+    return TracedFirestore(target)
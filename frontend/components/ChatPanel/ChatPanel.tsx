@@ -18,6 +18,9 @@ interface ChatPanelProps {
     firebaseUserID: string
 }
 
+// Number of messages shown when (re)connecting, older ones are loaded on request
+const HISTORY_PAGE_SIZE = 50;
+
 
 export default function ChatPanel({ firebaseUserID }: ChatPanelProps) {
 
@@ -26,8 +29,10 @@ export default function ChatPanel({ firebaseUserID }: ChatPanelProps) {
     const [messages, setMessages] = useState<MessageListItem[]>([])
     const [loading, setLoading] = useState(true);
     const [loadingMessage, setLoadingMessage] = useState("");
+    // Position of the oldest shown message in the session history, older messages exist if it is above 0
+    const [historyStart, setHistoryStart] = useState(0);
 
-    const WebSocketURL = PROD ? `wss://${socketURL}/gpt/ws/${firebaseUserID}/` : `ws://${socketURL}/gpt/ws/${firebaseUserID}/`;
+    const WebSocketURL = PROD ? `wss://${socketURL}/gpt/ws/${firebaseUserID}/?history_page_size=${HISTORY_PAGE_SIZE}` : `ws://${socketURL}/gpt/ws/${firebaseUserID}/?history_page_size=${HISTORY_PAGE_SIZE}`;
     const { sendMessage, lastMessage, readyState } = useWebSocket(WebSocketURL, {
         shouldReconnect: (closeEvent) => true, // Always attempt to reconnect
         onOpen: () => setLoading(false),
@@ -36,12 +41,29 @@ export default function ChatPanel({ firebaseUserID }: ChatPanelProps) {
         reconnectAttempts: 10 // Maximum number of reconnect attempts
     });
 
+    const toVisualization = (response: any) => new VisualizationParams(
+        firebaseUserID,
+        response.name,
+        response.data_type,
+        response.unit,
+        response.granularity,
+        response.date
+    );
+
+    const toListItem = (response: any): MessageListItem => response.type === "visualization" ?
+        toVisualization(response) : new Message(response.role, response.content, response.state, response.strategy);
+
     useEffect(() => {
         if (lastMessage !== null) {
             const response = JSON.parse(lastMessage.data);
             
             if (response.type === "reset") {
                 setMessages([]);
+            } else if (response.type === "history") {
+                // The latest messages on connect (replacing the chat), or older ones that were requested
+                const items = response.messages.map(toListItem);
+                setMessages(prevMessages => response.initial ? items : [...items, ...prevMessages]);
+                setHistoryStart(response.start);
             } else if (response.type === "message") {
                 let gptMessage = new Message(response.role, response.content, response.state, response.strategy);
                 setMessages(prevMessages => [...prevMessages, gptMessage]);
@@ -49,19 +71,13 @@ export default function ChatPanel({ firebaseUserID }: ChatPanelProps) {
                 setLoadingMessage("");
                 console.log("Received message:", response);
             } else if (response.type === "visualization") {
-                let gptViz = new VisualizationParams(
-                    firebaseUserID,
-                    response.name,
-                    response.data_type,
-                    response.unit,
-                    response.granularity,
-                    response.date
-                );
-                setMessages(prevMessages => [...prevMessages, gptViz]);         
+                setMessages(prevMessages => [...prevMessages, toVisualization(response)]);         
             } else if (response.type === "loading") {
                 setLoadingMessage(response.content);
             } else if (response.type === "finish_summary") {
                 setMessages([]);
+            } else if (response.type === "error") {
+                console.warn("Backend error:", response.content);
             } else if (response.type == "rewind_confirmation") {
                 if (response.content == "success") {
                     console.log("Backend succesfully rewinded conversation!")                    
@@ -87,6 +103,10 @@ export default function ChatPanel({ firebaseUserID }: ChatPanelProps) {
         sendMessage(JSON.stringify(request));
     }
 
+    const handleLoadOlder = () => {
+        sendMessage(JSON.stringify({ type: "history", before: historyStart, limit: HISTORY_PAGE_SIZE }));
+    }
+
     const handleRewind = () => {
         console.log("rewinding...");
         // Define the rewind request object
@@ -136,6 +156,12 @@ export default function ChatPanel({ firebaseUserID }: ChatPanelProps) {
                     padding: '10px',
                     paddingBottom: '0px'
                 }}>
+                {historyStart > 0 ?
+                    <Center>
+                        <Button variant="subtle" color="gray" size="xs" onClick={handleLoadOlder}>Load older messages</Button>
+                    </Center>
+                    : null
+                }
                 <MessageList messages={messages} />
                 <Center 
                     style={{ 